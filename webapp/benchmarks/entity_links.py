@@ -0,0 +1,66 @@
+import os
+import sys
+from timeit import repeat
+
+import django
+
+
+"""
+Per-link cost of the change links the admin lists render (through `display_helpers.show_head_links`):
+`reverse` for every link, as `entity_link` used to, versus its template reversed once per model
+(see `display_helpers.change_link_template`), and the whole anchor, as `entity_tag` builds it
+
+Usage (from webapp/):
+    python -m benchmarks.entity_links [number of links]
+"""
+
+REPEATS = 5
+
+
+def entities(n_links: int) -> list:
+    """ unsaved, so nothing is queried: spots, deeds and owners, in turn """
+    from cemetery.models import Spot, Deed, Owner
+    return [Spot(pk=i, parcel='A', row=str(i % 40), column=str(i % 12)) if i % 3 == 0 else
+            Deed(pk=i, number=i, year=1990 + i % 28) if i % 3 == 1 else
+            Owner(pk=i, name=f'Nume{i} Prenume{i}')
+            for i in range(n_links)]
+
+
+def with_reverse(entities: list):
+    from django.core.urlresolvers import reverse
+    for entity in entities:
+        reverse(f'admin:cemetery_{entity.__class__.__name__.lower()}_change', args=(entity.pk,))
+
+
+def with_templates(entities: list):
+    from cemetery.display_helpers import entity_link
+    for entity in entities:
+        entity_link(entity.__class__.__name__, entity.pk)
+
+
+def with_tags(entities: list):
+    from cemetery.display_helpers import entity_tag
+    for entity in entities:
+        entity_tag(entity)
+
+
+def per_link_microseconds(function, entities: list) -> float:
+    best = min(repeat(lambda: function(entities), number=1, repeat=REPEATS))
+    return best / len(entities) * 1e6
+
+
+if __name__ == '__main__':
+    n_links = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gods_acre.settings')
+    django.setup()
+    from django.utils import translation
+    translation.activate('ro')  # the admin urls are prefixed by the language
+
+    links = entities(n_links)
+    before = per_link_microseconds(with_reverse, links)
+    after = per_link_microseconds(with_templates, links)
+    tags = per_link_microseconds(with_tags, links)
+    print(f'{n_links} links, best of {REPEATS}')
+    print(f'reverse:   {before:8.2f} us/link')
+    print(f'templates: {after:8.2f} us/link  ({before / after:.1f}x faster)')
+    print(f'anchors:   {tags:8.2f} us/link  (entity_tag, templates included)')
@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import django
+
+
+"""
+Throughput of the importer (`model_parsers.parse_sheet`, as `parse_workbook` runs it) on generated workbooks
+of increasing size (see `cemetery.synthetic_data`), for each sheet in MODELS_METADATA:
+rows per second, SQL queries per row, peak memory and where the time goes (see `cemetery.import_timings`),
+written to a json file to compare runs
+
+Each import runs twice on an emptied database: timed first, then measured (query counting, stage timings and
+memory tracing all slow it down). The database is a temporary one, the configured one is never touched
+
+Usage (from webapp/):
+    python -m benchmarks.imports [--spots 1000 5000] [--modes batch row] [--output import-benchmark.json]
+"""
+
+DEFAULT_SPOTS = [1000, 5000]
+MODES = ['batch', 'row']
+
+
+@contextmanager
+def tracing_memory():
+    """ yields a function returning the peak (in MB) of what was allocated since entering the block """
+    tracemalloc.start()
+    try:
+        yield lambda: tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def generate_workbook(n_spots: int, seed: int, path: str):
+    from cemetery.synthetic_data import SyntheticCemetery, WorkbookWriter
+    writer = WorkbookWriter(path)
+    for block in SyntheticCemetery(n_spots, seed).blocks():
+        writer.append(block.rows)
+    writer.close()
+
+
+def import_sheets(path: str, batch: bool, measured: bool):
+    """ yields (sheet name, measurements) for each sheet, imported in order into an emptied database """
+    from cemetery.models import ImportedRow, SpotSummary, ALL_MODELS
+    from cemetery.model_parsers import MODELS_METADATA, read_workbook, parse_sheet, status_counts
+    from cemetery.key_maps import KeyMaps, using_key_maps
+    from cemetery.batch_validation import validating_in_batches
+    from cemetery.spot_summaries import updating_summaries_afterwards
+    from cemetery.search_index import updating_search_afterwards
+    from cemetery.wiping import wipe
+    from cemetery.import_timings import timing_stages
+
+    wipe(ALL_MODELS + [ImportedRow, SpotSummary])
+    workbook = read_workbook(path)
+    # as `parse_workbook` does it, updating the spot summaries and search documents (not measured)
+    # once all the sheets are imported: all of them, the database was emptied
+    with using_key_maps(KeyMaps() if batch else None), validating_in_batches(), \
+            updating_summaries_afterwards(rebuild=batch), updating_search_afterwards(rebuild=batch):
+        for metadata in MODELS_METADATA:
+            sheet = workbook.pop(metadata.sheet_name)
+            if not measured:
+                start = perf_counter()
+                feedbacks = parse_sheet(sheet, metadata)
+                yield metadata.sheet_name, {'rows': len(sheet), 'seconds': perf_counter() - start,
+                                            'statuses': status_counts(feedbacks)}
+            else:
+                with timing_stages() as timings, tracing_memory() as peak_memory:
+                    parse_sheet(sheet, metadata)
+                    yield metadata.sheet_name, dict(timings.as_dict()[metadata.sheet_name],
+                                                    peak_memory_mb=peak_memory())
+
+
+def benchmark(n_spots: int, mode: str, path: str) -> list:
+    timed = dict(import_sheets(path, batch=mode == 'batch', measured=False))
+    measured = dict(import_sheets(path, batch=mode == 'batch', measured=True))
+
+    results = []
+    for sheet_name, timing in timed.items():
+        rows, seconds, queries = timing['rows'], timing['seconds'], measured[sheet_name]['total']['queries']
+        results.append({
+            'spots': n_spots,
+            'mode': mode,
+            'sheet': sheet_name,
+            'rows': rows,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds, 1) if seconds else None,
+            'queries': queries,
+            'queries_per_row': round(queries / rows, 2) if rows else None,
+            'peak_memory_mb': round(measured[sheet_name]['peak_memory_mb'], 1),
+            'statuses': timing['statuses'],
+            'stages': measured[sheet_name]['stages'],  # seconds (as measured), queries and calls of each
+            'fields': measured[sheet_name]['fields'],
+        })
+    return results
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)\
+            .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def show(result: dict) -> str:
+    return f'{result["spots"]:>8} {result["mode"]:>5}  {result["sheet"]:<16} {result["rows"]:>8} rows ' \
+           f'{result["rows_per_second"] or 0:>9.0f} rows/s {result["queries_per_row"] or 0:>7.2f} queries/row ' \
+           f'{result["peak_memory_mb"]:>7.1f} MB'
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Import throughput, queries and memory, per sheet')
+    parser.add_argument('--spots', type=int, nargs='+', default=DEFAULT_SPOTS,
+                        help='sizes of the generated cemeteries (default %(default)s)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='import-benchmark.json', help='json results (default %(default)s)')
+    args = parser.parse_args(args)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gods_acre.settings')
+    django.setup()
+    from django.conf import settings
+    from django.db import connection
+    import logging
+    settings.DEBUG = False  # queries are only logged (counted) in the measured runs
+    logging.disable(logging.WARNING)  # rows that fail to import are logged
+
+    with TemporaryDirectory() as directory:
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        connection.creation.create_test_db(verbosity=0, serialize=False)
+
+        results = []
+        for n_spots in args.spots:
+            path = os.path.join(directory, f'{n_spots}.xlsx')
+            generate_workbook(n_spots, args.seed, path)
+            for mode in args.modes:
+                for result in benchmark(n_spots, mode, path):
+                    print(show(result))
+                    results.append(result)
+        connection.close()
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': current_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'seed': args.seed,
+            'results': results,
+        }, file, indent=2)
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
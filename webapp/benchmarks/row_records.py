@@ -0,0 +1,61 @@
+import sys
+from timeit import repeat
+
+import numpy as np
+import pandas as pd
+
+from cemetery.sheet_streams import records
+
+
+"""
+Per-row overhead of turning a sheet into rows and reading their cells, as `model_parsers.parse_chunk` does:
+pandas' `iterrows` (a Series per row) versus `sheet_streams.records` (a dict per row)
+
+Usage (from webapp/):
+    python -m benchmarks.row_records [number of rows]
+"""
+
+REPEATS = 5
+
+
+def operations_sheet(n_rows: int) -> pd.DataFrame:
+    """ shaped like the (translated) Operatii sheet: mostly text, a numeric column and blanks """
+    sheet = pd.DataFrame({
+        'type':     ['inhumare', 'dezhumare'] * (n_rows // 2) + ['inhumare'] * (n_rows % 2),
+        'deceased': [f'nume{i} prenume{i}' for i in range(n_rows)],
+        'spot':     [f'a-{i % 40}-{i % 12}' for i in range(n_rows)],
+        'date':     np.arange(n_rows) % 60 + 1950,
+        'exhumation_written_report': [None] * n_rows,
+        'remains_brought_from':      [np.nan] * n_rows,
+    })
+    return sheet.replace({np.nan: None})
+
+
+def read_cells(rows, columns):
+    for row in rows:
+        for column in columns:
+            row[column]
+
+
+def with_iterrows(sheet: pd.DataFrame):
+    read_cells((row for _, row in sheet.iterrows()), sheet.columns)
+
+
+def with_records(sheet: pd.DataFrame):
+    read_cells(records(sheet), sheet.columns)
+
+
+def per_row_microseconds(function, sheet: pd.DataFrame) -> float:
+    best = min(repeat(lambda: function(sheet), number=1, repeat=REPEATS))
+    return best / len(sheet) * 1e6
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sheet = operations_sheet(n_rows)
+
+    before = per_row_microseconds(with_iterrows, sheet)
+    after = per_row_microseconds(with_records, sheet)
+    print(f'{n_rows} rows, best of {REPEATS}')
+    print(f'iterrows: {before:8.2f} us/row')
+    print(f'records:  {after:8.2f} us/row  ({before / after:.1f}x faster)')
@@ -1,17 +1,28 @@
+from typing import Optional
+from datetime import date
+
 from django.utils.translation import pgettext_lazy, ugettext_lazy as _
-from django.contrib.admin import ModelAdmin, register, site
-from django.db.models import Min, Case, When, Max
+from django.contrib.admin import ModelAdmin, SimpleListFilter, register, site
+from django.contrib.admin.utils import get_fields_from_path, get_model_from_relation
+from django.core.urlresolvers import reverse
+from django.forms.utils import flatatt
+from django.db.models import Min, Count, Prefetch
 from django.contrib.messages import SUCCESS, WARNING
 from django.utils.safestring import mark_safe
+from django.utils.html import format_html
 from easy import short, SimpleAdminField as Field
+from jet.filters import RelatedFieldAjaxListFilter
 
 from .models import Spot, Deed, OwnershipReceipt, Owner, Maintenance, Operation, PaymentUnit, PaymentReceipt, \
-    Construction, Authorization, Company
+    Construction, Authorization, Company, SpotSummary, show_unkept_year
 from .forms import SpotForm, DeedForm
+from .widgets import AutocompleteRelations
 from .inlines import OwnershipReceiptInline, MaintenanceInline, OperationInline, ConstructionInline, \
     AuthorizationInline, PaymentUnitInline
 from .utils import rev, all_equal, class_name
 from .display_helpers import entity_tag, show_head_links, truncate, show_date, year_to_shorthand
+from .spot_summaries import mark_changed
+from .search_index import search
 
 
 """
@@ -28,7 +39,25 @@ site.site_url = None  # remove the "View Site" link
 Composables
 """
 
-class CustomBaseModelAdmin(ModelAdmin):
+class AutocompleteFilter(RelatedFieldAjaxListFilter):
+    """
+    Relation filter that loads no related entity but the selected one: jet makes it an autocomplete,
+    which asks `views.autocomplete` for a page of them at a time, as the user types
+    (instead of the sidebar listing every related entity, on every load of the changelist)
+    """
+    def field_choices(self, field, request, model_admin):
+        choices = super(AutocompleteFilter, self).field_choices(field, request, model_admin)
+        model = get_model_from_relation(field)
+        self.ajax_attrs = format_html('{0}', flatatt({
+            'data-app-label': model._meta.app_label,
+            'data-model': model._meta.object_name,
+            'data-ajax--url': reverse('autocomplete'),
+            'data-queryset--lookup': self.lookup_kwarg,
+        }))
+        return choices
+
+
+class CustomBaseModelAdmin(AutocompleteRelations, ModelAdmin):
     class Media:
         css = {
             # HACK
@@ -42,10 +71,74 @@ class CustomBaseModelAdmin(ModelAdmin):
             emitter_info = f'{_(class_name(emitting_entity))} {_(entity_tag(emitting_entity))}'
             self.message_user(request, mark_safe(f'{prefix}! {emitter_info}: {message}'), WARNING)
 
+    def get_list_filter(self, request):
+        # every relation is filtered through an autocomplete (see `AutocompleteFilter`)
+        def is_relation(item) -> bool:
+            return isinstance(item, str) and get_fields_from_path(self.model, item)[-1].is_relation
+        return [(item, AutocompleteFilter) if is_relation(item) else item
+                for item in super(CustomBaseModelAdmin, self).get_list_filter(request)]
+
+    def get_search_results(self, request, queryset, search_term):
+        # the indexed models (see `search_index.py`) are searched through their documents, without joining anything
+        found = search(queryset, search_term)
+        if found is None:
+            return super(CustomBaseModelAdmin, self).get_search_results(request, queryset, search_term)
+        return found, False
+
 """
 Spot
 """
 
+# What the changelist shows for each spot, read from what `SpotAdmin.get_queryset` prefetched
+# (the equivalent `Spot` properties make queries of their own, for every row)
+
+def active_owners(spot: Spot) -> Optional[list]:
+    deeds = spot.prefetched_active_deeds
+    if not deeds:
+        return
+    return list(deeds[0].owners.all())
+
+
+def shares_deed_with(spot: Spot) -> Optional[list]:
+    deeds = spot.prefetched_active_deeds
+    if not deeds:
+        return
+    return [other for other in deeds[0].spots.all() if other.pk != spot.pk]
+
+
+def summary_of(spot: Spot) -> SpotSummary:
+    # a spot saved without signals (eg: with raw SQL) has none until the summaries are rebuilt
+    return getattr(spot, 'summary', None) or SpotSummary(spot=spot)
+
+
+def shares_authorization_with(spot: Spot) -> list:
+    others = {other.pk: other
+              for authorization in spot.authorizations.all()
+              for other in authorization.spots.all()
+              if other.pk != spot.pk}
+    return sorted(others.values(), key=lambda other: (other.parcel, other.row, other.column))
+
+
+class UnkeptSinceFilter(SimpleListFilter):
+    """ by the spot's `unkept_since` year, as summarized """
+    title = _('unkept since')
+    parameter_name = 'unkept'
+
+    def lookups(self, request, model_admin):
+        return [('no',  _('kept')),
+                ('yes', _('unkept')),
+                ('2',   _('unkept for 2 years or more')),
+                ('5',   _('unkept for 5 years or more'))]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'no':
+            return queryset.filter(summary__unkept_since__isnull=True)
+        if self.value() == 'yes':
+            return queryset.filter(summary__unkept_since__isnull=False)
+        if self.value() in ['2', '5']:
+            return queryset.filter(summary__unkept_since__lte=date.today().year - int(self.value()))
+
+
 @register(Spot)
 class SpotAdmin(CustomBaseModelAdmin):
     # What columns the list-view has
@@ -63,7 +156,8 @@ class SpotAdmin(CustomBaseModelAdmin):
     list_filter = rev(['parcel', 'row', 'column',
                        'deeds', 'deeds__owners', 'deeds__receipts',
                        'operations__type', 'constructions__type',
-                       'constructions__company'])
+                       'constructions__company',
+                       UnkeptSinceFilter])
 
     search_fields = ['parcel', 'row', 'column',
                      'deeds__number', 'deeds__year',
@@ -77,15 +171,13 @@ class SpotAdmin(CustomBaseModelAdmin):
 
     def get_queryset(self, request):
         qs = super(SpotAdmin, self).get_queryset(request)
-        return qs.annotate(first_operation=Min('operations'),
-                           first_construction=Min('constructions'),
-                           first_active_deed=Min(Case(
-                               When(deeds__cancel_reason__isnull=True, then='deeds'))),
-                           first_active_owner=Min(Case(
-                               When(deeds__cancel_reason__isnull=True, then='deeds__owners__name'))),
-                           # first_sharing_deed_spot=Min(
-                           #     When(Q(deeds__spots__deeds=spot.deeds) & Q(~deeds__spots=spot)), then='deeds__spots'),
-                           max_payments_year=Max('payments__year'))
+        # sorted by what's in the spot summaries (see `spot_summaries.py`), without joining everything
+        return qs.select_related('summary').prefetch_related(
+            Prefetch('deeds', Deed.objects.filter(cancel_reason__isnull=True).prefetch_related('owners', 'spots'),
+                     to_attr='prefetched_active_deeds'),
+            Prefetch('operations', Operation.objects.select_related('spot')),
+            Prefetch('constructions', Construction.objects.prefetch_related('spots')),
+            Prefetch('authorizations', Authorization.objects.prefetch_related('spots')))
 
     # put show_repr instead of just __str__ in list_display
     # because we want the non-breaking hyphens added by `entity_tag` but not from regular __str__
@@ -94,15 +186,15 @@ class SpotAdmin(CustomBaseModelAdmin):
     show_row    = Field(lambda s: s.row,    'R', admin_order_field='row')
     show_column = Field(lambda s: s.column, 'C', admin_order_field='column')
 
-    show_active_deed   = Field(lambda s: show_head_links(s.active_deeds, 1),     _('Active Deed'),   'first_active_deed',    True)
-    show_owners        = Field(lambda s: show_head_links(s.active_owners),       _('Active Owners'), 'first_active_owner',   True)
-    show_operations    = Field(lambda s: show_head_links(s.operations, 1),       _('Operations'),    'first_operation',      True)
-    show_constructions = Field(lambda s: show_head_links(s.constructions, 1),    _('Constructions'), 'first_construction',   True)
+    show_active_deed   = Field(lambda s: show_head_links(s.prefetched_active_deeds, 1), _('Active Deed'), 'summary__active_deed', True)
+    show_owners        = Field(lambda s: show_head_links(active_owners(s)),      _('Active Owners'), 'summary__first_active_owner', True)
+    show_operations    = Field(lambda s: show_head_links(s.operations, 1),       _('Operations'),    'summary__n_operations',       True)
+    show_constructions = Field(lambda s: show_head_links(s.constructions, 1),    _('Constructions'), 'summary__n_constructions',    True)
 
-    show_shares_deed_with = Field(lambda s: show_head_links(s.shares_deed_with), _('Sharing Deed'),                          allow_tags=True)
-    show_last_paid_year   = Field(lambda s: s.last_paid_year,                    _('Last Paid'),     'max_payments_year')
-    show_unkept_since     = Field(lambda s: s.unkept_since,                      _('Unkept Since'))
-    show_shares_authorizations_with = Field(lambda s: show_head_links(s.shares_authorization_with), _('Sharing Auth.'),      allow_tags=True)
+    show_shares_deed_with = Field(lambda s: show_head_links(shares_deed_with(s)), _('Sharing Deed'),                         allow_tags=True)
+    show_last_paid_year   = Field(lambda s: summary_of(s).last_paid_year,         _('Last Paid'),     'summary__last_paid_year')
+    show_unkept_since     = Field(lambda s: show_unkept_year(summary_of(s).unkept_since), _('Unkept Since'), 'summary__unkept_since')
+    show_shares_authorizations_with = Field(lambda s: show_head_links(shares_authorization_with(s)), _('Sharing Auth.'),     allow_tags=True)
 
     # def save_model(self, request, spot, form, change):
     #     # TODO this can only be applied after the model is saved (needs pk to access m2m)
@@ -237,7 +329,7 @@ class OperationAdmin(CustomBaseModelAdmin):
                        'spot__parcel', 'spot__row', 'spot__column',
                        'spot__deeds__owners'])
 
-    search_fields = ['type', 'date', 'deceased', 'note', 'exhumation_written_report', 'remains_brought_from',
+    search_fields = ['type', 'date', 'deceased', 'exhumation_written_report', 'remains_brought_from',
                      'spot__parcel', 'spot__row', 'spot__column',
                      'spot__deeds__owners__name']
 
@@ -282,7 +374,7 @@ class ConstructionAdmin(CustomBaseModelAdmin):
                        'authorizations'])
 
     search_fields = ['type', 'owner_builder__name', 'company__name',
-                     'spots__parcel', 'spots__row', 'spots__column'
+                     'spots__parcel', 'spots__row', 'spots__column',
                      'authorizations__number', 'authorizations__year']
 
     # no custom form
@@ -312,8 +404,13 @@ class CompanyAdmin(CustomBaseModelAdmin):
 
     inlines = [ConstructionInline]
 
-    show_n_constructions = Field(lambda c: c.n_constructions,                   _('#Constructions'))
-    show_constructions   = Field(lambda c: show_head_links(c.constructions, 5), _('Constructions'), 'constructions', True)
+    def get_queryset(self, request):
+        qs = super(CompanyAdmin, self).get_queryset(request)
+        return qs.annotate(constructions_count=Count('constructions'))
+
+    show_n_constructions = Field(lambda c: c.constructions_count,               _('#Constructions'))
+    show_constructions   = Field(lambda c: show_head_links(c.constructions, 5, c.constructions_count),
+                                 _('Constructions'), 'constructions', True)
 
 
 """
@@ -419,7 +516,9 @@ class MaintenanceAdmin(CustomBaseModelAdmin):
 
     @short(desc=_('Mark selected entries as kept'))
     def mark_kept(self, request, queryset):
+        spot_pks = list(queryset.values_list('spot', flat=True))  # before the update, it can change what's selected
         n_updated = queryset.update(kept=True)
+        mark_changed(spots=spot_pks)  # updates don't send signals
 
         if n_updated == 1:
             prefix = '1 entry was'
@@ -430,7 +529,9 @@ class MaintenanceAdmin(CustomBaseModelAdmin):
 
     @short(desc=_('Mark selected entries as unkept'))
     def mark_unkept(self, request, queryset):
+        spot_pks = list(queryset.values_list('spot', flat=True))
         n_updated = queryset.update(kept=False)
+        mark_changed(spots=spot_pks)
 
         if n_updated == 1:
             prefix = '1 entry was'
@@ -6,3 +6,8 @@ from django.apps import AppConfig
 class CemeteryConfig(AppConfig):
     name = 'cemetery'
     verbose_name = _('cemetery')
+
+    def ready(self):
+        from . import spot_summaries  # connects the signals keeping the spot summaries up to date
+        from . import search_index  # and the ones keeping the search documents up to date
+        from . import jobs  # and the one letting the database be read during background imports
@@ -0,0 +1,230 @@
+from typing import Optional, Dict, List, Iterable, Tuple
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+
+import numpy as np
+import pandas as pd
+
+from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
+from django.core.validators import RegexValidator, BaseValidator
+from django.db.models import Model
+
+
+"""
+Validation of many entities at once, what imports do instead of a `full_clean` on every save (see `models.validate_model`):
+each field validator runs over a whole column (vectorized for regex and limit validators) and uniqueness is checked
+against the keys of every entity, loaded once per model, instead of with a query per check and entity
+"""
+
+_local = threading.local()  # the validation of the import running on this thread (if any)
+
+VECTORIZE_FROM = 50  # values, for fewer (eg: a single entity being saved) building the arrays costs more than it saves
+
+
+def screen(validator, values: list) -> np.ndarray:
+    """
+    Which of the `values` the `validator` (might) reject, computed for all of them at once where possible
+
+    Examples:
+        >>> screen(RegexValidator(r'^\\d+$'), ['12', 'a1', 3] * VECTORIZE_FROM).tolist()[:3]
+        [False, True, False]
+        >>> from django.core.validators import MinValueValidator, MaxLengthValidator
+        >>> screen(MinValueValidator(0), [1, -1] * VECTORIZE_FROM).tolist()[:2]
+        [False, True]
+        >>> screen(MaxLengthValidator(2), ['ab', 'abc']).tolist()
+        [False, True]
+    """
+    if len(values) >= VECTORIZE_FROM:
+        if isinstance(validator, RegexValidator):
+            matches = pd.Series(values, dtype=object).astype(str).map(validator.regex.search).notnull().values
+            return matches if validator.inverse_match else ~matches
+        if isinstance(validator, BaseValidator):  # eg: min value, max length
+            cleaned = np.empty(len(values), dtype=object)
+            cleaned[:] = [validator.clean(value) for value in values]
+            return np.asarray(validator.compare(cleaned, validator.limit_value), dtype=bool)
+
+    def rejects(value) -> bool:
+        try:
+            validator(value)
+            return False
+        except ValidationError:
+            return True
+    return np.array([rejects(value) for value in values], dtype=bool)
+
+
+def clean_column(field, entities: List[Model]) -> Dict[int, List[ValidationError]]:
+    """
+    `field.clean` of its value on each of the `entities` (cleaned values are set back),
+    except the validators, which are applied to the whole column
+
+    Returns:
+        errors (dict<int: list<ValidationError>>): by the index of each entity with an invalid value
+    """
+    errors = defaultdict(list)
+    checked, values = [], []  # the entities whose (non empty) values get to the validators, and those values
+    for i, entity in enumerate(entities):
+        raw_value = getattr(entity, field.attname)
+        if field.blank and raw_value in field.empty_values:
+            continue  # like `Model.clean_fields` does
+        try:
+            value = field.to_python(raw_value)
+            field.validate(value, entity)
+        except ValidationError as error:
+            errors[i].extend(error.error_list)
+            continue
+        setattr(entity, field.attname, value)
+        if value not in field.empty_values:
+            checked.append(i)
+            values.append(value)
+
+    for validator in field.validators:
+        for j in np.flatnonzero(screen(validator, values)):
+            try:
+                validator(values[j])  # for its exact message (the screen is only a filter)
+            except ValidationError as error:
+                if hasattr(error, 'code') and error.code in field.error_messages:
+                    error.message = field.error_messages[error.code]
+                errors[checked[j]].extend(error.error_list)
+    return errors
+
+
+class UniqueKeys:
+    """
+    The values of the unique fields (and unique together fields) of every `model` entity, loaded with one query each.
+    Keys point to the entity they come from: a pk, or the entity itself for the ones validated during the import
+    """
+    def __init__(self, model):
+        self.model = model
+        opts = model._meta
+        self.checks = [(f.name,) for f in opts.local_fields if f.unique and not f.primary_key] + \
+                      [tuple(fields) for fields in opts.unique_together]
+        self.keys = {}  # fields ~> key ~> pk or entity
+        for check in self.checks:
+            self.keys[check] = {tuple(key): pk for pk, *key in model._default_manager.values_list('pk', *check)
+                                if None not in key}
+
+    def key(self, entity, check: Tuple[str]) -> Optional[tuple]:
+        """ None if any of the values is missing (NULLs never clash) """
+        key = tuple(getattr(entity, self.model._meta.get_field(name).attname) for name in check)
+        return None if None in key else key
+
+    def clashes(self, entity, check: Tuple[str]) -> bool:
+        key = self.key(entity, check)
+        other = self.keys[check].get(key) if key is not None else None
+        if other is None or other is entity or (entity.pk is not None and getattr(other, 'pk', other) == entity.pk):
+            return False
+        if isinstance(other, Model) and other.pk is None:  # not in the database (yet), a clash within the import
+            return True
+
+        # confirmed with a query: the key might be stale (eg: the entity it comes from was changed or rolled back)
+        matching = self.model._default_manager.filter(**dict(zip(check, key)))
+        if entity.pk is not None:
+            matching = matching.exclude(pk=entity.pk)
+        return matching.exists()
+
+    def add(self, entity):
+        for check in self.checks:
+            key = self.key(entity, check)
+            if key is not None:
+                self.keys[check][key] = entity
+
+
+class BatchValidation:
+    """ validation for one whole import, with the unique keys of each model loaded on first use """
+    def __init__(self):
+        self.unique_keys = {}
+
+    def keys(self, model) -> UniqueKeys:
+        if model not in self.unique_keys:
+            self.unique_keys[model] = UniqueKeys(model)
+        return self.unique_keys[model]
+
+    def validate(self, entities: List[Model], exclude: Iterable[str] = (), unique: bool = True) \
+            -> Dict[int, Exception]:
+        """
+        Same as `full_clean(exclude, unique)` on each of the `entities` (all of the same model),
+        with the fields cleaned in place. If `unique`, the valid ones are then taken into account
+        when checking the uniqueness of the next ones
+
+        Returns:
+            errors (dict<int: Exception>): by the index of each invalid entity in `entities`, a ValidationError
+                (or whatever else the model's own cleaning raised)
+        """
+        if not entities:
+            return {}
+        model = type(entities[0])
+        exclude = set(exclude)
+        crashed = {}  # index ~> anything but a ValidationError, raised by the model's own cleaning
+
+        # the models' own clean_fields only normalize values (eg: title case) before calling the default one,
+        # which is left with nothing to do: the fields are cleaned column by column below
+        everything = [f.name for f in model._meta.concrete_fields]
+        for i, entity in enumerate(entities):
+            try:
+                entity.clean_fields(exclude=everything)
+            except Exception as error:
+                crashed[i] = error
+        indices = [i for i in range(len(entities)) if i not in crashed]
+
+        errors = defaultdict(dict)  # index ~> field name ~> errors
+        for field in model._meta.concrete_fields:
+            if field.name not in exclude:
+                for j, field_errors in clean_column(field, [entities[i] for i in indices]).items():
+                    errors[indices[j]][field.name] = field_errors
+
+        for i in indices:
+            try:
+                entities[i].clean()
+            except ValidationError as error:
+                errors[i] = error.update_error_dict(errors[i])
+            except Exception as error:
+                crashed[i] = error
+
+        if unique:
+            keys = self.keys(model)
+            for i in [i for i in indices if i not in crashed]:
+                entity = entities[i]
+                for check in keys.checks:
+                    if exclude.intersection(check) or any(name in errors[i] for name in check):
+                        continue
+                    if keys.clashes(entity, check):
+                        error_key = check[0] if len(check) == 1 else NON_FIELD_ERRORS
+                        errors[i].setdefault(error_key, []).append(entity.unique_error_message(model, check))
+                if not errors[i]:
+                    keys.add(entity)
+
+        invalid = {i: ValidationError(entity_errors) for i, entity_errors in errors.items() if entity_errors}
+        invalid.update(crashed)
+        return invalid
+
+    def validate_one(self, entity):
+        """
+        For the entities saved one by one during the import, raises the error if it's invalid.
+        Foreign keys aren't checked: they point to entities that were just retrieved (or saved)
+        """
+        foreign_keys = [f.name for f in entity._meta.concrete_fields if f.is_relation]
+        errors = self.validate([entity], exclude=foreign_keys)
+        if errors:
+            raise errors[0]
+
+
+def active_validation() -> Optional[BatchValidation]:
+    """ the validation the current import runs with, None when not importing (ie: `full_clean` on each save) """
+    return getattr(_local, 'validation', None)
+
+
+@contextmanager
+def validating_in_batches():
+    """ saves made during the block are validated by a (new) BatchValidation instead of `full_clean` """
+    previous = active_validation()
+    _local.validation = BatchValidation()
+    try:
+        yield _local.validation
+    finally:
+        _local.validation = previous
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
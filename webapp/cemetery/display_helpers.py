@@ -1,14 +1,23 @@
-from typing import Optional
+from typing import Optional, List, Tuple
 from datetime import datetime
-
-from django.core.urlresolvers import reverse
-from django.utils.safestring import mark_safe
+from functools import lru_cache
+import sqlite3
+
+from django.core.urlresolvers import reverse, get_urlconf, get_script_prefix
+from django.core.signals import setting_changed
+from django.utils.translation import get_language
+from django.db import connections
+from django.db.models import QuerySet
+from django.db.models.expressions import RawSQL
+from django.utils.html import format_html
 from titlecase import titlecase as titlecase_external
 
 
 DEFAULT_HEAD_LENGTH = 2
 NB_HYPHEN = '‑'
 NBSP = '\u00A0'  # non-breaking white-space
+SQLITE_WINDOW_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 25, 0)  # eg: COUNT(*) OVER ()
+URL_ARG_MARKER = 'URLARGMARKER'  # reversed in place of the argument, to be replaced by it (nothing to quote in it)
 
 
 """ 
@@ -40,9 +49,29 @@ def add_link(model_name: str, popup: bool = True) -> str:
     return link
 
 
+@lru_cache(maxsize=None)
+def change_link_template(model_name: str, urlconf, script_prefix: str, language: str) -> Tuple[str, str]:
+    """
+    What the change link of `model_name` has before and after the pk, reversed once
+    for everything reversing depends on (which is why those are arguments, they're the cache key)
+    """
+    model_name = model_name.replace('_', '').lower()  # delete underscores
+    link = reverse(f'admin:cemetery_{model_name}_change', urlconf=urlconf, args=(URL_ARG_MARKER,))
+    before, after = link.split(URL_ARG_MARKER)
+    return before, after
+
+
+def clear_link_templates(setting, **kwargs):
+    """ reversing gives other links once the urlconf is changed (eg: in tests) """
+    if setting == 'ROOT_URLCONF':
+        change_link_template.cache_clear()
+setting_changed.connect(clear_link_templates, dispatch_uid='clear_link_templates')
+
+
 def entity_link(model_name: str, pk) -> str:
     """
     Link building from https://docs.djangoproject.com/en/1.11/ref/contrib/admin/#reversing-admin-urls
+    only reversed once per model (and language), see `change_link_template`
 
     Args:
         model_name (str): name in snake_case (with underscores) - what to build the link for
@@ -51,9 +80,8 @@ def entity_link(model_name: str, pk) -> str:
     Returns:
         link (str): to change/edit page of the one entity
     """
-    model_name = model_name.replace('_', '').lower()  # delete underscores
-    link_name = f'admin:cemetery_{model_name}_change'
-    return reverse(link_name, args=(pk,))
+    before, after = change_link_template(model_name, get_urlconf(), get_script_prefix(), get_language())
+    return f'{before}{pk}{after}'
 
 
 def entity_tag(entity) -> Optional[str]:
@@ -77,7 +105,7 @@ def entity_tag(entity) -> Optional[str]:
     # do the conversion from regular hyphen to non-breaking hyphen here instead of putting it in __str__ directly
     # because then searching for A-1-2 in multi-select box would not work (because they would not be regular hyphens)
     entity_str = str(entity).replace(' ', NBSP).replace('-', NB_HYPHEN)
-    return mark_safe(f'<a href="{link}">{entity_str}</a>')
+    return format_html('<a href="{}">{}</a>', link, entity_str)  # names come from the imported documents: escaped
 
 
 def head_plus_more(entities, head_length=None) -> (Optional[str], Optional[str]):
@@ -119,28 +147,60 @@ def head_plus_more(entities, head_length=None) -> (Optional[str], Optional[str])
     if head_length == 'all':
         head_length = len(entities)
 
-    tail_length = len(entities) - head_length
-    tail_summary = '' if tail_length <= 0 else f'{NBSP}(+{tail_length})'
+    return entities[:head_length], tail_summary(len(entities) - head_length)
+
 
-    return entities[:head_length], tail_summary
+def tail_summary(tail_length: int) -> str:
+    """ how `head_plus_more` shows the entities after the head """
+    return '' if tail_length <= 0 else f'{NBSP}(+{tail_length})'
 
 
-def show_head_links(query, head_length=None) -> Optional[str]:
+def head_and_count(queryset: QuerySet, head_length: int, count: int = None) -> (List, int):
+    """
+    The first `head_length` entities of `queryset` and how many it has in all, without loading the others.
+    One query, counting them with a window function, unless the count is given (eg: annotated or summarized).
+    Where there's no window function (or DISTINCT would be applied after it) one more row is loaded instead,
+    to know if there are others, and only then are they counted
+    """
+    if count is not None:
+        return list(queryset[:head_length]), count
+
+    windowed = connections[queryset.db].vendor == 'sqlite' and SQLITE_WINDOW_FUNCTIONS and not queryset.query.distinct
+    if windowed and head_length > 0:
+        head = list(queryset.annotate(total_count=RawSQL('COUNT(*) OVER ()', ()))[:head_length])
+        return head, head[0].total_count if head else 0
+
+    head = list(queryset[:head_length + 1])
+    if len(head) <= head_length:
+        return head, len(head)
+    return head[:head_length], queryset.count()
+
+
+def show_head_links(query, head_length=None, count: int = None) -> Optional[str]:
     """
     Links the first item and shows the others.
+    Only the head is loaded (see `head_and_count`), unless the entities already are (eg: prefetched)
 
     Args:
-        query: Django query manager (or something that has .all = () -> list)
+        query: Django query manager (or something that has .all = () -> list), or a list of entities (eg: prefetched)
         head_length: passed to `head_plus_more`
+        count: how many entities there are in all, if already known (eg: annotated)
 
     Returns:
         tag (str?): html for anchor
     """
-    if not query:
+    if query is None:
         return
 
-    entities = query.all()
-    head, others = head_plus_more(entities, head_length)
+    entities = query if isinstance(query, list) else query.all()
+    if head_length is None:
+        head_length = DEFAULT_HEAD_LENGTH
+
+    if isinstance(entities, QuerySet) and entities._result_cache is None and head_length != 'all':
+        head, count = head_and_count(entities, head_length, count)
+        others = tail_summary(count - len(head))
+    else:
+        head, others = head_plus_more(entities, head_length)
     if not head:  # no entities
         return
 
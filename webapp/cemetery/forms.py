@@ -1,20 +1,19 @@
 from django.utils.translation import ugettext_lazy as _
 from django.forms import Form, ModelForm, ModelMultipleChoiceField, BooleanField, FileField
-from django.contrib.admin.widgets import FilteredSelectMultiple
 
 from .models import Spot, Deed,  Owner, Construction, Authorization
-from .widgets import AddAnotherWidgetWrapper
+from .widgets import AddAnotherWidgetWrapper, AutocompleteSelectMultiple
 
 
-def many_to_many_field(model, required=False, name=None, is_stacked=False):
+def many_to_many_field(model, required=False, name=None):
     if name is None:
         name = _(model.__name__ + 's')
     return ModelMultipleChoiceField(
-        queryset=model.objects.all(),
+        queryset=model.objects.all(),  # only to validate the chosen ones, the widget doesn't list them all
         required=required,
         label=name,
         widget=AddAnotherWidgetWrapper(
-            widget=FilteredSelectMultiple(is_stacked=is_stacked, verbose_name=name),
+            widget=AutocompleteSelectMultiple(model),
             model=model
         )
     )
@@ -55,6 +54,7 @@ class SpotForm(ModelForm):
 
 
 class DeedForm(ModelForm):
+    spots  = many_to_many_field(Spot, required=True)  # as the model field's form field was (it's not blank)
     owners = many_to_many_field(Owner)
 
     class Meta:
@@ -82,3 +82,12 @@ class DeedForm(ModelForm):
 class ImportForm(Form):
     document = FileField(label=_('Document'))
     wipe_beforehand = BooleanField(required=False, label=_('Wipe beforehand'))
+    all_or_nothing  = BooleanField(required=False, label=_('All or nothing'),
+                                   help_text=_('If any row fails, nothing is saved'))
+    incremental     = BooleanField(required=False, label=_('Skip unchanged rows'),
+                                   help_text=_('Rows that are identical to when they were last imported are not '
+                                               'imported again'))
+    dry_run         = BooleanField(required=False, label=_('Preview'),
+                                   help_text=_('Only show what would be imported, without saving anything'))
+    time_stages     = BooleanField(required=False, label=_('Time the stages'),
+                                   help_text=_('Measure how long each stage of the import takes (makes it slower)'))
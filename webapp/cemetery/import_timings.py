@@ -0,0 +1,157 @@
+from typing import Optional, Dict
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+import threading
+
+from django.db import connection
+
+
+"""
+Optional instrumentation of the importer: wall time and SQL queries accumulated for each sheet,
+per stage of parsing its rows (see `model_parsers.parse_row` and `parse_rows_batch`) and per field parser.
+Off unless the import runs inside `timing_stages`, which also has every query counted (through the debug cursor)
+"""
+
+_local = threading.local()  # the timings of the import running on this thread (if any)
+
+
+class QueryCounter:
+    """ stands in for a connection's queries log, counting the queries instead of keeping them """
+    def __init__(self):
+        self.count = 0
+
+    def append(self, query):
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+
+@contextmanager
+def counting_queries(db=connection):
+    """ every query made through `db` during the block is counted by the yielded QueryCounter """
+    counter = QueryCounter()
+    queries_log, force_debug_cursor = db.queries_log, db.force_debug_cursor
+    db.queries_log, db.force_debug_cursor = counter, True
+    try:
+        yield counter
+    finally:
+        db.queries_log, db.force_debug_cursor = queries_log, force_debug_cursor
+
+
+class Totals:
+    """ what the blocks it measures took, all together (used as a context manager) """
+    __slots__ = ['seconds', 'queries', 'calls', 'counter', 'start', 'first_query']
+
+    def __init__(self, counter: QueryCounter):
+        self.seconds, self.queries, self.calls = 0., 0, 0
+        self.counter = counter
+
+    def __enter__(self):
+        self.start, self.first_query = perf_counter(), self.counter.count
+
+    def __exit__(self, *exception):
+        self.seconds += perf_counter() - self.start
+        self.queries += self.counter.count - self.first_query
+        self.calls += 1
+
+    def as_dict(self) -> Dict[str, float]:
+        return {'seconds': round(self.seconds, 4), 'queries': self.queries, 'calls': self.calls}
+
+
+class NotTimed:
+    """ what `timed_stage` and `timed_field` give when not timing: does nothing, as cheaply as possible """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exception):
+        pass
+
+_not_timed = NotTimed()
+
+
+class StageTimings:
+    """ the totals of one import, by sheet, then by stage or field parser (in the order they first ran) """
+    def __init__(self, counter: QueryCounter):
+        self.counter = counter
+        self.sheets = OrderedDict()  # sheet name ~> {'total': Totals, 'stages': {name: Totals}, 'fields': ...}
+        self.sheet_name = None
+
+    def totals(self, group: str, name: str) -> Totals:
+        sheet = self.sheets[self.sheet_name]
+        if name not in sheet[group]:
+            sheet[group][name] = Totals(self.counter)
+        return sheet[group][name]
+
+    @contextmanager
+    def sheet(self, sheet_name: str):
+        """ what's measured during the block counts towards `sheet_name`, and so does the block itself """
+        self.sheets.setdefault(sheet_name, {'total': Totals(self.counter),
+                                            'stages': OrderedDict(), 'fields': OrderedDict()})
+        previous, self.sheet_name = self.sheet_name, sheet_name
+        try:
+            with self.sheets[sheet_name]['total']:
+                yield
+        finally:
+            self.sheet_name = previous
+
+    def as_dict(self) -> Dict[str, dict]:
+        """ json serializable: sheet name ~> 'total' / 'stages' / 'fields' ~> name ~> seconds, queries, calls """
+        return OrderedDict((sheet_name, {
+            'total':  sheet['total'].as_dict(),
+            'stages': OrderedDict((name, totals.as_dict()) for name, totals in sheet['stages'].items()),
+            'fields': OrderedDict((name, totals.as_dict()) for name, totals in sheet['fields'].items()),
+        }) for sheet_name, sheet in self.sheets.items())
+
+
+def active_timings() -> Optional[StageTimings]:
+    """ the timings of the current import, None when it's not being timed """
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def timing_stages():
+    """
+    Imports during the block are timed, by the yielded (new) StageTimings
+
+    Examples:
+        >>> with timing_stages() as timings, timing_sheet('Operatii'):
+        ...     for _ in range(2):
+        ...         with timed_stage('save'):
+        ...             pass
+        >>> timings.as_dict()['Operatii']['stages']['save']['calls']
+        2
+        >>> active_timings() is None
+        True
+    """
+    previous = active_timings()
+    with counting_queries() as counter:
+        _local.timings = StageTimings(counter)
+        try:
+            yield _local.timings
+        finally:
+            _local.timings = previous
+
+
+def timing_sheet(sheet_name: str):
+    """ context manager: the stages and field parsers measured during the block belong to `sheet_name` """
+    timings = active_timings()
+    return timings.sheet(sheet_name) if timings is not None and timings.sheet_name != sheet_name else _not_timed
+
+
+def timed_stage(name: str):
+    """ context manager adding the time and queries of the block to the stage `name` (if timing) """
+    timings = active_timings()
+    return timings.totals('stages', name) if timings is not None and timings.sheet_name else _not_timed
+
+
+def timed_field(name: str):
+    """ same as `timed_stage`, for the parser of the field `name` """
+    timings = active_timings()
+    return timings.totals('fields', name) if timings is not None and timings.sheet_name else _not_timed
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
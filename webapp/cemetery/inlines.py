@@ -2,13 +2,14 @@ from django.contrib.admin import TabularInline
 from jet.admin import CompactInline
 
 from .models import OwnershipReceipt, Maintenance, Operation,  PaymentUnit, Construction, Authorization
+from .widgets import AutocompleteRelations
 
 
-class SmallInline(TabularInline):
+class SmallInline(AutocompleteRelations, TabularInline):
     extra = 1
     show_change_link = True
 
-class LargeInline(CompactInline):  # yeah, the name they chose, "Compact", can lead to confusion
+class LargeInline(AutocompleteRelations, CompactInline):  # yeah, the name they chose, "Compact", can lead to confusion
     extra = 1
     show_change_link = True
 
@@ -0,0 +1,138 @@
+from typing import Dict, Tuple, List
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from tempfile import NamedTemporaryFile
+import os
+import json
+import threading
+import traceback
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.uploadedfile import UploadedFile
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+from .models import ImportJob, ImportedRow, ImportFeedback, SpotSummary, ALL_MODELS
+from .model_parsers import RowFeedback, EntityRef, parse_file
+from .sheet_streams import is_csv_archive
+from .wiping import wipe
+from .import_timings import timing_stages
+
+
+"""
+Background imports: the upload request only records an ImportJob, the parsing happens on a worker thread.
+The server is assumed to run the app in a single process (threads are fine): the worker and the live progress
+counters live in the process that got the upload, the others only see the progress saved between sheets
+(and would each run their own worker, so imports, and their writes, could overlap)
+"""
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=1)  # sqlite allows only one writer at a time anyway
+
+STREAMING_THRESHOLD = 5 * 1024 * 1024  # bytes, larger documents are read in chunks while parsing them
+VACUUM_AFTER_WIPE = True  # give the disk space back after wiping (sqlite files never shrink otherwise)
+
+# job id ~> sheet name ~> (rows parsed, rows in sheet - None while streaming csv)
+# the counters saved on the job lag behind: they can only be written between sheets (outside their transaction)
+_live_progress = {}
+_live_progress_lock = threading.Lock()
+
+
+def use_write_ahead_log(sender, **kwargs):
+    """
+    Puts sqlite in WAL mode (kept by the database file once set): reading doesn't wait for an import holding
+    a write transaction for a whole sheet (or document), eg: the progress polls and the admin's pages.
+    Writers still take turns: an admin save waits for the import's transaction (up to the database's timeout)
+    """
+    db = kwargs['connection']
+    if db.vendor == 'sqlite':
+        with db.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+
+connection_created.connect(use_write_ahead_log, dispatch_uid='use_write_ahead_log')
+
+
+def spool_upload(upload: UploadedFile) -> str:
+    """ copies the uploaded document to a temporary file, to be read by the job once the request is over """
+    with NamedTemporaryFile(suffix=os.path.splitext(upload.name)[1], delete=False) as spooled:
+        for chunk in upload.chunks():  # never the whole document in memory
+            spooled.write(chunk)
+    return spooled.name
+
+
+def submit_import(job: ImportJob, path: str):
+    """ queue the import of the excel document at `path` for `job`, the file is deleted once it's done """
+    _executor.submit(run_import, job.pk, path)
+
+
+def live_progress(job: ImportJob) -> Dict[str, Tuple[int, int]]:
+    """ most recent progress counters, if the job is running in this process, otherwise the saved ones """
+    with _live_progress_lock:
+        if job.pk in _live_progress:
+            return dict(_live_progress[job.pk])
+    return json.loads(job.progress)
+
+
+def save_feedbacks(job: ImportJob, sheet_feedbacks: Dict[str, List[RowFeedback]]):
+    """ one ImportFeedback per row, entities are only referenced (see `model_parsers.show_feedback_entities`) """
+    def stored(sheet_name, i, feedback):
+        entity = feedback.info if isinstance(feedback.info, EntityRef) else None
+        return ImportFeedback(job=job, sheet_name=sheet_name, row=i + 2,  # the header is the first row in excel
+                              status=feedback.status, info='' if entity else feedback.info,
+                              additional=feedback.additional,
+                              entity_type=ContentType.objects.get_for_model(entity.model) if entity else None,
+                              entity_id=entity.pk if entity else None)
+
+    for sheet_name, feedbacks in sheet_feedbacks.items():
+        ImportFeedback.objects.bulk_create([stored(sheet_name, i, f) for i, f in enumerate(feedbacks)])
+
+
+def run_import(job_id: int, path: str):
+    job = ImportJob.objects.get(pk=job_id)
+    job.status = ImportJob.RUNNING
+    job.save()
+
+    def on_progress(sheet_name: str, n_parsed: int, n_rows: int):
+        with _live_progress_lock:
+            progress = _live_progress.setdefault(job_id, {})
+            progress[sheet_name] = n_parsed, n_rows
+            snapshot = json.dumps(progress)
+        if n_parsed == n_rows:  # the sheet was committed
+            ImportJob.objects.filter(pk=job_id).update(progress=snapshot)
+
+    def import_content():
+        if job.wipe_beforehand and not job.dry_run:  # a preview of a wipe runs as if the database was empty instead
+            job.wipe_duration = wipe(ALL_MODELS + [ImportedRow, SpotSummary], vacuum=VACUUM_AFTER_WIPE)
+            logger.info(f'Import {job_id} wiped the database in {job.wipe_duration:.2f}s')
+
+        incremental = job.incremental and not job.wipe_beforehand  # after a wipe, nothing is left to compare with
+        with open(path, 'rb') as file:
+            streaming = os.path.getsize(path) > STREAMING_THRESHOLD or is_csv_archive(file)
+            return parse_file(file, batch=True, all_or_nothing=job.all_or_nothing, dry_run=job.dry_run,
+                              incremental=incremental, streaming=streaming, on_progress=on_progress,
+                              from_scratch=job.wipe_beforehand)
+
+    try:
+        with ExitStack() as stack:
+            timings = stack.enter_context(timing_stages()) if job.time_stages else None
+            sheet_feedbacks, _ = import_content()
+        if timings is not None:
+            job.stage_timings = json.dumps(timings.as_dict())
+        save_feedbacks(job, sheet_feedbacks)
+        job.status = ImportJob.DONE
+    except Exception:
+        logger.exception(f'Import {job_id} crashed')
+        job.error = traceback.format_exc()
+        job.status = ImportJob.CRASHED
+    finally:
+        with _live_progress_lock:
+            job.progress = json.dumps(_live_progress.pop(job_id, {}))
+        job.finished = timezone.now()
+        job.save()
+        if os.path.exists(path):
+            os.remove(path)
+        connection.close()  # each worker thread gets its own connection, don't leak it
@@ -0,0 +1,266 @@
+from typing import Optional, Dict, Any, Iterable, Iterator, Set, Tuple
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import count
+import threading
+
+from django.db import transaction
+from django.db.models import Model, Max, Case, When, Value
+from django.db.models.fields.reverse_related import ForeignObjectRel
+
+from .utils import chunks, QUERY_CHUNK
+
+
+"""
+In-memory maps of every entity of a model, keyed by its natural (or any identifying) fields.
+Used by the batch importer to replace a query (and maybe an insert) per cell with
+one query per model for the whole import and one `bulk_create` per batch of new entities.
+A dry run (a preview) writes nothing: it resolves the keys the same way, but the new entities only get provisional pks
+"""
+
+_local = threading.local()  # the key maps of the import running on this thread (if any)
+
+
+def key_value(value: Any) -> Any:
+    """
+    Hashable form of a field value, as used in keys: entities are replaced by their pk
+    and collections of entities (relational fields) by the set of their pks
+
+    Examples:
+        >>> key_value('A')
+        'A'
+        >>> key_value([1, 2, 2])
+        frozenset({1, 2})
+    """
+    if isinstance(value, Model):
+        return value.pk
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(map(key_value, value))
+    return value
+
+
+def through_columns(field) -> Tuple[Any, str, str]:
+    """
+    For a many-to-many field (forward or reverse) returns
+    (through model, column pointing to the field's model, column pointing to the related model)
+    """
+    if isinstance(field, ForeignObjectRel):  # reverse side, eg: Deed.owners
+        forward = field.field
+        return forward.remote_field.through, forward.m2m_reverse_field_name() + '_id', forward.m2m_field_name() + '_id'
+    return field.remote_field.through, field.m2m_field_name() + '_id', field.m2m_reverse_field_name() + '_id'
+
+
+def load_relations(model, field_name: str) -> Dict[int, Set[int]]:
+    """ pks of the related entities, for every entity of `model` that has any, in a single query """
+    field = model._meta.get_field(field_name)
+    if field.many_to_many:
+        through, source, target = through_columns(field)
+        pairs = through.objects.values_list(source, target)
+    else:  # reverse foreign key, eg: Deed.receipts
+        child_column = field.field.attname
+        pairs = field.related_model.objects.filter(**{child_column + '__isnull': False})\
+            .values_list(child_column, 'pk')
+
+    relations = defaultdict(set)
+    for source_pk, target_pk in pairs:
+        relations[source_pk].add(target_pk)
+    return relations
+
+
+def update_column(model, column: str, values_by_pk: Dict[int, Any]):
+    """ sets a (different) value of `column` on each of the entities, with a query per chunk of them """
+    for some_pks in chunks(list(values_by_pk), QUERY_CHUNK // 2):  # 3 parameters each: a `When` and `pk__in`
+        whens = [When(pk=pk, then=Value(values_by_pk[pk])) for pk in some_pks]
+        model.objects.filter(pk__in=some_pks)\
+            .update(**{column: Case(*whens, output_field=model._meta.get_field(column))})
+
+
+class KeyMap:
+    """
+    Every entity of `model` indexed by the values of `fields`, loaded with one query.
+    Entities that are not in the database yet are created in memory (pending) and inserted all at once on `flush`
+
+    Args:
+        provisional_pks: in a dry run, where the pending entities get their pks from instead of being inserted
+        load (bool): start from the entities in the database (otherwise from none, as if it was wiped)
+        inserted (set): gets the pks of the entities inserted in bulk (without signals)
+    """
+    def __init__(self, model, fields: Iterable[str], provisional_pks: Iterator[int] = None, load: bool = True,
+                 inserted: Set[int] = None):
+        self.model = model
+        self.fields = tuple(fields)
+        self.provisional_pks = provisional_pks
+        self.inserted = inserted if inserted is not None else set()
+        self.entities = {}  # key ~> entity
+        self.pending = []   # entities to be inserted on the next flush
+        self.relations = {field.name: load_relations(model, field.name) if load else {}
+                          for field in self.model_fields if field.many_to_many}
+
+        for entity in model.objects.all() if load else []:
+            self.entities.setdefault(self.key_of(entity), entity)  # on (unexpected) clashes, the oldest one wins
+
+    @property
+    def model_fields(self):
+        return [self.model._meta.get_field(f) for f in self.fields]
+
+    def key(self, values: Dict[str, Any]) -> tuple:
+        """ key for the given {field: value} (values can be entities, or lists of entities) """
+        key = []
+        for field in self.model_fields:
+            value = key_value(values[field.name])
+            if not field.is_relation:
+                value = field.to_python(value)  # eg: datetime ~> date, so it matches what comes back from the db
+            key.append(value)
+        return tuple(key)
+
+    def key_of(self, entity) -> tuple:
+        """ key of an entity already in the database """
+        return tuple(frozenset(self.relations[field.name].get(entity.pk, ())) if field.many_to_many
+                     else getattr(entity, field.attname)
+                     for field in self.model_fields)
+
+    def get(self, values: Dict[str, Any]) -> Optional[Model]:
+        return self.entities.get(self.key(values))
+
+    def add(self, entity, values: Dict[str, Any]):
+        """ register a new (pending) `entity` under the key for `values` """
+        self.entities[self.key(values)] = entity
+        self.pending.append(entity)
+
+    def getsert(self, values: Dict[str, Any], defaults: Dict[str, Any] = None) -> Model:
+        """ in-memory equivalent of `get_or_create`, with the insert postponed until `flush` """
+        entity = self.get(values)
+        if entity is not None:
+            return entity
+
+        entity = self.model(**values, **(defaults or {}))
+        # the cleaning .save() would have done, minus the queries: uniqueness is guaranteed by the map itself
+        # and foreign keys point to entities that were just retrieved
+        foreign_keys = [f.name for f in self.model._meta.concrete_fields if f.is_relation]
+        entity.full_clean(exclude=foreign_keys, validate_unique=False)
+
+        cleaned_values = {f: getattr(entity, f) for f in self.fields}
+        existing = self.get(cleaned_values)  # cleaning can change the key (eg: A-1BIS-2 ~> A-1bis-2)
+        if existing is not None:
+            return existing
+
+        self.add(entity, cleaned_values)
+        return entity
+
+    def forget(self, entity):
+        self.entities = {k: e for k, e in self.entities.items() if e is not entity}
+
+    def flush(self) -> Dict[int, Exception]:
+        """
+        Inserts the pending entities with one `bulk_create`. If that fails, they are saved one by one
+        to find out which ones are at fault.
+
+        Returns:
+            errors (dict<int: Exception>): by the `id` of each entity that could not be saved
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return {}
+        if self.provisional_pks is not None:  # dry run: nothing is inserted, they stay `_state.adding`
+            for entity in pending:
+                entity.pk = next(self.provisional_pks)
+            return {}
+
+        try:
+            with transaction.atomic():
+                manager = self.model.objects
+                last_pk = manager.aggregate(Max('pk'))['pk__max'] or 0
+                manager.bulk_create(pending)
+                # sqlite doesn't return the ids of bulk inserts, but they are consecutive inside the transaction
+                pks = list(manager.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+                if len(pks) != len(pending):
+                    raise ValueError(f'Inserted {len(pending)} {self.model.__name__} entities, found {len(pks)}')
+        except Exception:
+            return self._save_one_by_one(pending)
+
+        for entity, pk in zip(pending, pks):
+            entity.pk = pk
+            entity._state.adding = False
+            entity._state.db = manager.db
+        self.inserted.update(pks)
+        return {}
+
+    def _save_one_by_one(self, entities) -> Dict[int, Exception]:
+        errors = {}
+        for entity in entities:
+            try:
+                with transaction.atomic():
+                    entity.save()
+            except Exception as error:
+                errors[id(entity)] = error
+                self.forget(entity)
+        return errors
+
+
+class KeyMaps:
+    """
+    Key maps for one whole import, each loaded on first use
+
+    Args:
+        dry_run (bool): nothing is written, new entities get negative pks (never in the database) when flushed,
+            and whoever writes on flush (eg: `model_parsers.set_relations`) checks it
+        from_scratch (bool): nothing is loaded either, as if the database was wiped beforehand
+
+    `written` holds, by model, the pks of the entities inserted or related without signals: by the maps,
+    and by whoever writes relations on flush, for what's derived from them to be updated afterwards
+    (eg: `spot_summaries.mark_written`)
+    """
+    def __init__(self, dry_run: bool = False, from_scratch: bool = False):
+        self.dry_run = dry_run
+        self.from_scratch = from_scratch
+        self.provisional_pks = count(-1, -1) if dry_run else None
+        self.maps = OrderedDict()
+        self.relations = {}
+        self.written = defaultdict(set)  # model ~> pks
+
+    def get(self, model, fields: Iterable[str] = None) -> KeyMap:
+        """ the map of `model` by `fields` (the natural key, if not given) """
+        if fields is None:
+            fields = model.objects.natural_key_fields
+        index = model, tuple(sorted(fields))
+        if index not in self.maps:
+            self.maps[index] = KeyMap(model, index[1], self.provisional_pks, load=not self.from_scratch,
+                                      inserted=self.written[model])
+        return self.maps[index]
+
+    __getitem__ = get
+
+    def related_pks(self, model, field_name: str) -> Dict[int, Set[int]]:
+        """ `load_relations`, loaded once per import """
+        index = model, field_name
+        if index not in self.relations:
+            self.relations[index] = load_relations(model, field_name) if not self.from_scratch else {}
+        return self.relations[index]
+
+    def flush(self) -> Dict[int, Exception]:
+        """ flushes every map (in the order they were first used), see `KeyMap.flush` """
+        errors = {}
+        for key_map in self.maps.values():
+            errors.update(key_map.flush())
+        return errors
+
+
+def active_key_maps() -> Optional[KeyMaps]:
+    """ the key maps the current import runs with, None when not importing in batch mode """
+    return getattr(_local, 'key_maps', None)
+
+
+@contextmanager
+def using_key_maps(key_maps: Optional[KeyMaps]):
+    """ makes `key_maps` the active ones for the duration of the block (None ~> no batch mode) """
+    previous = active_key_maps()
+    _local.key_maps = key_maps
+    try:
+        yield key_maps
+    finally:
+        _local.key_maps = previous
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
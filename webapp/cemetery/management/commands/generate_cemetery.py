@@ -0,0 +1,69 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cemetery.models import Spot, ImportedRow, SpotSummary, ALL_MODELS
+from cemetery.synthetic_data import SyntheticCemetery, WorkbookWriter, save_block
+from cemetery.spot_summaries import rebuild_summaries
+from cemetery.search_index import rebuild_search_index
+from cemetery.wiping import wipe
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with a synthetic (seeded) cemetery of the given size, ' \
+           'and/or writes it as an import document'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spots', type=int, default=1000,
+                            help='how many spots, everything else is generated around them (default 1000)')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='the same seed and number of spots always give the same cemetery')
+        parser.add_argument('--workbook', metavar='PATH',
+                            help='also write it as an import document: an excel workbook (.xlsx) '
+                                 'or a zip archive of csv sheets (.zip, for more rows than excel allows)')
+        parser.add_argument('--no-db', action='store_true',
+                            help="don't save anything to the database, only write the workbook")
+        parser.add_argument('--wipe', action='store_true', dest='wipe_first',
+                            help='delete everything in the database first')
+
+    def handle(self, *args, spots, seed, workbook, no_db, wipe_first, **options):
+        if no_db and not workbook:
+            raise CommandError('Nothing to do: --no-db without a --workbook')
+        if workbook and not workbook.endswith(('.xlsx', '.zip')):
+            raise CommandError(f'Unknown workbook format: {workbook} (expected .xlsx or .zip)')
+
+        if not no_db:
+            if wipe_first:
+                seconds = wipe(ALL_MODELS + [ImportedRow, SpotSummary], vacuum=True)
+                self.stdout.write(f'Wiped the database in {seconds:.1f}s')
+            elif any(model.objects.exists() for model in ALL_MODELS):
+                raise CommandError('The database is not empty: the generated pks would clash, use --wipe')
+
+        start = perf_counter()
+        writer = WorkbookWriter(workbook) if workbook else None
+        counts = {}
+        for block in SyntheticCemetery(spots, seed).blocks():
+            if not no_db:
+                save_block(block)
+            if writer:
+                writer.append(block.rows)
+            for model, entities in block.entities.items():
+                counts[model] = counts.get(model, 0) + len(entities)
+            self.stdout.write(f'{counts.get(Spot, 0)} / {spots} spots', ending='\r')
+        if writer:
+            writer.close()
+
+        self.stdout.write(f'Generated in {perf_counter() - start:.1f}s' + ' ' * 20)
+        for model, count in counts.items():
+            self.stdout.write(f'{count:>10} {model._meta.verbose_name_plural}')
+
+        if not no_db:  # the rows were inserted without signals
+            start = perf_counter()
+            rebuild_summaries()
+            self.stdout.write(f'Summarized the spots in {perf_counter() - start:.1f}s')
+            start = perf_counter()
+            rebuild_search_index()
+            self.stdout.write(f'Indexed them for search in {perf_counter() - start:.1f}s')
+        if writer:
+            self.stdout.write(self.style.SUCCESS(f'Wrote {workbook}'))
+
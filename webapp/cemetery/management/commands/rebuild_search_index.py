@@ -0,0 +1,17 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cemetery.search_index import create_search_tables, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Writes the search document of every spot, deed, owner and operation again, from scratch ' \
+           '(they are otherwise kept up to date on save, but not by raw SQL or bulk changes)'
+
+    def handle(self, *args, **options):
+        if not create_search_tables():
+            raise CommandError('The database can not have the search tables (it needs sqlite, with FTS5)')
+        start = perf_counter()
+        n_documents = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {n_documents} entities in {perf_counter() - start:.1f}s'))
@@ -0,0 +1,15 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from cemetery.spot_summaries import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Computes the summary of every spot again, from scratch ' \
+           '(they are otherwise kept up to date on save, but not by raw SQL or bulk changes)'
+
+    def handle(self, *args, **options):
+        start = perf_counter()
+        n_spots = rebuild_summaries()
+        self.stdout.write(self.style.SUCCESS(f'Summarized {n_spots} spots in {perf_counter() - start:.1f}s'))
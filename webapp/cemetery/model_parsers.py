@@ -1,22 +1,35 @@
-from typing import Optional, Tuple, Dict, Callable, Any, List
+from typing import Optional, Tuple, Dict, Callable, Any, List, Set, Union
 
-from copy import deepcopy
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, Counter, defaultdict
 from itertools import zip_longest
+from contextlib import ExitStack
 from functools import partial
 import logging
+import hashlib
+import json
 
 import numpy as np
 import pandas as pd
 
+from django.db import transaction
+from django.db.models import Model, prefetch_related_objects
 from django.forms.models import model_to_dict
 from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext_lazy as _
 
 from .models import Spot, Operation, Deed, OwnershipReceipt, Owner, Construction, Authorization, Company, PaymentUnit, \
-    PaymentReceipt, Maintenance
-from .utils import reverse_dict, filter_dict, show_dict, map_dict, identity
+    PaymentReceipt, Maintenance, ImportedRow, ImportFeedback
+from .key_maps import KeyMaps, active_key_maps, using_key_maps, through_columns, update_column
+from .sheet_streams import SheetStream, stream_workbook, records
+from .batch_validation import active_validation, validating_in_batches
+from .import_timings import timing_sheet, timed_stage, timed_field
+from .spot_summaries import updating_summaries_afterwards, mark_written as mark_summaries_written
+from .search_index import updating_search_afterwards, mark_written as mark_search_written
+from .utils import reverse_dict, filter_dict, show_dict, map_dict, identity, class_name, chunks, relation_signature, \
+    QUERY_CHUNK
 from .display_helpers import entity_tag, title_case
-from .parsing_helpers import year_shorthand_to_full, parse_nr_year, keep_only, parse_date
+from .parsing_helpers import year_shorthand_to_full, parse_nr_year, keep_only, parse_date, \
+    parse_nr_year_column, keep_only_column, title_case_column
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -35,6 +48,10 @@ def natural_getsert(model) -> Callable:  # takes a django model
         # prepare the natural key into a dict that can be passed to __init__
         natural_key = model.objects.prepare_natural_key(identifier)
 
+        key_maps = active_key_maps()
+        if key_maps is not None:  # batch mode: the entity is only inserted when the key maps are flushed
+            return key_maps[model].getsert(natural_key)
+
         try:
             # retrieve by natural key
             entity = model.objects.get_by_natural_key(**natural_key)
@@ -49,21 +66,32 @@ def natural_getsert(model) -> Callable:  # takes a django model
 
 def relational_get(model, fields: Dict[str, Any], relational_keys: [str]):
     """ find the entity that has the given `fields` (even for relational fields) """
+    signature_columns = {k: k + '_signature' for k in fields if k in relational_keys}
+    column_names = {f.name for f in model._meta.concrete_fields}
+    if all(column in column_names for column in signature_columns.values()):
+        # exact matches only, with one indexed lookup (see `Construction.spots_signature`)
+        query_fields = {signature_columns.get(k, k): relation_signature(e.pk for e in v) if k in signature_columns else v
+                        for k, v in fields.items()}
+        entities = model.objects.filter(**query_fields)[:2]
+        unsigned = not entities and any(model.objects.filter(**{column: '', k + '__isnull': False}).exists()
+                                        for k, column in signature_columns.items())
+        if not unsigned:  # otherwise the match may not be signed yet (see `models.backfill_spots_signatures`)
+            return entities[0] if len(entities) == 1 else None
+
     try:
         query_fields = {(k + '__in' if k in relational_keys else k): v for k, v in fields.items()}
-        entities = model.objects.filter(**query_fields)
+        entities = model.objects.filter(**query_fields).distinct()  # one row per matching related entity otherwise
     except Exception as e:
         raise ValueError(f'Filter by {{{show_dict(fields)}}}: {e}')
 
-    if len(entities) != 1:  # don't use get as it throws an error on multiple matches, but it is in fact not an error
-        return None
+    # __in also matches the entities with only some of them, or with others as well
+    related_pks = {k: {e.pk for e in v} for k, v in fields.items() if k in relational_keys}
+    entities = [entity for entity in entities
+                if all(set(getattr(entity, k).values_list('pk', flat=True)) == pks for k, pks in related_pks.items())]
 
-    entity = entities[0]
-    lengths_equal = all(getattr(entity, f).count() == len(fields[f]) for f in fields)  # __in can return partials
-    if not lengths_equal:
+    if len(entities) != 1:  # don't use get as it throws an error on multiple matches, but it is in fact not an error
         return None
-
-    return entity
+    return entities[0]
 
 
 def relational_get_or_create(model, fields: Dict[str, Any], relational_keys: [str], defaults=Dict[str, Any]):
@@ -101,7 +129,18 @@ def translate(dictionary: Dict[str, str], default=None):
     return handler
 
 
+def get_or_create(model, defaults: Dict[str, Any] = None, **fields):
+    """ `model.objects.get_or_create`, served from the key maps in batch mode """
+    key_maps = active_key_maps()
+    if key_maps is not None:
+        return key_maps.get(model, fields=fields.keys()).getsert(fields, defaults)
+    return model.objects.get_or_create(**fields, defaults=defaults)[0]  # returns entity, created_now
+
+
 def get_or_create_and_save(model, **kwargs):
+    if active_key_maps() is not None:
+        return get_or_create(model, **kwargs)
+
     entity, created_now = model.objects.get_or_create(**kwargs)
     if created_now:
         entity.save()
@@ -121,8 +160,7 @@ def prepare_deed_fields(parsed_fields: Dict[str, Any]) -> Dict[str, Any]:
         values      = parsed_fields['values']
         if len(values) > len(receipt_ids):  # make sure there no more than one value per receipt id
             raise ValueError(f'More values ({len(values)} than receipts ({len(receipt_ids)})')
-        receipts = [OwnershipReceipt.objects.get_or_create(
-                        number=nr, year=yr, defaults={'value': val})[0]  # returns entity, created_now
+        receipts = [get_or_create(OwnershipReceipt, number=nr, year=yr, defaults={'value': val})
                     for (nr, yr), val in zip_longest(receipt_ids, values)]  # missing values will be None
 
         return {
@@ -173,20 +211,25 @@ Composing parsing bits
 """
 
 ModelMetadata = namedtuple('ModelMetadata',
-                           'model sheet_name column_renames field_parsers prepare_fields '
-                           'identifying_fields relational_fields')
+                           'model sheet_name column_renames field_parsers column_parsers prepare_fields '
+                           'identifying_fields relational_fields identifier_columns')
 """
     model (django.db.models.Model): class of the resulting object
     sheet_name (str): excel sheet name
     column_renames (dict<str: str>): code_field_name: excel_column_name
     field_parsers (dict<str: str -> Any>): type of the field - an entry for a field takes the cell content and 
         produces a value (eg: title-cased name, spot object from its textual representation)
+    column_parsers (dict<str: pd.Series -> (pd.Series, pd.Series)>): vectorized fast path for some field_parsers -
+        parses the whole column at once, returning the values and a mask of the cells it handled
+        (the others still go through their field parser, see `parse_columns`)
     identifying_fields ([str]): fields that should be present in `get_or_create` args, others instead in defaults kwarg
         eg: name Owner (but not address or phone)
     prepare_fields (dict<str: Any> -> dict<str: Any>): change the fields values/keys to fit the model's __init__ -
         takes dict of {input_field: parsed_value} and transforms it into {model_field: value} (eg: combine values and
         receipt_identifiers into receipts or split deed_identifier into number and year)
     relational_fields ([str]): fields that need to be assigned after a the object received its pk (eg: owners for deed)
+    identifier_columns ([str]): columns that tell which row is which between two versions of the document
+        (see `incremental` in `parse_sheet`)
 """
 
 operation_type_translations = {
@@ -225,9 +268,13 @@ MODELS_METADATA = [
           'exhumation_written_report': identity,
           'remains_brought_from':      identity
         },
+        column_parsers={
+          'deceased': title_case_column,
+        },
         prepare_fields=identity,
         identifying_fields={'type', 'deceased', 'spot', 'date'},
         relational_fields=set(),
+        identifier_columns=['type', 'deceased', 'spot', 'date'],
     ),
 
     ModelMetadata(
@@ -249,9 +296,13 @@ MODELS_METADATA = [
             'owners':        multiple(natural_getsert(Owner)),
             'cancel_reason': translate(deed_cancel_reason_translations),
         },
+        column_parsers={
+            'deed_id':       parse_nr_year_column,
+        },
         prepare_fields=prepare_deed_fields,
         identifying_fields={'number', 'year'},
         relational_fields={'spots', 'owners', 'receipts'},
+        identifier_columns=['deed_id'],
     ),
 
     ModelMetadata(
@@ -269,9 +320,14 @@ MODELS_METADATA = [
             'city':     identity,
             'phone':    partial(keep_only, condition=str.isdigit),
         },
+        column_parsers={
+            'name':     title_case_column,
+            'phone':    partial(keep_only_column, pattern=r'\d'),
+        },
         prepare_fields=identity,
         identifying_fields={'name'},
         relational_fields=set(),
+        identifier_columns=['name'],
     ),
 
     ModelMetadata(
@@ -291,9 +347,11 @@ MODELS_METADATA = [
             'owner_builder':  natural_getsert(Owner),
             'company':        natural_getsert(Company),
         },
+        column_parsers={},
         prepare_fields=identity,
         identifying_fields={'type', 'spots'},
         relational_fields={'spots', 'authorizations', 'company', 'owner_builder'},
+        identifier_columns=['type', 'spots'],
     ),
 
     ModelMetadata(
@@ -311,43 +369,150 @@ MODELS_METADATA = [
             'years':      multiple(year_shorthand_to_full, at_least_one=True),
             'values':     multiple(float, at_least_one=True),
         },
+        column_parsers={
+            'receipt_id': parse_nr_year_column,
+        },
         prepare_fields=prepare_payment_receipt_fields,
         identifying_fields={'number', 'year'},
         relational_fields={'units'},
+        identifier_columns=['receipt_id'],
     )
 
 ]
 
+PROGRESS_EVERY = 100  # rows, how often to report progress while parsing a sheet
+
+STATUSES = ['fail', 'duplicate', 'add', 'unchanged']
+
 RowFeedback = namedtuple('RowFeedback', 'status info additional')
 """
-    status (str):       fail            | add / duplicate
-    info (str):         failure cause   | entity link
-    additional (str):   exception       | fields as dict
+    status (str):           fail            | add / duplicate       | unchanged
+    info (str / EntityRef): failure cause   | the entity, see below | identifier cells
+    additional (str):       exception       | -                     | -
+
+    The link and fields of an added or duplicate entity are only rendered when shown (see `show_feedbacks`),
+    building them for every row of a big import would take longer than the import itself.
+    Until then, it's only referenced: the feedbacks of a big import shouldn't keep every entity in memory.
+    A dry run's entities are rendered right away instead, its changes are never saved to be loaded again
+    (and its new entities are described by the row's fields)
 """
 
+EntityRef = namedtuple('EntityRef', 'model pk')
+
+
 def entity2dict_str(entity) -> str:
     d = model_to_dict(entity)
     return '{' + show_dict(d) + '}'
 
-def parse_row(row, metadata) -> Tuple[str, str, str]:
-    model = metadata.model
-    model_name = model.__name__
-
-    # 1. parse fields
+def show_feedback(feedback: RowFeedback) -> RowFeedback:
+    """ link and fields (as text) for the entity of an 'add' / 'duplicate' feedback """
+    if not isinstance(feedback.info, Model):
+        return feedback
+    return RowFeedback(feedback.status, entity_tag(feedback.info), entity2dict_str(feedback.info))
+
+def referenced(feedback: RowFeedback) -> RowFeedback:
+    """ the feedback with its entity replaced by an EntityRef """
+    if not isinstance(feedback.info, Model):
+        return feedback
+    return RowFeedback(feedback.status, EntityRef(type(feedback.info), feedback.info.pk), feedback.additional)
+
+def show_feedbacks(feedbacks: List[RowFeedback]) -> List[RowFeedback]:
+    """ `show_feedback` for feedbacks with referenced entities, loading them with a few queries """
+    pks = defaultdict(set)
+    for feedback in feedbacks:
+        if isinstance(feedback.info, EntityRef):
+            pks[feedback.info.model].add(feedback.info.pk)
+    entities = {}
+    for model, model_pks in pks.items():
+        for some_pks in chunks(list(model_pks), QUERY_CHUNK):
+            entities.update((EntityRef(model, pk), entity) for pk, entity in model.objects.in_bulk(some_pks).items())
+
+    return [show_feedback(RowFeedback(f.status, entities[f.info], f.additional)) if isinstance(f.info, EntityRef)
+            else f for f in feedbacks]
+
+def show_feedback_entities(feedbacks: List[ImportFeedback]):
+    """ `show_feedback` for (a page of) stored feedbacks, loading their entities with a few queries """
+    by_model = defaultdict(list)
+    for feedback in feedbacks:
+        if feedback.entity is not None:
+            by_model[type(feedback.entity)].append(feedback.entity)
+    for model, entities in by_model.items():  # the related entities shown by `entity_tag` and `entity2dict_str`
+        related = [f.name for f in model._meta.get_fields() if f.many_to_one or f.many_to_many and f.concrete]
+        prefetch_related_objects(entities, *related)
+
+    for feedback in feedbacks:
+        if feedback.entity is not None:
+            feedback.info, feedback.additional = entity_tag(feedback.entity), entity2dict_str(feedback.entity)
+        elif feedback.entity_id is not None:
+            feedback.info = _('deleted since the import')
+
+
+class RowFailure(Exception):
+    """ stops parsing a row; `info` and `error` make up the 'fail' feedback """
+    def __init__(self, info: str, error: Exception):
+        super(RowFailure, self).__init__(info)
+        self.info = info
+        self.error = error
+
+    @property
+    def feedback(self) -> Tuple[str, Any, str]:
+        return 'fail', self.info, repr(self.error)  # repr instead of str to get the exception type as well
+
+
+NOT_PARSED = object()  # marks the cells the column parsers left to the field parsers
+
+def parse_columns(sheet: pd.DataFrame, metadata) -> List[Dict[str, Any]]:
+    """
+    Runs the column parsers over the whole sheet
+
+    Returns:
+        for each row, {field: parsed value} for the fields with a column parser (NOT_PARSED for the cells they
+        didn't handle, which go through the field parser instead, to get either their value or their exact error)
+    """
+    parsed_columns = pd.DataFrame(index=sheet.index)
+    for field, column_parser in metadata.column_parsers.items():
+        with timed_field(field):
+            values, ok = column_parser(sheet[field])
+        parsed_columns[field] = values.where(ok, NOT_PARSED)
+    if parsed_columns.empty:
+        return [{}] * len(sheet)
+    return parsed_columns.to_dict('records')
+
+def parse_fields(row: Dict[str, Any], metadata, preparsed: Dict[str, Any] = None) -> Dict[str, Any]:
+    """ preparsed: for this row, from `parse_columns` """
     parsed_fields = {}
     for field, parser in metadata.field_parsers.items():
+        value = preparsed.get(field, NOT_PARSED) if preparsed else NOT_PARSED
+        if value is not NOT_PARSED:
+            parsed_fields[field] = value
+            continue
         try:
-            parsed_fields[field] = parser(row[field])
+            with timed_field(field):
+                parsed_fields[field] = parser(row[field])
         except Exception as error:
-            info = f'Parse column "{field}": {row[field]}'
-            return 'fail', info, repr(error)  # repr instead of str to get the exception type as well
+            raise RowFailure(f'Parse column "{field}": {row[field]}', error)
+    return parsed_fields
 
-    # 2. prepare the parsed fields
+def prepare_parsed_fields(parsed_fields: Dict[str, Any], metadata) -> Dict[str, Any]:
     try:
-        prepared_fields = metadata.prepare_fields(parsed_fields)
+        return metadata.prepare_fields(parsed_fields)
     except Exception as error:
-        info = f'Prepare the parsed fields {{{show_dict(parsed_fields)}}}'
-        return 'fail', info, repr(error)
+        raise RowFailure(f'Prepare the parsed fields {{{show_dict(parsed_fields)}}}', error)
+
+def parse_row(row: Dict[str, Any], metadata, preparsed: Dict[str, Any] = None) -> Tuple[str, Any, str]:
+    model = metadata.model
+    model_name = model.__name__
+
+    # each stage is timed, if the import is (see `import_timings.py`)
+    try:
+        # 1. parse fields
+        with timed_stage('parse fields'):
+            parsed_fields = parse_fields(row, metadata, preparsed)
+        # 2. prepare the parsed fields
+        with timed_stage('prepare fields'):
+            prepared_fields = prepare_parsed_fields(parsed_fields, metadata)
+    except RowFailure as failure:
+        return failure.feedback
 
     # 3. use the prepared fields to build the model
     try:
@@ -356,81 +521,526 @@ def parse_row(row, metadata) -> Tuple[str, str, str]:
         identif_items = filter_dict(prepared_fields, metadata.identifying_fields)
         identif_non_rel_items = filter_dict(identif_items, metadata.relational_fields, inverse=True)
 
-        if not identif_rel:
-            # non identifiable and non relational
-            safe_defaults = filter_dict(prepared_fields,
-                                        metadata.identifying_fields | metadata.relational_fields, inverse=True)
-            entity, created_now  = model.objects.get_or_create(**identif_items, defaults=safe_defaults)
-
-        else:  # model has identifying and relational fields
-            identif_rel_items = filter_dict(prepared_fields, identif_rel)
-            entity = relational_get(model, identif_rel_items, metadata.relational_fields)
-            if not entity:  # there is not an entity that matches exactly the relational fields
-                entity = model(**identif_non_rel_items)
-                entity.save()
-                created_now = True
-            else:
-                created_now = False
+        with timed_stage('get/create'):
+            if not identif_rel:
+                # non identifiable and non relational
+                safe_defaults = filter_dict(prepared_fields,
+                                            metadata.identifying_fields | metadata.relational_fields, inverse=True)
+                entity, created_now  = model.objects.get_or_create(**identif_items, defaults=safe_defaults)
+
+            else:  # model has identifying and relational fields
+                entity = relational_get(model, identif_items, metadata.relational_fields)
+                if not entity:  # there is not an entity that matches exactly the relational fields
+                    entity = model(**identif_non_rel_items)
+                    entity.save()
+                    created_now = True
+                else:
+                    created_now = False
 
     except Exception as error:
         info = f'Get/create {model_name} with init {{{show_dict(identif_items)}}}'
         return 'fail', info, repr(error)
 
     if not created_now:  # entity already existed
-        for field, value in prepared_fields.items():
+        with timed_stage('update duplicate'):
+            for field, value in prepared_fields.items():
+                try:
+                    setattr(entity, field, value)
+                except Exception as error:
+                    info = f'Update on duplicate "{field}": {{value}}'
+                    return 'fail', info, repr(error)
+
             try:
-                setattr(entity, field, value)
+                entity.save()
             except Exception as error:
-                info = f'Update on duplicate "{field}": {{value}}'
+                info = f'Save after updating fields on found-duplicate {entity}'
                 return 'fail', info, repr(error)
-
-        try:
-            entity.save()
-        except Exception as error:
-            info = f'Save after updating fields on found-duplicate {entity}'
-            return 'fail', info, repr(error)
         # TODO: nicely formatted warnings, like: .admin.CustomBaseModelAdmin#save_model
-        return 'duplicate', entity_tag(entity), entity2dict_str(entity)
+        return 'duplicate', entity, ''
 
     # 4. save the entity
     try:
-        entity.save()
+        with timed_stage('save'):
+            entity.save()
     except Exception as error:
         info = f'Save {model_name}: {entity}'
         return 'fail', info, repr(error)
 
     # 5. set relational fields
-    for field in metadata.relational_fields:
-        try:
-            setattr(entity, field, prepared_fields[field])
-        except Exception as error:
-            info = f'Set relational field {field}: {prepared_fields[field]}'
-            return 'fail', info, repr(error)
+    with timed_stage('set relational fields'):
+        for field in metadata.relational_fields:
+            try:
+                setattr(entity, field, prepared_fields[field])
+            except Exception as error:
+                info = f'Set relational field {field}: {prepared_fields[field]}'
+                return 'fail', info, repr(error)
     try:
-        entity.save()
+        with timed_stage('save again'):
+            entity.save()
     except Exception as error:
         info = f'Save after setting relational fields on {entity}'
         return 'fail', info, repr(error)
 
     # finally success
     # TODO: like 'duplicate' but dry
-    return 'add', entity_tag(entity), entity2dict_str(entity)
+    return 'add', entity, ''
+
 
+"""
+Batch parsing
+"""
 
-def parse_sheet(file, metadata) -> [RowFeedback]:
-    sheet = pd.read_excel(file, sheetname=metadata.sheet_name)
+def entities_in(value) -> List[Model]:
+    """ the entities in a parsed field value: an entity, a list of entities or neither """
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [v for v in values if isinstance(v, Model)]
+
+def field_values(entity, field_names) -> Dict[str, Any]:
+    """ comparable values of the given (non to-many) fields, eg: the date of a datetime, the pk of a foreign entity """
+    fields = [entity._meta.get_field(f) for f in field_names]
+    return {f.name: getattr(entity, f.attname) if f.is_relation else f.to_python(getattr(entity, f.attname))
+            for f in fields}
+
+def to_many_fields(metadata) -> [str]:
+    """ relational fields that can't be assigned before the entity is inserted (many-to-many, reverse foreign keys) """
+    fields = [metadata.model._meta.get_field(f) for f in metadata.relational_fields]
+    return [f.name for f in fields if f.many_to_many or f.one_to_many]
+
+def set_relations(model, field_name: str, targets: List[Tuple[Model, List[Model]]], known: Dict[int, Set[int]],
+                  dry_run: bool = False, written: Dict[Any, Set[int]] = None):
+    """
+    Makes each entity in `targets` related to exactly its listed entities (like `setattr` would, row after row)
+    with a handful of queries for all of them. `known` holds the current relations and is kept up to date
+    (it's all that changes in a `dry_run`). No signals are sent: `written` gets the pks of the entities
+    on both sides of each change, by model (see `KeyMaps`)
+    """
+    field = model._meta.get_field(field_name)
+    written = written if written is not None else defaultdict(set)
+
+    if field.many_to_many:
+        through, source, target = through_columns(field)
+        last_targets = OrderedDict((entity, related) for entity, related in targets)  # the last row decides
+        # bulk inserts don't send m2m_changed, so signatures (eg: Construction.spots_signature) are set here
+        signature_column = field_name + '_signature'
+        has_signature = any(f.name == signature_column for f in model._meta.concrete_fields)
+        new_rows, signatures = [], {}
+        for entity, related in last_targets.items():
+            new_pks = {r.pk for r in related}
+            old_pks = known.get(entity.pk, set())
+            if new_pks == old_pks:
+                continue
+            known[entity.pk] = new_pks
+            new_rows += [through(**{source: entity.pk, target: pk}) for pk in new_pks - old_pks]
+            if old_pks - new_pks and not dry_run:
+                through.objects.filter(**{source: entity.pk, target + '__in': old_pks - new_pks}).delete()
+            written[model].add(entity.pk)
+            written[field.related_model].update(new_pks ^ old_pks)
+            if has_signature:
+                signatures[entity.pk] = relation_signature(new_pks)
+                setattr(entity, signature_column, signatures[entity.pk])
+        if dry_run:
+            return
+        if new_rows:
+            through.objects.bulk_create(new_rows)
+        if signatures:
+            update_column(model, signature_column, signatures)
+        return
+
+    # reverse foreign key: a child can be taken by a later row from the entity of an earlier one,
+    # so the rows are replayed in order (in memory) and only where each child ends up is saved
+    child_column = field.field.attname
+    initial_parents, final_parents = {}, {}  # child pk ~> parent pk
+    given = {}  # entity pk ~> the children its previous row gave it
+    for entity, related in targets:
+        new_pks = {r.pk for r in related if r.pk is not None}
+        for child in given.get(entity.pk, []):
+            if all(child is not r for r in related) and getattr(child, child_column) == entity.pk:
+                setattr(child, child_column, None)  # pending children are then inserted without it
+        given[entity.pk] = related
+        for released in known.get(entity.pk, set()) - new_pks:
+            initial_parents.setdefault(released, entity.pk)
+            final_parents[released] = None
+        for child in related:
+            previous = getattr(child, child_column)
+            if previous is not None and previous != entity.pk:  # taken from another entity
+                known.get(previous, set()).discard(child.pk)
+            setattr(child, child_column, entity.pk)  # pending children get it on insert
+            if child.pk is not None:
+                initial_parents.setdefault(child.pk, previous)
+                final_parents[child.pk] = entity.pk
+        known[entity.pk] = new_pks
+    if dry_run:
+        return
+
+    children_by_parent = defaultdict(list)
+    for child_pk, parent_pk in final_parents.items():
+        if parent_pk != initial_parents[child_pk]:
+            children_by_parent[parent_pk].append(child_pk)
+            written[model].update({parent_pk, initial_parents[child_pk]} - {None})
+            written[field.related_model].add(child_pk)
+    for parent_pk, child_pks in children_by_parent.items():
+        field.related_model.objects.filter(pk__in=child_pks).update(**{child_column: parent_pk})
+
+def parse_rows_batch(rows, metadata, preparsed_rows: List[Dict[str, Any]],
+                     report: Callable[[int], None] = None) -> [RowFeedback]:
+    """
+    Same feedback as `parse_row` on each row, but with the queries shared between rows:
+    existing entities are looked up in the active key maps and new ones are inserted with `bulk_create`.
+    `preparsed_rows` come from `parse_columns`. `report` is called with the number of rows parsed so far
+    """
+    key_maps = active_key_maps()
+    validation = active_validation()
+    model = metadata.model
+    model_name = model.__name__
+    feedbacks = [None] * len(rows)
+
+    def fail_unsaved(fields_by_row: Dict[int, Dict[str, Any]], errors: Dict[int, Exception]):
+        """ fails (and drops) the rows referencing entities that could not be inserted """
+        for i, fields in list(fields_by_row.items()):
+            for field, value in fields.items():
+                unsaved = [e for e in entities_in(value) if id(e) in errors]
+                if unsaved:
+                    info = f'Save {class_name(unsaved[0])} for "{field}": {unsaved[0]}'
+                    feedbacks[i] = RowFeedback('fail', info, repr(errors[id(unsaved[0])]))
+                    del fields_by_row[i]
+                    break
+
+    # 1. parse fields, missing spots, owners, companies and authorizations are only created in memory...
+    with timed_stage('parse fields'):
+        parsed_rows = {}
+        for i, (row, preparsed) in enumerate(zip(rows, preparsed_rows)):
+            try:
+                parsed_rows[i] = parse_fields(row, metadata, preparsed)
+            except RowFailure as failure:
+                feedbacks[i] = RowFeedback(*failure.feedback)
+            if report and (i + 1) % PROGRESS_EVERY == 0:
+                report(i + 1)
+    # ...and inserted all at once
+    with timed_stage('insert referenced entities'):
+        fail_unsaved(parsed_rows, key_maps.flush())
+
+    # 2. prepare the parsed fields (receipts and payment units are created in memory as well)
+    with timed_stage('prepare fields'):
+        prepared_rows = {}
+        for i, parsed_fields in parsed_rows.items():
+            try:
+                prepared_rows[i] = prepare_parsed_fields(parsed_fields, metadata)
+            except RowFailure as failure:
+                feedbacks[i] = RowFeedback(*failure.feedback)
+
+    # 3. validate the entities the rows would add, all at once...
+    with timed_stage('validate'):
+        row_identity = key_maps.get(model, metadata.identifying_fields)
+        to_many = to_many_fields(metadata)
+        foreign_keys = [f.name for f in model._meta.concrete_fields if f.is_relation]
+        candidates = {}
+        for i, prepared_fields in list(prepared_rows.items()):
+            identif_items = filter_dict(prepared_fields, metadata.identifying_fields)
+            try:
+                if row_identity.get(identif_items) is None:
+                    candidates[i] = model(**filter_dict(prepared_fields, to_many, inverse=True))
+            except Exception as error:
+                info = f'Get/create {model_name} with init {{{show_dict(identif_items)}}}'
+                feedbacks[i] = RowFeedback('fail', info, repr(error))
+                del prepared_rows[i]
+        # uniqueness is guaranteed by the identity map itself, foreign keys point to entities that were just retrieved
+        invalid = validation.validate(list(candidates.values()), exclude=foreign_keys, unique=False)
+        invalid = {row: invalid[j] for j, row in enumerate(candidates) if j in invalid}
+
+    # ...then find the duplicates and add the others in memory
+    with timed_stage('get/create'):
+        entities, statuses = {}, {}
+        for i, prepared_fields in list(prepared_rows.items()):
+            identif_items = filter_dict(prepared_fields, metadata.identifying_fields)
+            assignable = filter_dict(prepared_fields, to_many, inverse=True)
+            try:
+                entity = row_identity.get(identif_items)
+                if entity is None:
+                    if i in invalid:
+                        raise invalid[i]
+                    entity = candidates[i]
+                    row_identity.add(entity, identif_items)
+                    statuses[i] = 'add'
+                else:
+                    statuses[i] = 'duplicate'
+            except Exception as error:
+                info = f'Get/create {model_name} with init {{{show_dict(identif_items)}}}'
+                feedbacks[i] = RowFeedback('fail', info, repr(error))
+                del prepared_rows[i]
+                continue
+
+            if statuses[i] == 'duplicate':
+                before = field_values(entity, assignable.keys())
+                for field, value in assignable.items():
+                    setattr(entity, field, value)
+                if entity.pk is not None and field_values(entity, assignable.keys()) != before:
+                    try:
+                        if key_maps.dry_run:  # only what saving would check (see `models.validate_model`)
+                            errors = validation.validate([entity], exclude=foreign_keys,
+                                                         unique=not key_maps.from_scratch)
+                            if errors:
+                                raise errors[0]
+                        else:
+                            with transaction.atomic():
+                                entity.save()
+                    except Exception as error:
+                        info = f'Save after updating fields on found-duplicate {entity}'
+                        feedbacks[i] = RowFeedback('fail', info, repr(error))
+                        del prepared_rows[i]
+                        continue
+            entities[i] = entity
+
+    # 4. insert the new entities
+    with timed_stage('save'):
+        errors = row_identity.flush()
+        for i in [i for i in prepared_rows if id(entities[i]) in errors]:
+            feedbacks[i] = RowFeedback('fail', f'Save {model_name}: {entities[i]}', repr(errors[id(entities[i])]))
+            del prepared_rows[i]
+
+    # 5. set relational fields, the last row mentioning an entity decides
+    with timed_stage('set relational fields'):
+        for field in to_many:
+            targets = [(entities[i], prepared_fields[field]) for i, prepared_fields in prepared_rows.items()]
+            try:
+                with transaction.atomic() if not key_maps.dry_run else ExitStack():
+                    set_relations(model, field, targets, key_maps.related_pks(model, field), key_maps.dry_run,
+                                  key_maps.written)
+            except Exception as error:
+                for i in prepared_rows:
+                    info = f'Set relational field {field}: {prepared_rows[i][field]}'
+                    feedbacks[i] = RowFeedback('fail', info, repr(error))
+                prepared_rows.clear()
+
+    # 6. insert whatever is left (eg: receipts, now that they know their deed)
+    with timed_stage('save again'):
+        fail_unsaved(prepared_rows, key_maps.flush())
+
+    for i in prepared_rows:
+        if key_maps.dry_run and entities[i]._state.adding:  # new: no link, no relations to show
+            identif_items = filter_dict(prepared_rows[i], metadata.identifying_fields)
+            feedbacks[i] = RowFeedback(statuses[i], f'{model_name} {{{show_dict(identif_items)}}}',
+                                       f'{{{show_dict(prepared_rows[i])}}}')
+        else:
+            feedbacks[i] = RowFeedback(statuses[i], entities[i], '')
+    return feedbacks
+
+
+def read_workbook(file, streaming: bool = False) -> Dict[str, Union[pd.DataFrame, SheetStream]]:
+    """
+    Every sheet in MODELS_METADATA, read in a single pass over the file,
+    or read in chunks, while parsing them (see `sheet_streams.py`) if `streaming`
+    """
+    sheet_names = [metadata.sheet_name for metadata in MODELS_METADATA]
+    if streaming:
+        return stream_workbook(file, sheet_names)
+    return pd.read_excel(file, sheetname=sheet_names)
+
+"""
+Incremental re-imports
+"""
+
+
+def cells_hash(cells) -> str:
+    """ sha1 of some cells of a row (their excel values, before any parsing) """
+    return hashlib.sha1(json.dumps(list(cells), default=str).encode()).hexdigest()
+
+def row_hashes(row: Dict[str, Any], metadata) -> Tuple[str, str]:
+    """ (identifier, content) hashes of a row, see `ImportedRow` """
+    return (cells_hash(row.get(column) for column in metadata.identifier_columns),
+            cells_hash(row.get(column) for column in sorted(metadata.column_renames)))
+
+def unchanged_rows(hashes: List[Tuple[str, str]], metadata, seen_identifiers: Set[str]) -> Set[int]:
+    """
+    Indices of the rows that are the same as when they were last imported, as long as what they were imported as
+    is still there (eg: not deleted from the admin since, the row would never bring it back otherwise).
+    Rows sharing their identifier with others are never skipped: which one was imported last depends on the rest
+    (`seen_identifiers` are the ones in the previous chunks of the sheet, it gets this chunk's as well)
+    """
+    identifiers = [identifier for identifier, _ in hashes]
+    rows = ImportedRow.objects.filter(sheet_name=metadata.sheet_name)
+    stored = {}  # identifier ~> (content, entity pk)
+    for some_identifiers in chunks(list(set(identifiers)), QUERY_CHUNK):
+        stored.update((identifier, (content, entity_id)) for identifier, content, entity_id in
+                      rows.filter(identifier__in=some_identifiers).values_list('identifier', 'content', 'entity_id'))
+    existing = set()
+    for some_pks in chunks(list({entity_id for _, entity_id in stored.values()} - {None}), QUERY_CHUNK):
+        existing.update(metadata.model.objects.filter(pk__in=some_pks).values_list('pk', flat=True))
+
+    identifier_counts = Counter(identifiers)
+    unchanged = {i for i, (identifier, content) in enumerate(hashes)
+                 if identifier_counts[identifier] == 1 and identifier not in seen_identifiers
+                 and identifier in stored and stored[identifier][0] == content and stored[identifier][1] in existing}
+    seen_identifiers.update(identifiers)
+    return unchanged
+
+def store_row_hashes(hashes: List[Tuple[str, str]], feedbacks: List[RowFeedback], metadata):
+    """ forget the previous versions of the rows that were parsed, remember the ones that were imported """
+    rows = ImportedRow.objects.filter(sheet_name=metadata.sheet_name)
+    parsed = [identifier for (identifier, _), f in zip(hashes, feedbacks) if f.status != 'unchanged']
+    for identifiers in chunks(list(set(parsed)), QUERY_CHUNK):
+        rows.filter(identifier__in=identifiers).delete()
+
+    imported = {identifier: (content, f.info.pk) for (identifier, content), f in zip(hashes, feedbacks)
+                if f.status in ['add', 'duplicate']}
+    ImportedRow.objects.bulk_create(ImportedRow(sheet_name=metadata.sheet_name, identifier=identifier, content=content,
+                                                entity_id=entity_pk)
+                                    for identifier, (content, entity_pk) in imported.items())
+
+
+def previewing() -> bool:
+    """ whether the import running on this thread is a dry run, that doesn't write anything (see `KeyMaps`) """
+    key_maps = active_key_maps()
+    return key_maps is not None and key_maps.dry_run
+
+def parse_row_atomic(row: Dict[str, Any], metadata, preparsed: Dict[str, Any] = None) -> Tuple[str, Any, str]:
+    """ `parse_row` inside a savepoint: a database error on one row (eg: integrity) only rolls back that row,
+        instead of breaking the transaction of the whole sheet """
+    with transaction.atomic():
+        feedback = parse_row(row, metadata, preparsed)
+        if feedback[0] == 'fail':
+            # `parse_row` catches its errors, so the block would exit normally and release the savepoint:
+            # what the row saved before failing (eg: its spots, the entity before its relations) is undone
+            transaction.set_rollback(True)
+        return feedback
+
+def parse_chunk(sheet: pd.DataFrame, metadata, report: Callable[[int], None], incremental: bool = False,
+                seen_identifiers: Set[str] = None) -> [RowFeedback]:
+    """
+    Parses some consecutive rows of a sheet, see `parse_sheet`
+
+    Args:
+        report (rows parsed -> None): progress inside the chunk
+        seen_identifiers ({str}): identifier hashes of the rows in previous chunks, kept up to date
+    """
     sheet = sheet.rename(columns=reverse_dict(metadata.column_renames))  # translate
     sheet = sheet.replace({np.nan: None})  # mostly not numerical data: None is easier to work with
-
-    return [RowFeedback(*parse_row(row, metadata)) for _, row in sheet.iterrows()]
+    all_rows = records(sheet)
+    rows = all_rows
+
+    skipped = set()
+    if incremental:
+        hashes = [row_hashes(row, metadata) for row in all_rows]
+        skipped = unchanged_rows(hashes, metadata, seen_identifiers)
+        if skipped:
+            sheet = sheet.iloc[[i for i in range(len(all_rows)) if i not in skipped]]
+            rows = [row for i, row in enumerate(all_rows) if i not in skipped]
+
+    def report_parsed(n_parsed: int):
+        report(len(skipped) + n_parsed)
+
+    with timed_stage('parse columns'):
+        preparsed_rows = parse_columns(sheet, metadata)  # all the vectorized parsing, before any database work
+    if active_key_maps() is not None:
+        parsed_feedbacks = parse_rows_batch(rows, metadata, preparsed_rows, report_parsed)
+    else:
+        parsed_feedbacks = []
+        for row, preparsed in zip(rows, preparsed_rows):
+            parsed_feedbacks.append(RowFeedback(*parse_row_atomic(row, metadata, preparsed)))
+            if len(parsed_feedbacks) % PROGRESS_EVERY == 0:
+                report_parsed(len(parsed_feedbacks))
+
+    parsed_feedbacks = iter(parsed_feedbacks)
+    feedbacks = [RowFeedback('unchanged', show_dict({c: row.get(c) for c in metadata.identifier_columns}), '')
+                 if i in skipped else next(parsed_feedbacks)
+                 for i, row in enumerate(all_rows)]
+    if previewing():
+        return list(map(show_feedback, feedbacks))
+    if incremental:
+        store_row_hashes(hashes, feedbacks, metadata)
+    return list(map(referenced, feedbacks))
+
+def parse_sheet(sheet: Union[pd.DataFrame, SheetStream], metadata, on_progress: Callable = None,
+                incremental: bool = False) -> [RowFeedback]:
+    """
+    The whole sheet is committed at once (a single fsync instead of one per saved entity)
+
+    Args:
+        sheet (pd.DataFrame | SheetStream): as read from the excel document, whole or in chunks
+        metadata (ModelMetadata): how to parse it
+        on_progress (sheet name, rows parsed, rows in sheet -> None): called every PROGRESS_EVERY rows,
+            and once the sheet has been committed (rows in sheet is None while streaming csv)
+        incremental (bool): skip the rows that didn't change since they were last imported (status 'unchanged')
+    """
+    if isinstance(sheet, pd.DataFrame):
+        sheet = SheetStream(chunks=[sheet], n_rows=len(sheet))
+
+    feedbacks = []
+    seen_identifiers = set()
+
+    def report(n_parsed: int, n_rows: Optional[int] = sheet.n_rows):
+        if on_progress:
+            on_progress(metadata.sheet_name, n_parsed, n_rows)
+
+    report(0)
+    with timing_sheet(metadata.sheet_name), ExitStack() as stack:
+        if not previewing():  # a preview only reads, it shouldn't keep the database locked for the whole sheet
+            stack.enter_context(transaction.atomic())
+        for chunk in sheet.chunks:
+            n_before = len(feedbacks)
+            feedbacks += parse_chunk(chunk, metadata, lambda n_parsed: report(n_before + n_parsed),
+                                     incremental, seen_identifiers)
+    report(len(feedbacks), len(feedbacks))
+    return feedbacks
 
 def status_counts(feedbacks: [RowFeedback]) -> Dict[str, int]:
     statuses = [f.status for f in feedbacks]
-    return {status: statuses.count(status) for status in ['fail', 'duplicate', 'add']}
-
-def parse_file(file):
-    # send a copy of the file because the document gets consumed after reading a sheet
-    feedbacks = {metadata.sheet_name: parse_sheet(deepcopy(file), metadata) for metadata in MODELS_METADATA}
+    return {status: statuses.count(status) for status in STATUSES}
+
+def parse_workbook(workbook: Dict[str, Union[pd.DataFrame, SheetStream]], batch: bool, on_progress: Callable = None,
+                   incremental: bool = False, dry_run: bool = False, from_scratch: bool = False) \
+        -> Dict[str, List[RowFeedback]]:
+    """ dry runs are always in batch mode: the key maps are what resolves the rows without writing them """
+    with ExitStack() as stack:
+        key_maps = KeyMaps(dry_run, from_scratch) if batch or dry_run else None
+        stack.enter_context(using_key_maps(key_maps))
+        stack.enter_context(validating_in_batches())
+        if not dry_run:
+            stack.enter_context(updating_summaries_afterwards())
+            stack.enter_context(updating_search_afterwards())
+        # pop each sheet so its frame can be freed as soon as it's parsed
+        feedbacks = {metadata.sheet_name: parse_sheet(workbook.pop(metadata.sheet_name), metadata, on_progress,
+                                                      incremental)
+                     for metadata in MODELS_METADATA}
+        if key_maps is not None and not dry_run:
+            # batch mode inserts and relates entities in bulk, without signals: the summaries and search documents
+            # of what it wrote are updated along with the rest (only those, instead of all of them)
+            for model, pks in key_maps.written.items():
+                mark_summaries_written(model, pks)
+                mark_search_written(model, pks)
+        return feedbacks
+
+def parse_file(file, batch=False, all_or_nothing=False, dry_run=False, incremental=False, streaming=False,
+               on_progress=None, from_scratch=False):
+    """
+    Args:
+        file: excel document, with the sheets described in MODELS_METADATA
+            (or, if streaming, a zip archive of csv exports of them)
+        batch (bool): load existing entities once and insert new ones in bulk (see `parse_rows_batch`)
+        all_or_nothing (bool): if any row fails, nothing is saved (otherwise each sheet is committed on its own)
+        dry_run (bool): nothing is written, only the feedback is computed (what a real import would give, except for
+            what only the database can tell, eg: a clash with an entity the key maps don't know about)
+        from_scratch (bool): for a dry run, as if the database was wiped beforehand
+        incremental (bool): skip the rows that didn't change since the last import, see `parse_sheet`
+        streaming (bool): read the sheets in chunks while parsing them, instead of whole, before parsing
+        on_progress (sheet name, rows parsed, rows in sheet -> None): see `parse_sheet`
+
+    Returns:
+        tuple of (feedbacks for each sheet, status counts for each sheet)
+    """
+    workbook = read_workbook(file, streaming)
+    if dry_run:
+        # the duplicates are shown as the rows would change them, not as they are in the database (see `RowFeedback`)
+        feedbacks = parse_workbook(workbook, batch, on_progress, incremental, dry_run=True, from_scratch=from_scratch)
+    elif not all_or_nothing:
+        feedbacks = parse_workbook(workbook, batch, on_progress, incremental)
+    else:
+        # the rows are still inserted (later sheets refer to entities from earlier ones), but never committed
+        with transaction.atomic():
+            feedbacks = parse_workbook(workbook, batch, on_progress, incremental)
+            if any(f.status == 'fail' for sheet_feedbacks in feedbacks.values() for f in sheet_feedbacks):
+                # the entities won't be there to be shown later
+                feedbacks = map_dict(feedbacks, show_feedbacks)
+                transaction.set_rollback(True)
     return feedbacks, map_dict(feedbacks, status_counts)
 
 
@@ -1,17 +1,22 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 from datetime import date
 from math import fabs
 
 from django.utils.translation import ugettext_lazy as _
 from django.db.models import Model, ForeignKey, TextField, IntegerField, CharField, \
-    ManyToManyField, FloatField, BooleanField, DateField, Sum, Max, Manager
-from django.db.models.signals import pre_save
+    ManyToManyField, FloatField, BooleanField, DateField, DateTimeField, Sum, Max, Manager, OneToOneField, SET_NULL, \
+    Subquery, OuterRef, Exists
+from django.db import connection
+from django.db.models.signals import pre_save, m2m_changed, post_migrate
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 
 from .display_helpers import head_plus_more, initials, year_to_shorthand, title_case, entity_tag, show_head_links, NBSP
 from .parsing_helpers import parse_nr_year, keep_only, year_shorthand_to_full, parse_date
 from .validators import number_validator, year_validators, parcel_validator, row_validator, column_validator, \
     payment_value_validator, name_validator, romanian_phone_validator, address_validator, city_validator, date_validators
-from .utils import class_name
+from .utils import class_name, relation_signature, chunks, QUERY_CHUNK
+from .batch_validation import active_validation
 
 
 DISTANT_DATE_THRESHOLD = 10  # year(s)
@@ -29,7 +34,11 @@ optional = {'blank': True, 'null': True}  # to be passed in field definitions as
 def validate_model(sender, **kwargs):
     """ https://djangosnippets.org/snippets/2319/ """
     if 'raw' in kwargs and not kwargs['raw']:
-        kwargs['instance'].full_clean()
+        validation = active_validation()
+        if validation is None:
+            kwargs['instance'].full_clean()
+        else:  # importing: without a query per unique check (see `batch_validation.py`)
+            validation.validate_one(kwargs['instance'])
 pre_save.connect(validate_model, dispatch_uid='validate_models')
 
 
@@ -55,6 +64,18 @@ class WarningModel(Model):
         abstract = True
 
 
+class RemembersLoadedValues:
+    """
+    Mixin (before the model's other bases) keeping the field values an entity was loaded with, as `_loaded_values`
+    (attname ~> value), without a signal per loaded entity: eg: to tell where a saved child was moved from
+    """
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+
 class ModelWithYear(WarningModel):
     year   = IntegerField(default=date.today().year, validators=year_validators, verbose_name=_('year'))
 
@@ -73,6 +94,8 @@ class ModelWithYear(WarningModel):
 
 
 class NrYearManager(Manager):
+    natural_key_fields = ('number', 'year')
+
     @staticmethod
     def prepare_natural_key(identifier: str) -> Dict[str, int]:
         """ should be called before `get_by_natural_key` or `__init__` """
@@ -107,10 +130,14 @@ Spot - the central entity
 """
 
 class SpotManager(Manager):
+    natural_key_fields = ('parcel', 'row', 'column')
+
     @staticmethod
     def prepare_natural_key(identifier: str) -> Dict[str, str]:
         """ should be called before `get_by_natural_key` or `__init__` """
         parcel, row, column = identifier.strip().upper().split('-')
+        if 'BIS' in row:
+            row = row.lower()  # as `clean_fields` saves it, otherwise it's not found
         return {'parcel': parcel, 'row': row, 'column': column}
 
     def get_by_natural_key(self, parcel, row, column):
@@ -211,22 +238,7 @@ class Spot(WarningModel):
         -> 2017
         """
 
-        maintenances = self.maintenances.order_by('-year')  # from largest year to smallest
-        if not maintenances:
-            return
-
-        smallest_unkept_year = None
-        for maintenance in maintenances:
-            if maintenance.kept:  # stop going any further back if we found a year kept
-                break
-            smallest_unkept_year = maintenance.year  # otherwise, keep going and remembering this as the smallest unkept
-
-        if not smallest_unkept_year:
-            return
-
-        years_difference = date.today().year - smallest_unkept_year
-
-        return f'{smallest_unkept_year} ({years_difference} year{"s" if years_difference > 1 else ""})'
+        return show_unkept_since(self.maintenances.order_by('-year'))
 
     @property
     def last_operation(self):  # -> Optional[Operation]: no forward declaration so this can't be hinted conveniently
@@ -262,6 +274,46 @@ class Spot(WarningModel):
                 yield _(f'two  constructions of the same type: {constructions_links}'), self
 
 
+def unkept_year(maintenances) -> Optional[int]:
+    """ `Spot.unkept_since` as a year, given the spot's maintenances from largest year to smallest (eg: prefetched) """
+    smallest_unkept_year = None
+    for maintenance in maintenances:
+        if maintenance.kept:  # stop going any further back if we found a year kept
+            break
+        smallest_unkept_year = maintenance.year  # otherwise, keep going and remembering this as the smallest unkept
+    return smallest_unkept_year
+
+
+def unkept_year_subquery() -> Subquery:
+    """
+    `unkept_year` computed by the database, for all the spots of a queryset in one query:
+    the smallest unkept year with no kept year after it
+
+    Examples:
+        Spot.objects.annotate(unkept_year=unkept_year_subquery()).filter(unkept_year__lte=2015)
+    """
+    kept_later = Maintenance.objects.filter(spot=OuterRef('spot'), year__gt=OuterRef('year'), kept=True)
+    trailing_unkept = Maintenance.objects.filter(spot=OuterRef('pk'), kept=False)\
+        .annotate(kept_later=Exists(kept_later)).filter(kept_later=False)\
+        .order_by('year').values('year')[:1]
+    return Subquery(trailing_unkept, output_field=IntegerField())
+
+
+def show_unkept_since(maintenances) -> Optional[str]:
+    """ `Spot.unkept_since`, given the spot's maintenances from largest year to smallest (eg: prefetched) """
+    return show_unkept_year(unkept_year(maintenances))
+
+
+def show_unkept_year(smallest_unkept_year: Optional[int]) -> Optional[str]:
+    """ `Spot.unkept_since`, given its year (eg: from `unkept_year_subquery`) """
+    if not smallest_unkept_year:
+        return
+
+    years_difference = date.today().year - smallest_unkept_year
+
+    return f'{smallest_unkept_year} ({years_difference} year{"s" if years_difference > 1 else ""})'
+
+
 """
 Ownership
 """
@@ -294,7 +346,7 @@ class Deed(NrYear):
                 yield from spot.diagnose_warnings(only_related_to=self)
 
 
-class OwnershipReceipt(NrYear):
+class OwnershipReceipt(RemembersLoadedValues, NrYear):
     deed  = ForeignKey(Deed, related_name='receipts', **optional, verbose_name=_('deed'))
     value = FloatField(**optional, validators=[payment_value_validator], verbose_name=_('value'))
 
@@ -318,6 +370,8 @@ class OwnershipReceipt(NrYear):
 
 
 class OwnerManager(Manager):
+    natural_key_fields = ('name',)
+
     @staticmethod
     def prepare_natural_key(identifier: str) -> Dict[str, str]:
         return {'name': title_case(identifier)}
@@ -367,7 +421,7 @@ class Owner(WarningModel):
 Operations
 """
 
-class Operation(WarningModel):
+class Operation(RemembersLoadedValues, WarningModel):
     BURIAL     = 'b'
     EXHUMATION = 'e'
     TYPE_CHOICES = [
@@ -405,6 +459,8 @@ Constructions
 """
 
 class CompanyManager(Manager):
+    natural_key_fields = ('name',)
+
     @staticmethod
     def prepare_natural_key(identifier: str) -> Dict[str, str]:
         return {'name': title_case(identifier)}
@@ -441,7 +497,7 @@ class Company(WarningModel):
         super(Company, self).clean_fields(exclude)
 
 
-class Construction(WarningModel):
+class Construction(RemembersLoadedValues, WarningModel):
     TOMB   = 't'
     BORDER = 'b'
     TYPE_CHOICES = [
@@ -457,10 +513,12 @@ class Construction(WarningModel):
     spots         = ManyToManyField(Spot, verbose_name=_('spots'))
     company       = ForeignKey(Company, **optional, verbose_name=_('company'))
     owner_builder = ForeignKey(Owner,   **optional, related_name='constructions_built', verbose_name=_('owner builder'))
+    # relation_signature of the spots, to find "the construction on exactly these spots" with one indexed lookup
+    spots_signature = CharField(max_length=40, blank=True, db_index=True, editable=False)
 
     class Meta:
         default_related_name = 'constructions'
-        # unique_together = ('type', 'spots')  # can't unique m2m
+        # unique_together = ('type', 'spots')  # can't unique m2m, but (type, spots_signature) is what identifies it
         ordering = ['type']  # FIXME add spots to ordering (as it is in the str)
         verbose_name = _('Construction')
         verbose_name_plural = _('Constructions')
@@ -506,6 +564,60 @@ class Construction(WarningModel):
                 yield from spot.diagnose_warnings(only_related_to=self)
 
 
+def update_spots_signatures(construction_pks: List[int]):
+    """ recomputes the spots signature of the given constructions, from the database """
+    spots = {pk: [] for pk in construction_pks}
+    through = Construction.spots.through
+    for construction_pk, spot_pk in through.objects.filter(construction_id__in=construction_pks)\
+            .values_list('construction_id', 'spot_id'):
+        spots[construction_pk].append(spot_pk)
+    for pk, spot_pks in spots.items():
+        Construction.objects.filter(pk=pk).update(spots_signature=relation_signature(spot_pks))
+
+def construction_spots_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """ keeps `Construction.spots_signature` up to date, whichever side the relation is changed from """
+    if not reverse:  # construction.spots
+        if action in ['post_add', 'post_remove', 'post_clear']:
+            instance.spots_signature = relation_signature(instance.spots.values_list('pk', flat=True))
+            Construction.objects.filter(pk=instance.pk).update(spots_signature=instance.spots_signature)
+        return
+
+    # spot.constructions
+    if action == 'pre_clear':  # remember which ones are about to lose the spot
+        instance._cleared_construction_pks = list(instance.constructions.values_list('pk', flat=True))
+    elif action in ['post_add', 'post_remove']:
+        update_spots_signatures(list(pk_set))
+    elif action == 'post_clear':
+        update_spots_signatures(instance._cleared_construction_pks)
+m2m_changed.connect(construction_spots_changed, sender=Construction.spots.through,
+                    dispatch_uid='construction_spots_signature')
+
+
+def backfill_spots_signatures() -> int:
+    """
+    Signs the constructions that have spots but no signature (eg: inserted before there were signatures, or with
+    raw SQL), until then `model_parsers.relational_get` can't trust a missing match. Returns how many were signed
+    """
+    unsigned = list(Construction.objects.filter(spots_signature='', spots__isnull=False).distinct()
+                    .values_list('pk', flat=True))
+    for some_pks in chunks(unsigned, QUERY_CHUNK):
+        update_spots_signatures(some_pks)
+    return len(unsigned)
+
+def spots_signatures_migrated(sender, **kwargs):
+    """ `migrate --run-syncdb` never alters existing tables: a database from before the signatures gets the column """
+    if sender.name != 'cemetery':
+        return
+    table = Construction._meta.db_table
+    with connection.cursor() as cursor:
+        columns = {column.name for column in connection.introspection.get_table_description(cursor, table)}
+    if 'spots_signature' not in columns:
+        with connection.schema_editor() as schema_editor:
+            schema_editor.add_field(Construction, Construction._meta.get_field('spots_signature'))
+    backfill_spots_signatures()
+post_migrate.connect(spots_signatures_migrated, dispatch_uid='spots_signatures_migrated')
+
+
 class Authorization(NrYear):
     # Construction authorization
     spots        = ManyToManyField(Spot,    related_name='authorizations', verbose_name=_('spots'))
@@ -543,7 +655,7 @@ class PaymentReceipt(NrYear):
         return aggregation['value__sum']
 
 
-class PaymentUnit(ModelWithYear):
+class PaymentUnit(RemembersLoadedValues, ModelWithYear):
     """ one unit is for a single year-spot combination. one receipt can have multiple units """
     spot    = ForeignKey(Spot, related_name='payments', verbose_name=_('spot'))
     # expected value for this year, for this spot
@@ -572,7 +684,7 @@ class PaymentUnit(ModelWithYear):
 Maintenance
 """
 
-class Maintenance(ModelWithYear):
+class Maintenance(RemembersLoadedValues, ModelWithYear):
     spot = ForeignKey(Spot, related_name='maintenances', verbose_name=_('spot'))
     kept = BooleanField(verbose_name=_('kept'))
 
@@ -591,6 +703,108 @@ class Maintenance(ModelWithYear):
         return Owner.objects.filter(deeds__spots__maintenances=self)
 
 
+"""
+Summaries
+"""
+
+class SpotSummary(Model):
+    """
+    What the spot list shows of each spot, denormalized into one row per spot so it can be sorted (and filtered)
+    without joining everything. Kept up to date by signals, see `spot_summaries.py`
+    """
+    spot               = OneToOneField(Spot, primary_key=True, related_name='summary', verbose_name=_('spot'))
+    active_deed        = ForeignKey(Deed, **optional, on_delete=SET_NULL, related_name='+', verbose_name=_('active deed'))
+    n_active_deeds     = IntegerField(default=0, verbose_name=_('active deeds'))
+    active_owners      = TextField(blank=True, verbose_name=_('active owners'))  # names, of the active deed
+    first_active_owner = CharField(max_length=100, **optional, db_index=True, verbose_name=_('first active owner'))
+    shares_deed_with   = TextField(blank=True, verbose_name=_('sharing deed'))  # the other spots of the active deed
+    n_operations       = IntegerField(default=0, db_index=True, verbose_name=_('operations'))
+    n_constructions    = IntegerField(default=0, db_index=True, verbose_name=_('constructions'))
+    last_paid_year     = IntegerField(**optional, db_index=True, verbose_name=_('last paid year'))
+    unkept_since       = IntegerField(**optional, db_index=True, verbose_name=_('unkept since'))  # year
+
+    class Meta:
+        verbose_name = _('Spot Summary')
+        verbose_name_plural = _('Spot Summaries')
+
+    def __str__(self):
+        return str(self.spot)
+
+
+"""
+Imports
+"""
+
+class ImportJob(Model):
+    """ an excel import, run in the background (see `jobs.py`) """
+    PENDING = 'p'
+    RUNNING = 'r'
+    DONE    = 'd'
+    CRASHED = 'c'
+    STATUS_CHOICES = [
+        (PENDING, _('pending')),
+        (RUNNING, _('running')),
+        (DONE,    _('done')),
+        (CRASHED, _('crashed')),
+    ]
+    status          = CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING, verbose_name=_('status'))
+    file_name       = CharField(max_length=250, verbose_name=_('file name'))
+    wipe_beforehand = BooleanField(default=False, verbose_name=_('wipe beforehand'))
+    all_or_nothing  = BooleanField(default=False, verbose_name=_('all or nothing'))
+    dry_run         = BooleanField(default=False, verbose_name=_('preview'))  # nothing is saved
+    incremental     = BooleanField(default=False, verbose_name=_('skip unchanged rows'))
+    time_stages     = BooleanField(default=False, verbose_name=_('time the stages'))
+    created         = DateTimeField(auto_now_add=True, verbose_name=_('created'))
+    finished        = DateTimeField(**optional, verbose_name=_('finished'))
+    wipe_duration   = FloatField(**optional, verbose_name=_('wipe duration'))  # seconds, if it wiped beforehand
+    # json: sheet name ~> [rows parsed, rows in sheet]; only saved between sheets
+    progress        = TextField(default='{}', blank=True, verbose_name=_('progress'))
+    error           = TextField(**optional, verbose_name=_('error'))  # traceback, if the import itself crashed
+    # json: sheet name ~> time and queries per stage and field parser, if time_stages (see `import_timings.py`)
+    stage_timings   = TextField(**optional, verbose_name=_('stage timings'))
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = _('Import')
+        verbose_name_plural = _('Imports')
+
+    def __str__(self):
+        return f'{self.file_name} ({self.created:%Y-%m-%d %H:%M})'
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in [ImportJob.DONE, ImportJob.CRASHED]
+
+
+class ImportFeedback(Model):
+    """ the outcome of importing one row of a sheet (see `model_parsers.RowFeedback`) """
+    job         = ForeignKey(ImportJob, related_name='feedbacks', verbose_name=_('import'))
+    sheet_name  = CharField(max_length=250, verbose_name=_('sheet'))
+    row         = IntegerField(verbose_name=_('row'))  # as numbered in excel: the header is the first one
+    status      = CharField(max_length=10, verbose_name=_('status'))
+    info        = TextField(blank=True, verbose_name=_('info'))
+    additional  = TextField(blank=True, verbose_name=_('additional info'))
+    # the added / duplicate entity, its link and fields are only rendered for the rows that get viewed
+    entity_type = ForeignKey(ContentType, **optional)
+    entity_id   = IntegerField(**optional)
+    entity      = GenericForeignKey('entity_type', 'entity_id')
+
+    class Meta:
+        ordering = ['row']
+        index_together = ['job', 'sheet_name', 'status']
+
+
+class ImportedRow(Model):
+    """ the last successfully imported version of an excel row, to skip it if it comes in unchanged next time """
+    sheet_name = CharField(max_length=250)
+    identifier = CharField(max_length=40)  # sha1 of the cells that identify the row (eg: the deed number)
+    content    = CharField(max_length=40)  # sha1 of all its cells
+    entity_id  = IntegerField(**optional)  # what it was imported as (of the sheet's model), if it's deleted: not skipped
+
+    class Meta:
+        unique_together = ['sheet_name', 'identifier']
+
+
 ALL_MODELS = [
     Spot,
     Deed, OwnershipReceipt, Owner,
@@ -1,6 +1,14 @@
-from typing import Optional, Union, Tuple, Callable
+from typing import Optional, Union, Tuple, Callable, Dict
 from dateutil.parser import parse as dateutil_parse
-from datetime import datetime
+from datetime import datetime, date
+from functools import lru_cache
+from collections import Counter
+import re
+
+import numpy as np
+import pandas as pd
+
+from .display_helpers import title_case
 
 
 def year_shorthand_to_full(shorthand: Optional[Union[int, str]], threshold: int = 50) -> Optional[int]:
@@ -46,19 +54,19 @@ def year_shorthand_to_full(shorthand: Optional[Union[int, str]], threshold: int
 def parse_nr_year(identifier: Optional[str]) -> Optional[Tuple[int, int]]:
     """
     >>> parse_nr_year('1/17')
-    1, 2017
+    (1, 2017)
 
     >>> parse_nr_year('10/17')
-    10, 2017
+    (10, 2017)
 
     >>> parse_nr_year('10/2017')
-    10, 2017
+    (10, 2017)
 
     >>> parse_nr_year('10/94')
-    1, 1994
+    (10, 1994)
 
     >>> parse_nr_year('10/1994')
-    1, 1994
+    (10, 1994)
 
     >>> parse_nr_year(None)
     """
@@ -136,8 +144,28 @@ def parse_date(arg) -> Optional[datetime]:
 
     if arg is None:
         return None
+    if isinstance(arg, datetime):
+        return arg  # already parsed (eg: by the importer, before cleaning) - parsing its string again would swap
+    if isinstance(arg, date):  # day and month, because of `dayfirst`
+        return datetime(arg.year, arg.month, arg.day)
+
+    return _parse_date_str(str(arg))  # convert ints
+
+
+YEAR_PATTERN = re.compile(r"\s*'?(\d{1,4})\s*$")                               # 94, '94, 1994
+DAY_MONTH_YEAR_PATTERN = re.compile(r'\s*(\d{1,2})[./\- ](\d{1,2})[./\- ](\d{4})\s*$')  # 24.01.1994, 18 07 2017
 
-    str_arg = str(arg)  # convert ints
+_date_parse_paths = Counter()  # how the cache misses were parsed: fast path (regex) or dateutil fallback
+
+
+@lru_cache(maxsize=4096)  # the same few dates repeat across rows
+def _parse_date_str(str_arg: str) -> datetime:
+    parsed = _parse_date_fast(str_arg)
+    if parsed is not None:
+        _date_parse_paths['fast'] += 1
+        return parsed
+
+    _date_parse_paths['fallback'] += 1
     try:
         int_arg = int(str_arg.replace("'", ""))  # to be able to convert '17
         int_arg = year_shorthand_to_full(int_arg)  # to correctly assess 17 as the year 2017 instead of day 17
@@ -149,3 +177,126 @@ def parse_date(arg) -> Optional[datetime]:
         str_arg,
         dayfirst=True,  # for ambiguities like `10.10.1994`
         default=datetime(year=2000, month=1, day=1))  # when only the year is given, set to Jan 1st
+
+
+def _parse_date_fast(str_arg: str) -> Optional[datetime]:
+    """
+    The formats found in the sheets, parsed the same way dateutil would parse them, without dateutil.
+    None for anything else (including invalid dates, so dateutil gets to raise its usual error)
+
+    Examples:
+        >>> _parse_date_fast("'94")
+        datetime.datetime(1994, 1, 1, 0, 0)
+        >>> _parse_date_fast('01.24.1994')
+        datetime.datetime(1994, 1, 24, 0, 0)
+        >>> _parse_date_fast('30.02.1994')
+        >>> _parse_date_fast('1994-01-24')
+    """
+    match = YEAR_PATTERN.match(str_arg)
+    if match:
+        year = year_shorthand_to_full(int(match.group(1)))
+        return datetime(year, 1, 1) if year >= 1000 else None
+
+    match = DAY_MONTH_YEAR_PATTERN.match(str_arg)
+    if match:
+        day, month, year = map(int, match.groups())
+        if month > 12 and day <= 12:  # can only be month first
+            day, month = month, day
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            return None
+
+    return None
+
+
+def parse_date_stats() -> Dict[str, int]:
+    """ cache hits & misses of `parse_date` so far, and how many of the misses the fast path covered """
+    cache_info = _parse_date_str.cache_info()
+    return {
+        'hits':     cache_info.hits,
+        'misses':   cache_info.misses,
+        'fast':     _date_parse_paths['fast'],
+        'fallback': _date_parse_paths['fallback'],
+    }
+
+
+"""
+Column parsers: vectorized versions of the parsers above, that work on a whole pd.Series at once.
+Each returns (parsed values, ok mask). Cells that are not ok were not handled by the fast path 
+(unusual or invalid input) and should go through the regular parser, which produces the value or the error
+"""
+
+def year_shorthand_to_full_column(shorthands: pd.Series, threshold: int = 50) -> Tuple[pd.Series, pd.Series]:
+    """
+    Vectorized `year_shorthand_to_full`
+
+    Examples:
+        >>> years, ok = year_shorthand_to_full_column(pd.Series([99, "'15", '1994', None, 'x']))
+        >>> years.tolist()
+        [1999, 2015, 1994, None, None]
+        >>> ok.tolist()
+        [True, True, True, True, False]
+    """
+    missing = shorthands.isnull()
+    numbers = pd.to_numeric(shorthands.astype(str).str.replace("'", ''), errors='coerce')
+    ok = missing | (numbers.notnull() & (numbers % 1 == 0))  # int('15.5') fails, so floats are left to the fallback
+
+    numbers = numbers.fillna(0)
+    years = np.where(numbers >= 100, numbers,  # not actually a shorthand
+                     np.where(numbers > threshold, 1900 + numbers, 2000 + numbers))
+    years = pd.Series(years.astype(np.int64).tolist(), index=shorthands.index, dtype=object)
+    return years.where(ok & ~missing, None), ok
+
+
+def parse_nr_year_column(identifiers: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Vectorized `parse_nr_year`
+
+    Examples:
+        >>> nr_years, ok = parse_nr_year_column(pd.Series(['1/17', '10/1994', None, '?/09', '1/2/3']))
+        >>> nr_years.tolist()
+        [(1, 2017), (10, 1994), None, None, None]
+        >>> ok.tolist()
+        [True, True, True, False, False]
+    """
+    missing = identifiers.isnull()
+    parts = identifiers.astype(str).str.split('/')
+    numbers = pd.to_numeric(parts.str[0], errors='coerce')
+    years, years_ok = year_shorthand_to_full_column(parts.str[1])
+    ok = missing | ((parts.str.len() == 2) & numbers.notnull() & (numbers % 1 == 0) & years.notnull() & years_ok)
+
+    nr_years = pd.Series(list(zip(numbers.fillna(0).astype(np.int64).tolist(), years.tolist())),
+                         index=identifiers.index, dtype=object)
+    return nr_years.where(ok & ~missing, None), ok
+
+
+def keep_only_column(strings: pd.Series, pattern: str) -> Tuple[pd.Series, pd.Series]:
+    """
+    Vectorized `keep_only`, where the condition is expressed as a regex character class (eg: \\d for str.isdigit)
+
+    Examples:
+        >>> phones, ok = keep_only_column(pd.Series(['0712 345 789', None]), r'\\d')
+        >>> phones.tolist(), ok.tolist()
+        (['0712345789', None], [True, True])
+    """
+    missing = strings.isnull()
+    ok = missing | strings.map(lambda x: isinstance(x, str))  # keep_only fails on non-strings (eg: numeric cells)
+    kept = strings.where(ok & ~missing, '').astype(str).str.replace(f'[^{pattern}]', '')
+    return kept.where(ok & ~missing, None), ok
+
+
+def title_case_column(strings: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """
+    Vectorized `title_case`: every distinct value is title-cased only once
+
+    Examples:
+        >>> names, ok = title_case_column(pd.Series(['ion popescu', None, 'ion popescu']))
+        >>> names.tolist(), ok.tolist()
+        (['Ion Popescu', None, 'Ion Popescu'], [True, True, True])
+    """
+    missing = strings.isnull()
+    ok = missing | strings.map(lambda x: isinstance(x, str))
+    distinct = strings[ok & ~missing].unique()
+    title_cased = strings.map(dict(zip(distinct, map(title_case, distinct))))
+    return title_cased.where(ok & ~missing, None), ok
@@ -0,0 +1,169 @@
+from typing import Optional, Iterable, Set, Dict, Tuple, Callable
+from contextlib import contextmanager
+import threading
+
+from django.db.models import Model
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+
+from .key_maps import through_columns
+from .utils import chunks, QUERY_CHUNK
+
+
+"""
+Keeps data derived from the entities up to date (eg: the spot summaries, the search documents): saving, deleting
+or relating entities marks the ones concerned, by kind (eg: 'spots'), and what's derived from the marked ones
+is then updated, right away or, inside `Marking.afterwards` (eg: during an import), once for the whole block.
+Marks are kept as cheap as possible (mostly pks the signals already have)
+"""
+
+
+class PendingMarks:
+    """ what was marked since the derived data was last updated """
+    def __init__(self, marking: 'Marking'):
+        self.marking = marking
+        self.pks = {kind: set() for kind in marking.kinds}  # kind ~> marked pks
+        self.everything = False
+
+    def mark(self, **pks: Iterable[int]):
+        for kind, some_pks in pks.items():
+            self.pks[kind].update(some_pks)
+
+    def flush(self):
+        if self.everything:
+            self.marking.rebuild()
+        elif any(self.pks.values()):
+            self.marking.update(self.pks)
+        self.__init__(self.marking)
+
+
+class Marking:
+    """
+    How some derived data is marked and updated: `update` gets the marked pks (kind ~> pks)
+    and updates what's derived from them, `rebuild` updates all of it
+
+    Args:
+        name: tells its receivers (and what they remember on the entities) from the ones of other markings
+        models: model ~> the kind its saved entities are marked as
+        parents: model ~> (its foreign key's attname, kind) of the parent marked when one of its entities changes
+            (and of the previous one when it's moved, as it was loaded, see `models.RemembersLoadedValues`)
+    """
+    def __init__(self, name: str, update: Callable[[Dict[str, Set[int]]], None], rebuild: Callable[[], None],
+                 models: Dict[type, str], parents: Dict[type, Tuple[str, str]] = None):
+        self.name, self.update, self.rebuild = name, update, rebuild
+        self.models, self.parents = models, parents or {}
+        self.kinds = set(self.models.values()) | {kind for _attname, kind in self.parents.values()}
+        self.losing = None  # see `connect`
+        self._local = threading.local()  # the marks waiting for the end of the block running on this thread (if any)
+
+    def pending(self) -> Optional[PendingMarks]:
+        """ the marks waiting for the end of the current block, None when they're updated right away """
+        return getattr(self._local, 'pending', None)
+
+    @contextmanager
+    def afterwards(self, rebuild: bool = False):
+        """
+        What changes during the block is updated once, when it ends
+        (all of it if `rebuild`, for blocks that make changes without sending signals, eg: bulk inserts)
+        """
+        previous = self.pending()
+        self._local.pending = PendingMarks(self)
+        self._local.pending.everything = rebuild
+        try:
+            yield self._local.pending
+            self._local.pending.flush()
+        finally:
+            self._local.pending = previous
+
+    def mark(self, **pks: Iterable[int]):
+        """ what's derived from these entities (kind ~> pks) needs to be updated """
+        pending = self.pending()
+        if pending is not None:
+            pending.mark(**pks)
+            return
+        now = PendingMarks(self)
+        now.mark(**pks)
+        now.flush()
+
+    def mark_written(self, model, pks: Iterable[int]):
+        """ `mark` for entities of any `model` that were inserted or related without signals (eg: in bulk) """
+        pks = list(pks)
+        if model in self.models:
+            self.mark(**{self.models[model]: pks})
+        if model in self.parents:  # what `child_changed` would have marked
+            attname, kind = self.parents[model]
+            for some_pks in chunks(pks, QUERY_CHUNK):
+                parent_pks = model.objects.filter(pk__in=some_pks).values_list(attname, flat=True)
+                self.mark(**{kind: set(parent_pks) - {None}})
+
+    def saved(self, sender, instance, **kwargs):
+        self.mark(**{self.models[sender]: [instance.pk]})
+
+    def child_changed(self, sender, instance, **kwargs):
+        attname, kind = self.parents[sender]
+        remembered = f'_{self.name}_{attname}'  # the parent it was marked for last time
+        previous = getattr(instance, remembered, getattr(instance, '_loaded_values', {}).get(attname))
+        current = getattr(instance, attname)
+        self.mark(**{kind: {current, previous} - {None}})
+        setattr(instance, remembered, current)
+
+    def deleting(self, sender, instance, **kwargs):
+        # resolved now, while the relations are still there, but marked once the entity is gone
+        setattr(instance, f'_{self.name}_marks', self.losing(instance))
+
+    def deleted(self, sender, instance, **kwargs):
+        self.mark(**getattr(instance, f'_{self.name}_marks'))
+
+    def relation_changed(self, field, forward: Optional[str], backward: Optional[str]):
+        """
+        m2m_changed receiver for the many-to-many `field`, marking the entities on its side as `forward`
+        and the related ones as `backward`: one of the kinds, or None (nothing derived from them)
+        """
+        cleared = f'_cleared_{self.name}_pks'
+
+        def changed(sender, instance, action, reverse, pk_set, **kwargs):
+            instance_kind, related_kind = (backward, forward) if reverse else (forward, backward)
+            if action == 'pre_clear':  # remember which ones are about to be cleared, they're not sent
+                through, source, target = through_columns(field)
+                if reverse:
+                    source, target = target, source
+                setattr(instance, cleared, set(through.objects.filter(**{source: instance.pk})
+                                               .values_list(target, flat=True)))
+                return
+            if action == 'post_clear':
+                pk_set = getattr(instance, cleared)
+            elif action not in ['post_add', 'post_remove']:
+                return
+
+            marks = {}
+            if instance_kind:
+                marks.setdefault(instance_kind, set()).add(instance.pk)
+            if related_kind:
+                marks.setdefault(related_kind, set()).update(pk_set)
+            self.mark(**marks)
+        return changed
+
+    def connect(self, losing: Callable[[Model], Dict[str, Iterable[int]]], deleted: Iterable[type]):
+        """
+        Connects the receivers marking the saved `models` and the parents of the saved or deleted children,
+        and, through `losing` (entity ~> its marks), what changes when one of the `deleted` models' entities is gone
+        (weak=False: nothing else references the receivers)
+        """
+        self.losing = losing
+        for model in self.models:
+            post_save.connect(self.saved, sender=model, weak=False,
+                              dispatch_uid=f'{self.name}_saved_{model.__name__}')
+        for model in self.parents:
+            post_save.connect(self.child_changed, sender=model, weak=False,
+                              dispatch_uid=f'{self.name}_child_saved_{model.__name__}')
+            post_delete.connect(self.child_changed, sender=model, weak=False,
+                                dispatch_uid=f'{self.name}_child_deleted_{model.__name__}')
+        for model in deleted:
+            pre_delete.connect(self.deleting, sender=model, weak=False,
+                               dispatch_uid=f'{self.name}_deleting_{model.__name__}')
+            post_delete.connect(self.deleted, sender=model, weak=False,
+                                dispatch_uid=f'{self.name}_deleted_{model.__name__}')
+
+    def connect_relation(self, field, forward: Optional[str], backward: Optional[str]):
+        """ connects the `relation_changed` receiver of the many-to-many `field` """
+        m2m_changed.connect(self.relation_changed(field, forward, backward), sender=through_columns(field)[0],
+                            weak=False, dispatch_uid=f'{self.name}_{field.model.__name__}_{field.name}')
@@ -0,0 +1,322 @@
+from typing import Optional, Iterable, Set, Dict, List
+from collections import OrderedDict, defaultdict
+import re
+
+from django.conf import settings
+from django.db import connection, transaction, OperationalError
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_migrate
+from django.utils import translation
+
+from .models import Spot, Deed, OwnershipReceipt, Owner, Operation, Construction, Company
+from .pending_marks import Marking
+from .spot_summaries import related_pks
+from .utils import chunks, QUERY_CHUNK
+
+
+"""
+Full text search of spots, deeds, owners and operations, through a SQLite FTS5 table for each of them:
+one document per entity (the words its admin's `search_fields` used to find through joins), with its pk as rowid.
+Saving or deleting anything a document shows marks the entities concerned, whose documents are then written again,
+right away or, inside `updating_search_afterwards` (eg: during an import), once for the whole block
+(see `pending_marks.py`).
+Where FTS5 is missing (or the tables weren't created yet, see `create_search_tables`), the admin searches as before
+"""
+
+_available = {}  # database name ~> whether its search tables exist
+
+TOKENIZER = 'unicode61 remove_diacritics 2'  # case and diacritics insensitive: "stefan" finds "Ștefan"
+
+
+"""
+Documents
+"""
+
+def choice_labels(choices) -> Dict[str, str]:
+    """ value ~> its label in every language, so it's found whichever one the search is in """
+    labels = defaultdict(set)
+    for language, _name in settings.LANGUAGES:
+        with translation.override(language):
+            for value, label in choices:
+                labels[value].add(str(label))
+    return {value: ' '.join(sorted(words)) for value, words in labels.items()}
+
+
+def spot_str(parcel: str, row: str, column: str) -> Optional[str]:
+    return str(Spot(parcel=parcel, row=row, column=column)) if parcel is not None else None
+
+
+def gather(documents: Dict[int, list], rows):
+    """ adds the (non null) values of each (pk, *values) row to the words of the document of that pk """
+    for pk, *values in rows:
+        if pk in documents:
+            documents[pk].extend(value for value in values if value is not None)
+
+
+def spot_documents(pks: List[int]) -> Dict[int, list]:
+    documents = {pk: [spot_str(parcel, row, column)]
+                 for pk, parcel, row, column in Spot.objects.filter(pk__in=pks).values_list('pk', 'parcel', 'row', 'column')}
+    deeds = Deed.spots.through.objects.filter(spot__in=pks)
+    gather(documents, deeds.values_list('spot', 'deed__number', 'deed__year'))
+    gather(documents, deeds.values_list('spot', 'deed__owners__name'))
+    gather(documents, deeds.values_list('spot', 'deed__receipts__number', 'deed__receipts__year'))
+    operation_types = choice_labels(Operation.TYPE_CHOICES)
+    gather(documents, ((spot_pk, operation_types[type])
+                       for spot_pk, type in Operation.objects.filter(spot__in=pks).values_list('spot', 'type')))
+    construction_types = choice_labels(Construction.TYPE_CHOICES)
+    gather(documents, ((spot_pk, construction_types.get(type), company)
+                       for spot_pk, type, company in Construction.spots.through.objects.filter(spot__in=pks)
+                       .values_list('spot', 'construction__type', 'construction__company__name')))
+    return documents
+
+
+def deed_documents(pks: List[int]) -> Dict[int, list]:
+    cancel_reasons = choice_labels(Deed.CANCEL_REASON_CHOICES)
+    documents = {pk: [number, year, cancel_reasons.get(cancel_reason)]
+                 for pk, number, year, cancel_reason
+                 in Deed.objects.filter(pk__in=pks).values_list('pk', 'number', 'year', 'cancel_reason')}
+    gather(documents, ((deed_pk, spot_str(parcel, row, column))
+                       for deed_pk, parcel, row, column in Deed.spots.through.objects.filter(deed__in=pks)
+                       .values_list('deed', 'spot__parcel', 'spot__row', 'spot__column')))
+    gather(documents, Owner.deeds.through.objects.filter(deed__in=pks).values_list('deed', 'owner__name'))
+    gather(documents, OwnershipReceipt.objects.filter(deed__in=pks).values_list('deed', 'number', 'year'))
+    return documents
+
+
+def owner_documents(pks: List[int]) -> Dict[int, list]:
+    documents = {pk: [name, phone, address, city]
+                 for pk, name, phone, address, city
+                 in Owner.objects.filter(pk__in=pks).values_list('pk', 'name', 'phone', 'address', 'city')}
+    deeds = Owner.deeds.through.objects.filter(owner__in=pks)
+    gather(documents, deeds.values_list('owner', 'deed__number', 'deed__year'))
+    gather(documents, ((owner_pk, spot_str(parcel, row, column))
+                       for owner_pk, parcel, row, column
+                       in deeds.values_list('owner', 'deed__spots__parcel', 'deed__spots__row', 'deed__spots__column')))
+    construction_types = choice_labels(Construction.TYPE_CHOICES)
+    gather(documents, ((owner_pk, construction_types.get(type))
+                       for owner_pk, type in Construction.objects.filter(owner_builder__in=pks)
+                       .values_list('owner_builder', 'type')))
+    return documents
+
+
+def operation_documents(pks: List[int]) -> Dict[int, list]:
+    types = choice_labels(Operation.TYPE_CHOICES)
+    # (no note: operations aren't Annotatable, searching it only raised a FieldError)
+    documents = {pk: [types[type], date.isoformat(), deceased, report, brought_from, spot_str(parcel, row, column)]
+                 for pk, type, date, deceased, report, brought_from, parcel, row, column
+                 in Operation.objects.filter(pk__in=pks).values_list(
+                     'pk', 'type', 'date', 'deceased', 'exhumation_written_report', 'remains_brought_from',
+                     'spot__parcel', 'spot__row', 'spot__column')}
+    gather(documents, Operation.objects.filter(pk__in=pks).values_list('pk', 'spot__deeds__owners__name'))
+    return documents
+
+
+# the searchable models, each with what computes the documents (as lists of words) of some of its entities
+DOCUMENTS = OrderedDict([
+    (Spot,      spot_documents),
+    (Deed,      deed_documents),
+    (Owner,     owner_documents),
+    (Operation, operation_documents),
+])
+
+
+def search_table_name(model) -> str:
+    return f'{model._meta.db_table}_search'
+
+
+def search_table(model) -> str:
+    return connection.ops.quote_name(search_table_name(model))
+
+
+def write_documents(model, pks: Iterable[int]):
+    """ replaces the documents of the given `model` entities, QUERY_CHUNK at a time (the deleted ones just lose it) """
+    table = search_table(model)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for some_pks in chunks(sorted(set(pks)), QUERY_CHUNK):
+            cursor.execute(f'DELETE FROM {table} WHERE rowid IN ({", ".join(["%s"] * len(some_pks))})', some_pks)
+            cursor.executemany(f'INSERT INTO {table} (rowid, document) VALUES (%s, %s)',
+                               [(pk, ' '.join(str(word) for word in words))
+                                for pk, words in DOCUMENTS[model](some_pks).items()])
+
+
+def rebuild_search_index() -> int:
+    """ writes the document of every searchable entity from scratch, returns how many """
+    n_documents = 0
+    with transaction.atomic():
+        for model in DOCUMENTS:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {search_table(model)}')
+            pks = list(model.objects.order_by().values_list('pk', flat=True))
+            write_documents(model, pks)
+            n_documents += len(pks)
+    return n_documents
+
+
+"""
+Tables
+"""
+
+def search_tables(models) -> List[str]:
+    """ the search tables of the indexed `models`, if the database has them """
+    return [search_table_name(model) for model in DOCUMENTS if model in models] if search_available() else []
+
+
+def search_available() -> bool:
+    """ whether the database has the search tables (checked once per database) """
+    name = connection.settings_dict['NAME']
+    if name not in _available:
+        tables = connection.introspection.table_names() if connection.vendor == 'sqlite' else []
+        _available[name] = all(search_table_name(model) in tables for model in DOCUMENTS)
+    return _available[name]
+
+
+def create_search_tables() -> bool:
+    """
+    Creates the search tables (when they're missing, indexing what's already there), if the database can have them:
+    sqlite, compiled with FTS5 (the tables are not models, `migrate` creates them through `post_migrate`)
+    """
+    _available.pop(connection.settings_dict['NAME'], None)
+    if connection.vendor != 'sqlite' or search_available():
+        return search_available()
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in DOCUMENTS:
+                cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {search_table(model)} '
+                               f'USING fts5(document, tokenize="{TOKENIZER}")')
+    except OperationalError:  # no FTS5 (or no remove_diacritics 2, before sqlite 3.27)
+        return False
+    _available[connection.settings_dict['NAME']] = True
+    rebuild_search_index()
+    return True
+
+
+def search_tables_migrated(sender, **kwargs):
+    if sender.name == 'cemetery':
+        create_search_tables()
+
+
+"""
+Searching
+"""
+
+def match_expression(search_term: str) -> Optional[str]:
+    """
+    FTS5 query for the documents having every word of `search_term` (as the admin's search requires)
+    at the beginning of one of theirs, None if there are no words to search. Inside a word,
+    punctuation separates the terms of a phrase: "A-1-2" finds the spot A-1-2 (and A-1-20)
+
+    Examples:
+        >>> match_expression('Popescu ion')
+        '"Popescu"* "ion"*'
+        >>> match_expression('A-1-2 12/1995')
+        '"A 1 2"* "12 1995"*'
+        >>> match_expression(' - ') is None
+        True
+    """
+    phrases = [' '.join(re.findall(r'\w+', word)) for word in search_term.split()]
+    return ' '.join(f'"{phrase}"*' for phrase in phrases if phrase) or None
+
+
+def search(queryset: QuerySet, search_term: str) -> Optional[QuerySet]:
+    """ the entities of `queryset` matching `search_term`, None if they can't be searched this way """
+    model, match = queryset.model, match_expression(search_term)
+    if model not in DOCUMENTS or match is None or not search_available():
+        return None
+    table, quote = search_table(model), connection.ops.quote_name
+    pk_column = f'{quote(model._meta.db_table)}.{quote(model._meta.pk.column)}'
+    # (a subquery filter, `pk__in`, would be parenthesized twice, which sqlite reads as a list of its first row)
+    return queryset.extra(where=[f'{pk_column} IN (SELECT rowid FROM {table} WHERE {table} MATCH %s)'], params=[match])
+
+
+"""
+Marking
+"""
+
+def affected(spots: Set[int], deeds: Set[int], owners: Set[int], operations: Set[int],
+             constructions: Set[int]) -> Dict[type, Set[int]]:
+    """
+    The marked entities and those whose documents show them: spots show their deeds (with their owners and
+    receipts) and constructions, deeds their spots and owners, owners their deeds (with their spots)
+    and operations their spot (with the owners of its deeds)
+    """
+    spot_pks = spots | related_pks(Construction._meta.get_field('spots'), constructions)
+    owners_deed_pks = related_pks(Owner._meta.get_field('deeds'), owners)
+    spots_deed_pks = related_pks(Spot._meta.get_field('deeds'), spot_pks)
+    spot_pks |= related_pks(Deed._meta.get_field('spots'), deeds | owners_deed_pks)
+    operation_pks = set()
+    for some_pks in chunks(sorted(spot_pks), QUERY_CHUNK):
+        operation_pks.update(Operation.objects.filter(spot__in=some_pks).values_list('pk', flat=True))
+    return {
+        Spot:      spot_pks,
+        Deed:      deeds | owners_deed_pks | spots_deed_pks,
+        Owner:     owners | related_pks(Deed._meta.get_field('owners'), deeds | spots_deed_pks),
+        Operation: operations | operation_pks,
+    }
+
+
+def index_marked(marks: Dict[str, Set[int]]):
+    if search_available():
+        with transaction.atomic():
+            for model, pks in affected(**marks).items():
+                write_documents(model, pks)
+
+
+def reindex():
+    if search_available():
+        rebuild_search_index()
+
+
+marking = Marking('search', index_marked, reindex,
+                  models={Spot: 'spots', Deed: 'deeds', Owner: 'owners', Operation: 'operations',
+                          Construction: 'constructions'},
+                  # the entities whose documents show (some of) a child's fields, by the foreign key to them
+                  parents={Operation:        ('spot_id', 'spots'),
+                           OwnershipReceipt: ('deed_id', 'deeds'),
+                           Construction:     ('owner_builder_id', 'owners')})
+
+
+def updating_search_afterwards(rebuild: bool = False):
+    """ the documents of what changes during the block are written once, when it ends (see `Marking.afterwards`) """
+    return marking.afterwards(rebuild)
+
+
+def mark_changed(spots: Iterable[int] = (), deeds: Iterable[int] = (), owners: Iterable[int] = (),
+                 operations: Iterable[int] = (), constructions: Iterable[int] = ()):
+    """ the documents of these entities (and of the ones showing them) need to be written again """
+    marking.mark(spots=spots, deeds=deeds, owners=owners, operations=operations, constructions=constructions)
+
+
+def mark_written(model, pks: Iterable[int]):
+    """ `mark_changed` for entities of any `model` that were inserted or related without signals (eg: in bulk) """
+    marking.mark_written(model, pks)
+
+
+"""
+Signals
+"""
+
+def company_saved(sender, instance, **kwargs):
+    mark_changed(constructions=instance.constructions.values_list('pk', flat=True))
+
+
+def losing(instance) -> dict:
+    """ the marks for what shows `instance`, once it's deleted (its relations go without m2m_changed) """
+    if isinstance(instance, Spot):
+        return {'spots': [instance.pk], 'deeds': related_pks(Spot._meta.get_field('deeds'), [instance.pk])}
+    if isinstance(instance, Deed):
+        return {'deeds': [instance.pk], 'spots': related_pks(Deed._meta.get_field('spots'), [instance.pk]),
+                'owners': related_pks(Deed._meta.get_field('owners'), [instance.pk])}
+    if isinstance(instance, Owner):
+        return {'owners': [instance.pk], 'deeds': related_pks(Owner._meta.get_field('deeds'), [instance.pk])}
+    if isinstance(instance, Operation):
+        return {'operations': [instance.pk]}
+    return {'spots': related_pks(Construction._meta.get_field('spots'), [instance.pk])}
+
+
+post_migrate.connect(search_tables_migrated, dispatch_uid='search_tables_migrated')
+post_save.connect(company_saved, sender=Company, dispatch_uid='search_company_saved')
+
+marking.connect(losing, deleted=[Spot, Deed, Owner, Operation, Construction])
+marking.connect_relation(Deed._meta.get_field('spots'), 'deeds', 'spots')
+marking.connect_relation(Owner._meta.get_field('deeds'), 'owners', 'deeds')
+marking.connect_relation(Construction._meta.get_field('spots'), None, 'spots')
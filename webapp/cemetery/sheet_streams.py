@@ -0,0 +1,131 @@
+from typing import Dict, Iterator, List, Any
+from collections import namedtuple
+from itertools import islice
+from zipfile import ZipFile, is_zipfile
+
+import pandas as pd
+from openpyxl import load_workbook
+
+
+"""
+Streaming readers: each sheet of a document as an iterator of small DataFrames (chunks), so that memory use
+doesn't grow with the size of the document (see `model_parsers.parse_file`)
+
+Two kinds of documents can be streamed:
+    - excel workbooks (.xlsx), read row by row
+    - zip archives with a csv export of each sheet, named after it (eg: Operatii.csv)
+"""
+
+CHUNK_SIZE = 1000  # rows
+
+SheetStream = namedtuple('SheetStream', 'chunks n_rows')
+"""
+    chunks (Iterator<pd.DataFrame>): consecutive rows of the sheet, columns named after its header
+    n_rows (int): how many rows there are in total, None if it's not known before reading them all
+"""
+
+
+def is_csv_archive(file) -> bool:
+    """ zip archive that isn't an excel workbook (which is also a zip archive) """
+    try:
+        if not is_zipfile(file):
+            return False
+        file.seek(0)
+        return '[Content_Types].xml' not in ZipFile(file).namelist()
+    finally:
+        file.seek(0)  # ready to be read again
+
+
+def records(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    The rows of `frame` as plain dicts, built from its columns (much cheaper than the Series `iterrows` makes)
+
+    Examples:
+        >>> records(pd.DataFrame([[1, 'a'], [2, None]], columns=['number', 'name']))
+        [{'number': 1, 'name': 'a'}, {'number': 2, 'name': None}]
+    """
+    columns = list(frame.columns)
+    values = [frame.iloc[:, i].tolist() for i in range(len(columns))]  # python scalars, eg: int instead of np.int64
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def chunk_frames(rows: Iterator[tuple], columns: List[str], chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    >>> [len(chunk) for chunk in chunk_frames(iter([(1, 2)] * 5), ['a', 'b'], chunk_size=2)]
+    [2, 2, 1]
+    """
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield pd.DataFrame.from_records(chunk, columns=columns)
+
+
+def without_trailing_blanks(rows: Iterator[tuple]) -> Iterator[tuple]:
+    """
+    Drops the empty rows at the end of the sheet (eg: formatted, but never filled), like `pd.read_excel` does
+
+    Examples:
+        >>> list(without_trailing_blanks(iter([(1,), (None,), (2,), (None,), (None,)])))
+        [(1,), (None,), (2,)]
+    """
+    blanks = []
+    for row in rows:
+        if all(value is None for value in row):
+            blanks.append(row)
+        else:
+            yield from blanks
+            blanks = []
+            yield row
+
+
+def header_names(header: tuple) -> List[str]:
+    """
+    >>> header_names(('Act', None))
+    ['Act', 'Unnamed: 1']
+    """
+    return [name if name is not None else f'Unnamed: {i}' for i, name in enumerate(header)]  # like pandas
+
+
+def stream_xlsx_sheet(workbook, sheet_name: str, chunk_size: int) -> SheetStream:
+    if sheet_name not in workbook.sheetnames:
+        raise KeyError(f'No sheet named {sheet_name}')
+    worksheet = workbook[sheet_name]
+
+    def chunks():
+        rows = (tuple(cell.value for cell in row) for row in worksheet.iter_rows())
+        header = next(rows, ())
+        # without dimensions in the file (eg: written by openpyxl in write-only mode), rows end at their last value
+        rows = (row + (None,) * (len(header) - len(row)) for row in rows)
+        yield from chunk_frames(without_trailing_blanks(rows), header_names(header), chunk_size)
+
+    n_rows = worksheet.max_row - 1 if worksheet.max_row else None  # from the sheet's dimensions, minus the header
+    return SheetStream(chunks(), n_rows)
+
+
+def stream_csv_sheet(archive: ZipFile, sheet_name: str, chunk_size: int) -> SheetStream:
+    member = sheet_name + '.csv'
+    if member not in archive.namelist():
+        raise KeyError(f'No sheet named {sheet_name}')
+
+    def chunks():
+        with archive.open(member) as csv_file:
+            # read everything as text (like excel shows it), eg: leading zeros in phone numbers are kept
+            yield from pd.read_csv(csv_file, dtype=str, encoding='utf-8', chunksize=chunk_size)
+
+    return SheetStream(chunks(), None)
+
+
+def stream_workbook(file, sheet_names: List[str], chunk_size: int = CHUNK_SIZE) -> Dict[str, SheetStream]:
+    """ each of the sheets, read lazily (nothing is read until its chunks are iterated) """
+    if is_csv_archive(file):
+        archive = ZipFile(file)
+        return {name: stream_csv_sheet(archive, name, chunk_size) for name in sheet_names}
+
+    workbook = load_workbook(file, read_only=True, data_only=True)  # data_only: values, not formulas
+    return {name: stream_xlsx_sheet(workbook, name, chunk_size) for name in sheet_names}
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,164 @@
+from typing import Iterable, Set, List, Dict
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Max, Count
+
+from .models import Spot, Deed, Owner, Operation, Construction, PaymentUnit, Maintenance, SpotSummary, \
+    unkept_year_subquery
+from .key_maps import through_columns
+from .pending_marks import Marking
+from .utils import chunks, QUERY_CHUNK
+
+
+"""
+Keeps `SpotSummary` (one row per spot) up to date: saving or deleting anything a summary is derived from
+marks the spots concerned, which are then summarized again, right away or, inside `updating_summaries_afterwards`
+(eg: during an import), once for the whole block (see `pending_marks.py`). The deeds and owners marked
+are only resolved to their spots when summarizing
+"""
+
+
+"""
+Summarizing
+"""
+
+def grouped(queryset, column: str, aggregate) -> dict:
+    """ `column` value ~> `aggregate` over the rows of `queryset` with that value """
+    return dict(queryset.order_by().values(column).annotate(value=aggregate).values_list(column, 'value'))
+
+
+def compute_summaries(spot_pks: List[int]) -> List[SpotSummary]:
+    """
+    The summaries of the given spots (the ones that still exist), with a fixed number of queries,
+    of plain values: the relations of a few hundred spots are too many to make into entities
+    """
+    spots = Spot.objects.filter(pk__in=spot_pks).order_by().annotate(unkept_year=unkept_year_subquery())\
+        .values_list('pk', 'parcel', 'row', 'column', 'unkept_year')
+    spot_strs, unkept_years = {}, {}
+    for pk, parcel, row, column, year in spots:
+        spot_strs[pk] = str(Spot(parcel=parcel, row=row, column=column))
+        unkept_years[pk] = year
+
+    deeds = defaultdict(list)  # spot pk ~> pks of its active deeds, ordered as deeds are
+    for spot_pk, deed_pk in Deed.spots.through.objects.filter(spot__in=spot_pks, deed__cancel_reason__isnull=True)\
+            .order_by(*('deed__' + f for f in Deed._meta.ordering)).values_list('spot', 'deed'):
+        deeds[spot_pk].append(deed_pk)
+    shown_deeds = {deed_pks[0] for deed_pks in deeds.values()}  # the first ones, that the spot list shows
+    owners = defaultdict(list)  # deed pk ~> names of its owners
+    for deed_pk, name in Owner.deeds.through.objects.filter(deed__in=shown_deeds)\
+            .order_by('owner__name').values_list('deed', 'owner__name'):
+        owners[deed_pk].append(name)
+    deed_spots = defaultdict(list)  # deed pk ~> its spots (pk, str), ordered as spots are
+    for deed_pk, spot_pk, parcel, row, column in Deed.spots.through.objects.filter(deed__in=shown_deeds)\
+            .order_by(*('spot__' + f for f in Spot._meta.ordering))\
+            .values_list('deed', 'spot', 'spot__parcel', 'spot__row', 'spot__column'):
+        deed_spots[deed_pk].append((spot_pk, str(Spot(parcel=parcel, row=row, column=column))))
+
+    last_paid_years = grouped(PaymentUnit.objects.filter(spot__in=spot_pks), 'spot', Max('year'))
+    n_operations    = grouped(Operation.objects.filter(spot__in=spot_pks), 'spot', Count('pk'))
+    n_constructions = grouped(Construction.spots.through.objects.filter(spot__in=spot_pks), 'spot', Count('pk'))
+
+    summaries = []
+    for spot_pk in spot_strs:
+        deed_pk = deeds[spot_pk][0] if deeds[spot_pk] else None
+        names = owners[deed_pk]
+        summaries.append(SpotSummary(
+            spot_id=spot_pk,
+            active_deed_id=deed_pk,
+            n_active_deeds=len(deeds[spot_pk]),
+            active_owners=', '.join(names),
+            first_active_owner=names[0] if names else None,
+            shares_deed_with=', '.join(other_str for other_pk, other_str in deed_spots[deed_pk] if other_pk != spot_pk),
+            n_operations=n_operations.get(spot_pk, 0),
+            n_constructions=n_constructions.get(spot_pk, 0),
+            last_paid_year=last_paid_years.get(spot_pk),
+            unkept_since=unkept_years[spot_pk]))
+    return summaries
+
+
+def summarize(spot_pks: Iterable[int]):
+    """ replaces the summaries of the given spots, QUERY_CHUNK spots at a time (the deleted ones just lose it) """
+    with transaction.atomic():
+        for some_pks in chunks(sorted(set(spot_pks)), QUERY_CHUNK):
+            SpotSummary.objects.filter(spot__in=some_pks).delete()
+            SpotSummary.objects.bulk_create(compute_summaries(some_pks))
+
+
+def rebuild_summaries() -> int:
+    """ summarizes every spot from scratch, returns how many """
+    with transaction.atomic():
+        SpotSummary.objects.all().delete()
+        spot_pks = list(Spot.objects.order_by().values_list('pk', flat=True))
+        summarize(spot_pks)
+    return len(spot_pks)
+
+
+"""
+Marking
+"""
+
+def related_pks(field, pks: Iterable[int]) -> Set[int]:
+    """ pks of what the entities with `pks` are related to through the many-to-many `field` (forward or reverse) """
+    through, source, target = through_columns(field)
+    related = set()
+    for some_pks in chunks(list(pks), QUERY_CHUNK):
+        related.update(through.objects.filter(**{source + '__in': some_pks}).values_list(target, flat=True))
+    return related
+
+
+def affected_spots(spots: Set[int], deeds: Set[int], owners: Set[int]) -> Set[int]:
+    """
+    The marked spots, the spots of the marked deeds and owners,
+    and those sharing a deed with any of them (their `shares_deed_with` shows the others)
+    """
+    deed_pks = deeds | related_pks(Owner._meta.get_field('deeds'), owners) \
+                     | related_pks(Spot._meta.get_field('deeds'), spots)
+    return spots | related_pks(Deed._meta.get_field('spots'), deed_pks)
+
+
+def summarize_marked(marks: Dict[str, Set[int]]):
+    summarize(affected_spots(**marks))
+
+
+marking = Marking('summary', summarize_marked, rebuild_summaries,
+                  models={Spot: 'spots', Deed: 'deeds', Owner: 'owners'},
+                  parents={model: ('spot_id', 'spots') for model in [PaymentUnit, Maintenance, Operation]})
+
+
+def updating_summaries_afterwards(rebuild: bool = False):
+    """ the summaries of what changes during the block are updated once, when it ends (see `Marking.afterwards`) """
+    return marking.afterwards(rebuild)
+
+
+def mark_changed(spots: Iterable[int] = (), deeds: Iterable[int] = (), owners: Iterable[int] = ()):
+    """ the summaries of these spots (and of the spots of these deeds and owners) need to be updated """
+    marking.mark(spots=spots, deeds=deeds, owners=owners)
+
+
+def mark_written(model, pks: Iterable[int]):
+    """ `mark_changed` for entities of any `model` that were inserted or related without signals (eg: in bulk) """
+    marking.mark_written(model, pks)
+
+
+"""
+Signals
+"""
+
+def spots_losing(instance) -> Dict[str, Set[int]]:
+    """ the spots whose summary changes when `instance` is deleted (its relations go without m2m_changed) """
+    if isinstance(instance, Spot):
+        # the other spots on its deeds, and its own summary: the signals of its cascading children
+        # (eg: maintenances) summarize it again before it's gone, so it's deleted once it is
+        deed_pks = related_pks(Spot._meta.get_field('deeds'), [instance.pk])
+        return {'spots': related_pks(Deed._meta.get_field('spots'), deed_pks) | {instance.pk}}
+    if isinstance(instance, Owner):
+        deed_pks = related_pks(Owner._meta.get_field('deeds'), [instance.pk])
+        return {'spots': related_pks(Deed._meta.get_field('spots'), deed_pks)}
+    return {'spots': related_pks(instance._meta.get_field('spots'), [instance.pk])}  # deed, construction
+
+
+marking.connect(spots_losing, deleted=[Spot, Deed, Owner, Construction])
+marking.connect_relation(Deed._meta.get_field('spots'), 'deeds', 'spots')
+marking.connect_relation(Owner._meta.get_field('deeds'), 'owners', 'deeds')
+marking.connect_relation(Construction._meta.get_field('spots'), None, 'spots')
@@ -1,24 +1,28 @@
 document.addEventListener("DOMContentLoaded", function() {
-    var tabs     = document.getElementsByClassName('changeform-tabs-item')
-    var contents = document.getElementsByClassName('module')
-
-    for (var selectedIndex = 0; selectedIndex < tabs.length; selectedIndex++)
-        tabs[selectedIndex].onclick = function (selectedIndex) {
-            return function() {
-                console.log('clicked', selectedIndex)
+    var progress = document.getElementById('import-progress')
+    if (progress)
+        pollImportProgress(progress)
+})
 
-                // remove 'selected' class from all tabs and contents
-                for (var i = 0; i < tabs.length; i++) {
-                    tabs    [i].classList.remove('selected')
-                    contents[i].classList.remove('selected')
-                }
+function pollImportProgress(list) {
+    var request = new XMLHttpRequest()
+    request.open('GET', list.dataset.url)
+    request.onload = function() {
+        var job = JSON.parse(request.responseText)
+        if (job.finished)
+            return window.location.reload()
 
-                // set 'selected' only desired tab and content
-                tabs    [selectedIndex].classList.add('selected')
-                contents[selectedIndex].classList.add('selected')
-            }
-        }(selectedIndex)
-})
+        list.innerHTML = ''
+        for (var sheetName in job.progress) {
+            var item = document.createElement('li')
+            var total = job.progress[sheetName][1] === null ? '?' : job.progress[sheetName][1]  // csv archives
+            item.textContent = sheetName + ': ' + job.progress[sheetName][0] + ' / ' + total
+            list.appendChild(item)
+        }
+        setTimeout(function() { pollImportProgress(list) }, 1000)
+    }
+    request.send()
+}
 
 function askConfirmationIfWiping() {
     var wiping_checked = document.forms.import.wipe_beforehand.checked
@@ -26,15 +30,4 @@ function askConfirmationIfWiping() {
         // TODO: internationalization https://docs.djangoproject.com/en/1.11/topics/i18n/translation/#internationalization-in-javascript-code
         return confirm('Are you sure you want to delete everything from the database before importing?')
     return true
-}
-
-function toggleStatus(box, status) {
-    var checkboxes = document.querySelectorAll('.status-toggler.' + status + ' input[type="checkbox"]')
-    for (var i = 0; i < checkboxes.length; i++)
-        checkboxes[i].checked = box.checked
-
-    var rows = document.getElementsByClassName('toggleable-row ' + status)
-    var display = box.checked ? 'table-row' : 'none'
-    for (i = 0; i < rows.length; i++)
-        rows[i].style.display = display
 }
\ No newline at end of file
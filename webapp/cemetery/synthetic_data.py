@@ -0,0 +1,418 @@
+from typing import Optional, Dict, List, Iterator, Any
+from collections import namedtuple, OrderedDict, defaultdict
+from datetime import date, timedelta
+from string import ascii_uppercase
+from zipfile import ZipFile, ZIP_DEFLATED
+from tempfile import TemporaryDirectory
+import csv
+import os
+import random
+
+from django.db import connections, router, transaction
+
+from .models import Spot, Deed, OwnershipReceipt, Owner, Operation, Company, Construction, Authorization, \
+    PaymentReceipt, PaymentUnit, Maintenance
+from .model_parsers import MODELS_METADATA, operation_type_translations, deed_cancel_reason_translations, \
+    construction_type_translations
+from .utils import reverse_dict, relation_signature
+
+
+"""
+Synthetic cemeteries, for load and scale testing: a realistic (seeded) dataset of any size, generated a block of spots
+at a time, with every entity getting its pk up front so it can all be written with bulk inserts.
+The same data can be written as an import document as well (see `WorkbookWriter`)
+"""
+
+BLOCK_SPOTS = 5000  # spots generated (and inserted) at a time
+ROWS_PER_PARCEL, COLUMNS_PER_ROW = 40, 40
+
+FIRST_YEAR, LAST_YEAR = 1960, 2017
+
+FIRST_NAMES = ['Ion', 'Vasile', 'Gheorghe', 'Constantin', 'Nicolae', 'Mihai', 'Dumitru', 'Alexandru', 'Ștefan',
+               'Florin', 'Marian', 'Adrian', 'Cristian', 'Andrei', 'Ilie', 'Petre', 'Radu', 'Toma', 'Grigore', 'Aurel',
+               'Maria', 'Elena', 'Ioana', 'Ana', 'Mihaela', 'Gabriela', 'Florica', 'Rodica', 'Viorica', 'Cristina',
+               'Daniela', 'Georgeta', 'Lucia', 'Aurelia', 'Ecaterina', 'Tudora', 'Paraschiva', 'Angela', 'Doina',
+               'Silvia']
+LAST_NAMES = ['Popescu', 'Ionescu', 'Popa', 'Pop', 'Niculescu', 'Dumitru', 'Stan', 'Stoica', 'Gheorghe', 'Rusu',
+              'Munteanu', 'Matei', 'Constantin', 'Ciobanu', 'Moldovan', 'Lungu', 'Marin', 'Tudor', 'Dinu', 'Ene',
+              'Vasilescu', 'Florea', 'Dobre', 'Barbu', 'Nistor', 'Toma', 'Oprea', 'Diaconu', 'Zamfir', 'Neagu',
+              'Sandu', 'Radu', 'Mocanu', 'Manole', 'Preda', 'Bălan', 'Țurcanu', 'Șerban', 'Voicu', 'Ardeleanu']
+CITIES = ['București', 'Ploiești', 'Brașov', 'Pitești', 'Târgoviște', 'Buzău', 'Craiova', 'Iași', 'Cluj', 'Constanța']
+STREETS = ['Florilor', 'Libertății', 'Unirii', 'Morii', 'Bisericii', 'Păcii', 'Teilor', 'Viilor', 'Gării', 'Școlii']
+COMPANY_WORDS = ['Beto', 'Marmura', 'Granit', 'Piatra', 'Constructii', 'Monumente', 'Funerare', 'Cavouri', 'Lespezi',
+                 'Mozaic']
+COMPANY_SUFFIXES = ['Srl', 'Sa', 'Pfa']
+
+Block = namedtuple('Block', 'entities relations rows')
+"""
+    entities (OrderedDict<Model: list<Model>>): new entities of each model, with their pks set, parents first
+    relations (dict<Model: list<Model>>): many-to-many through entities, by through model
+    rows (dict<str: list<list>>): import document rows for the same entities, by sheet name (see `WorkbookWriter`)
+"""
+
+
+def unique_name(index: int, first_names: List[str] = FIRST_NAMES, last_names: List[str] = LAST_NAMES) -> str:
+    """
+    A different name for each index: a first and last name, then a middle name, then a double last name
+
+    Examples:
+        >>> unique_name(0)
+        'Ion Popescu'
+        >>> unique_name(len(FIRST_NAMES) * len(LAST_NAMES))
+        'Ion Ion Popescu'
+    """
+    first, rest = first_names[index % len(first_names)], index // len(first_names)
+    last, rest = last_names[rest % len(last_names)], rest // len(last_names)
+    if not rest:
+        return f'{first} {last}'
+    middle, rest = first_names[(rest - 1) % len(first_names)], (rest - 1) // len(first_names)
+    if not rest:
+        return f'{first} {middle} {last}'
+    return f'{first} {middle} {last}-{last_names[(rest - 1) % len(last_names)]}'
+
+
+def parcel_name(index: int) -> str:
+    """
+    >>> [parcel_name(i) for i in [0, 25, 26]]
+    ['A', 'Z', 'A1']
+    """
+    return ascii_uppercase[index % 26] + (str(index // 26) if index >= 26 else '')
+
+
+def row_name(number: int) -> str:
+    """ a few rows are squeezed in between others, eg: 17bis, 23A """
+    if number % 17 == 0:
+        return f'{number}bis'
+    if number % 23 == 0:
+        return f'{number}A'
+    return str(number)
+
+
+def spot_str(spot: Spot) -> str:
+    return f'{spot.parcel}-{spot.row}-{spot.column}'
+
+
+def nr_year_str(entity) -> str:
+    return f'{entity.number}/{entity.year}'
+
+
+def join(values) -> str:
+    return ','.join(map(str, values))
+
+
+def written_phone(phone: Optional[str]) -> Optional[str]:
+    """
+    Written like people do, digits only would be read back as a number (without the leading 0)
+
+    Examples:
+        >>> written_phone('0722123456')
+        '0722 123 456'
+    """
+    if phone is None:
+        return None
+    return f'{phone[:4]} {phone[4:7]} {phone[7:]}'
+
+
+class SyntheticCemetery:
+    """
+    Generates `n_spots` spots and everything around them, in blocks (see `blocks`)
+
+    Distributions (per spot, roughly):
+        - one deed (on one to three neighbouring spots), some with an older cancelled one as well,
+            a few spots with two active deeds, a few with none
+        - one or two owners per deed, some owning several deeds
+        - up to three burials, some followed by an exhumation
+        - a construction on about half of them (some spanning two spots, a few spots with two of the same type),
+            built by a company or by one of the owners (a few by both)
+        - payments for the last few years, grouped in receipts (some left unpaid) and maintenance checks
+    """
+    def __init__(self, n_spots: int, seed: int = 0, block_spots: int = BLOCK_SPOTS):
+        self.n_spots = n_spots
+        self.block_spots = block_spots
+        self.random = random.Random(seed)
+        self.last_pks = defaultdict(int)  # model ~> pk given to its last entity
+        self.last_numbers = defaultdict(int)  # (model, year) ~> number given to its last entity that year
+        self.n_companies = max(3, n_spots // 500)
+        self.companies = []
+
+    def new(self, model, **fields):
+        self.last_pks[model] += 1
+        return model(pk=self.last_pks[model], **fields)
+
+    def new_nr_year(self, model, year: int, **fields):
+        self.last_numbers[model, year] += 1
+        return self.new(model, number=self.last_numbers[model, year], year=year, **fields)
+
+    def year(self, after: int = FIRST_YEAR) -> int:
+        return self.random.randint(min(after, LAST_YEAR), LAST_YEAR)
+
+    def day(self, year: int) -> date:
+        return date(year, 1, 1) + timedelta(days=self.random.randrange(365))
+
+    def blocks(self) -> Iterator[Block]:
+        yield self.companies_block()
+        for start in range(0, self.n_spots, self.block_spots):
+            yield self.spots_block(start, min(start + self.block_spots, self.n_spots))
+
+    def companies_block(self) -> Block:
+        for i in range(self.n_companies):
+            name = f'{COMPANY_WORDS[i % len(COMPANY_WORDS)]} {COMPANY_SUFFIXES[i // len(COMPANY_WORDS) % 3]}'
+            if i >= len(COMPANY_WORDS) * len(COMPANY_SUFFIXES):
+                name += f' {i // (len(COMPANY_WORDS) * len(COMPANY_SUFFIXES)) + 1}'
+            self.companies.append(self.new(Company, name=name))
+        return Block(OrderedDict([(Company, self.companies)]), {}, {})
+
+    def spots_block(self, start: int, end: int) -> Block:
+        rand = self.random
+        entities = OrderedDict((model, []) for model in [Spot, Owner, Deed, OwnershipReceipt, Operation, Construction,
+                                                         Authorization, PaymentReceipt, PaymentUnit, Maintenance])
+        relations = defaultdict(list)
+        rows = defaultdict(list)
+
+        spots = []
+        for i in range(start, end):
+            in_parcel = i % (ROWS_PER_PARCEL * COLUMNS_PER_ROW)
+            spots.append(self.new(Spot, parcel=parcel_name(i // (ROWS_PER_PARCEL * COLUMNS_PER_ROW)),
+                                  row=row_name(in_parcel // COLUMNS_PER_ROW + 1),
+                                  column=str(in_parcel % COLUMNS_PER_ROW + 1)))
+        entities[Spot] = spots
+
+        # ownership
+        owners = entities[Owner]
+        def deed(deed_spots: List[Spot], year: int, cancel_reason: str = None) -> Deed:
+            entity = self.new_nr_year(Deed, year, cancel_reason=cancel_reason)
+            entities[Deed].append(entity)
+            relations[Deed.spots.through] += [Deed.spots.through(deed_id=entity.pk, spot_id=s.pk) for s in deed_spots]
+
+            n_owners = 1 if rand.random() < .85 else 2  # shared deed
+            deed_owners = []
+            for _ in range(n_owners):
+                if owners and rand.random() < .1:  # owner of several deeds
+                    deed_owners.append(rand.choice(owners))
+                else:
+                    deed_owners.append(self.new_owner())
+                    owners.append(deed_owners[-1])
+            deed_owners = list(OrderedDict.fromkeys(deed_owners))
+            relations[Owner.deeds.through] += [Owner.deeds.through(owner_id=o.pk, deed_id=entity.pk)
+                                               for o in deed_owners]
+
+            receipts = [self.new_nr_year(OwnershipReceipt, self.year(year), deed_id=entity.pk,
+                                         value=rand.randrange(50, 500, 10))
+                        for _ in range(rand.choice([0, 1, 1, 1, 2]))]
+            entities[OwnershipReceipt] += receipts
+
+            rows['Acte concesiune'].append(self.row('Acte concesiune',
+                deed_id=nr_year_str(entity),
+                spots=join(map(spot_str, deed_spots)),
+                receipt_ids=join(map(nr_year_str, receipts)) or None,
+                values=join(int(r.value) for r in receipts) or None,
+                owners=join(o.name for o in deed_owners),
+                cancel_reason=reverse_dict(deed_cancel_reason_translations).get(cancel_reason)))
+            entity.spot_list, entity.owner_list = deed_spots, deed_owners  # for the constructions, below
+            return entity
+
+        active_deeds = {}  # spot ~> deed
+        i = 0
+        while i < len(spots):
+            deed_spots = spots[i:i + rand.choices([1, 2, 3], weights=[80, 15, 5])[0]]
+            i += len(deed_spots)
+            if rand.random() < .03:  # abandoned
+                continue
+            year = self.year()
+            if rand.random() < .08:  # the previous deed
+                deed(deed_spots, year, cancel_reason=rand.choice(list(deed_cancel_reason_translations.values())))
+                year = self.year(after=year)
+            active_deed = deed(deed_spots, year)
+            active_deeds.update({spot: active_deed for spot in deed_spots})
+            if rand.random() < .01:  # two active deeds, the second one on the first spot alone
+                deed(deed_spots[:1], self.year(after=year))
+
+        # burials and exhumations
+        for spot in spots:
+            for _ in range(rand.choices([0, 1, 2, 3], weights=[30, 40, 20, 10])[0]):
+                burial = self.new(Operation, type=Operation.BURIAL, deceased=self.name(), spot_id=spot.pk,
+                                  date=self.day(self.year()))
+                entities[Operation].append(burial)
+                if rand.random() < .05:
+                    entities[Operation].append(self.new(
+                        Operation, type=Operation.EXHUMATION, deceased=burial.deceased, spot_id=spot.pk,
+                        date=self.day(self.year(after=burial.date.year + 1)),
+                        exhumation_written_report=str(rand.randint(1, 999))))
+        for operation in entities[Operation]:
+            rows['Operatii'].append(self.row('Operatii',
+                type=reverse_dict(operation_type_translations)[operation.type],
+                deceased=operation.deceased,
+                spot=spot_str(spots[operation.spot_id - spots[0].pk]),
+                date=f'{operation.date:%d.%m.%Y}',
+                exhumation_written_report=operation.exhumation_written_report,
+                remains_brought_from=operation.remains_brought_from))
+
+        # constructions
+        construction_types = reverse_dict(construction_type_translations)
+        i = 0
+        while i < len(spots):
+            construction_spots = spots[i:i + (2 if rand.random() < .12 else 1)]
+            i += len(construction_spots)
+            if rand.random() > .45:
+                continue
+            types = [rand.choice([Construction.TOMB, Construction.TOMB, Construction.BORDER])]
+            if rand.random() < .01:
+                types.append(types[0])  # two of the same type
+            for construction_type in types:
+                owner = rand.choice(active_deeds[construction_spots[0]].owner_list) \
+                    if construction_spots[0] in active_deeds else None
+                builder = rand.choices(['company', 'owner', 'both', 'none'], weights=[60, 35, 2, 3])[0]
+                company = rand.choice(self.companies) if builder in ['company', 'both'] or owner is None else None
+                owner_builder = owner if builder in ['owner', 'both'] else None
+
+                construction = self.new(Construction, type=construction_type, company_id=getattr(company, 'pk', None),
+                                        owner_builder_id=getattr(owner_builder, 'pk', None),
+                                        spots_signature=relation_signature(s.pk for s in construction_spots))
+                entities[Construction].append(construction)
+                relations[Construction.spots.through] += [
+                    Construction.spots.through(construction_id=construction.pk, spot_id=s.pk)
+                    for s in construction_spots]
+
+                authorizations = []
+                if rand.random() < .5:
+                    authorizations.append(self.new_nr_year(Authorization, self.year(),
+                                                           construction_id=construction.pk))
+                    relations[Authorization.spots.through] += [
+                        Authorization.spots.through(authorization_id=authorizations[0].pk, spot_id=s.pk)
+                        for s in construction_spots]
+                entities[Authorization] += authorizations
+
+                rows['Constructii'].append(self.row('Constructii',
+                    type=construction_types[construction_type],
+                    spots=join(map(spot_str, construction_spots)),
+                    authorizations=join(map(nr_year_str, authorizations)) or None,
+                    owner_builder=getattr(owner_builder, 'name', None),
+                    company=getattr(company, 'name', None)))
+
+        # payments and maintenance, for the last few years
+        for spot in spots:
+            years = list(range(LAST_YEAR - rand.randint(0, 5) + 1, LAST_YEAR + 1))
+            value = rand.randrange(10, 100, 5)
+            while years:
+                n_paid = rand.randint(1, 3)
+                paid_years, years = years[:n_paid], years[n_paid:]
+                receipt = None
+                if rand.random() < .95:
+                    receipt = self.new_nr_year(PaymentReceipt, paid_years[-1])
+                    entities[PaymentReceipt].append(receipt)
+                    rows['Contributii'].append(self.row('Contributii',
+                        receipt_id=nr_year_str(receipt),
+                        spots=spot_str(spot),
+                        years=join(paid_years),
+                        values=join([value] * len(paid_years))))
+                entities[PaymentUnit] += [self.new(PaymentUnit, year=year, spot_id=spot.pk, value=value,
+                                                   receipt_id=getattr(receipt, 'pk', None)) for year in paid_years]
+
+            entities[Maintenance] += [self.new(Maintenance, year=year, spot_id=spot.pk, kept=rand.random() < .85)
+                                      for year in range(LAST_YEAR - rand.randint(0, 4) + 1, LAST_YEAR + 1)]
+
+        rows['Proprietari'] = [self.row('Proprietari', name=o.name, address=o.address, city=o.city,
+                                        phone=written_phone(o.phone)) for o in owners]
+        return Block(entities, relations, rows)
+
+    def name(self) -> str:
+        return f'{self.random.choice(FIRST_NAMES)} {self.random.choice(LAST_NAMES)}'
+
+    def phone(self) -> str:
+        """ digits only, as imports keep them (see `written_phone` for the sheets) """
+        return f'07{self.random.randrange(10 ** 8):08d}'
+
+    def new_owner(self) -> Owner:
+        rand = self.random
+        return self.new(Owner, name=unique_name(self.last_pks[Owner]),
+                        phone=self.phone() if rand.random() < .7 else None,
+                        address=f'Strada {rand.choice(STREETS)} {rand.randint(1, 150)}' if rand.random() < .8 else None,
+                        city=rand.choice(CITIES) if rand.random() < .9 else None)
+
+    @staticmethod
+    def row(sheet_name: str, **fields) -> List[Any]:
+        """ cells in the order of the sheet's columns (see `WorkbookWriter`) """
+        return [fields.get(field) for field in sheet_columns(sheet_name)]
+
+
+def sheet_columns(sheet_name: str) -> List[str]:
+    """ fields of the sheet's columns, in order """
+    [metadata] = [m for m in MODELS_METADATA if m.sheet_name == sheet_name]
+    return list(metadata.column_renames)
+
+
+def insert(model, entities: list):
+    """
+    Inserts `entities` (pks included) with a single prepared statement: what `bulk_create` does,
+    minus building the SQL of every batch of entities, which takes longer than running it
+    """
+    db = connections[router.db_for_write(model)]
+    fields = model._meta.concrete_fields
+    table, columns = model._meta.db_table, [db.ops.quote_name(f.column) for f in fields]
+    rows = [[f.get_db_prep_save(getattr(entity, f.attname), db) for f in fields] for entity in entities]
+    with db.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {db.ops.quote_name(table)} ({", ".join(columns)}) '
+                           f'VALUES ({", ".join(["%s"] * len(columns))})', rows)
+
+
+def save_block(block: Block):
+    """ bulk inserts everything in the block, in one transaction """
+    with transaction.atomic():
+        for model, entities in list(block.entities.items()) + list(block.relations.items()):
+            if entities:
+                insert(model, entities)
+
+
+class WorkbookWriter:
+    """
+    Writes the sheets of an import document a few rows at a time (see `append`), as
+        - an excel workbook (.xlsx), like the one users upload
+        - a zip archive of csv exports of each sheet (.zip), which can hold more than an excel sheet's row limit
+    """
+    XLSX_MAX_ROWS = 1048576
+
+    def __init__(self, path: str):
+        self.path = path
+        self.n_rows = defaultdict(int)
+        self.csv_dir = TemporaryDirectory()
+        self.files = OrderedDict()
+        for metadata in MODELS_METADATA:  # the sheets are written in full, one by one, when closing
+            file = open(os.path.join(self.csv_dir.name, metadata.sheet_name + '.csv'), 'w', newline='', encoding='utf-8')
+            csv.writer(file).writerow(metadata.column_renames.values())
+            self.files[metadata.sheet_name] = file
+
+    def append(self, rows: Dict[str, List[List[Any]]]):
+        for sheet_name, sheet_rows in rows.items():
+            csv.writer(self.files[sheet_name]).writerows(sheet_rows)
+            self.n_rows[sheet_name] += len(sheet_rows)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+        if self.path.endswith('.zip'):
+            with ZipFile(self.path, 'w', ZIP_DEFLATED) as archive:
+                for sheet_name, file in self.files.items():
+                    archive.write(file.name, sheet_name + '.csv')
+        else:
+            self.write_xlsx()
+        self.csv_dir.cleanup()
+
+    def write_xlsx(self):
+        from openpyxl import Workbook
+        too_long = [name for name, n_rows in self.n_rows.items() if n_rows + 1 > self.XLSX_MAX_ROWS]
+        if too_long:
+            raise ValueError(f'Too many rows for an excel sheet in {", ".join(too_long)}, write a .zip instead')
+
+        workbook = Workbook(write_only=True)
+        for sheet_name, file in self.files.items():
+            sheet = workbook.create_sheet(sheet_name)
+            with open(file.name, newline='', encoding='utf-8') as rows:
+                for row in csv.reader(rows):
+                    sheet.append([cell if cell != '' else None for cell in row])
+        workbook.save(self.path)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,36 @@
+from typing import Dict, List, Any
+import os
+from tempfile import TemporaryDirectory
+
+import pandas as pd
+
+from cemetery.model_parsers import MODELS_METADATA
+from cemetery.synthetic_data import WorkbookWriter
+
+
+"""
+Import documents for the tests, written from rows of {field: cell} (missing cells are empty)
+"""
+
+METADATA = {metadata.sheet_name: metadata for metadata in MODELS_METADATA}
+
+
+def cells(metadata, row: Dict[str, Any]) -> List[Any]:
+    return [row.get(field) for field in metadata.column_renames]
+
+
+def sheet(metadata, *rows: Dict[str, Any]) -> pd.DataFrame:
+    """ a sheet as `read_workbook` gives it """
+    return pd.DataFrame([cells(metadata, row) for row in rows], columns=list(metadata.column_renames.values()))
+
+
+def document(sheets: Dict[str, List[Dict[str, Any]]], extension: str = '.xlsx') -> bytes:
+    """ the content of an excel workbook (or a zip of csv sheets) with every sheet, `sheets` has the rows of some """
+    with TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'document' + extension)
+        writer = WorkbookWriter(path)
+        writer.append({sheet_name: [cells(METADATA[sheet_name], row) for row in rows]
+                       for sheet_name, rows in sheets.items()})
+        writer.close()
+        with open(path, 'rb') as file:
+            return file.read()
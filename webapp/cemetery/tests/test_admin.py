@@ -0,0 +1,162 @@
+import re
+from datetime import date
+
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from cemetery.models import Spot, Deed, Owner, Operation, Construction, Authorization, PaymentUnit, Maintenance, \
+    unkept_year, unkept_year_subquery
+from cemetery.display_helpers import show_head_links
+
+
+# every model is cleaned before it's saved (see `models.validate_model`), stored sessions fail the unique check
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class AdminTestCase(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def changelist(self, model, **query) -> str:
+        url = reverse(f'admin:cemetery_{model._meta.model_name}_changelist')
+        return self.client.get(url, query).content.decode()
+
+
+class AutocompleteFilterTest(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spots = [Spot.objects.create(parcel='A', row='1', column=str(column)) for column in [1, 2, 3]]
+        Operation.objects.create(spot=self.spots[0], type=Operation.BURIAL, date='2010-01-01', deceased='Ion Pop')
+
+    def spot_filter(self, **query) -> str:
+        page = self.changelist(Operation, **query)
+        return re.search(r'<ul class="ajax"[^>]*data-model="Spot".*?</ul>', page, re.S).group(0)
+
+    def test_asks_the_autocomplete_view_for_the_entities(self):
+        spot_filter = self.spot_filter()
+        self.assertIn(f'data-ajax--url="{reverse("autocomplete")}"', spot_filter)
+        self.assertIn('data-app-label="cemetery"', spot_filter)
+        self.assertIn('data-queryset--lookup="spot__id__exact"', spot_filter)
+        self.assertNotIn('A-1-', spot_filter)  # none of them is listed
+
+    def test_renders_only_the_selected_entity(self):
+        spot_filter = self.spot_filter(spot__id__exact=self.spots[1].pk)
+        self.assertIn('<li class="selected">', spot_filter)
+        self.assertIn(f'<a href="?spot__id__exact={self.spots[1].pk}" title="A-1-2">A-1-2</a>', spot_filter)
+        self.assertNotIn('A-1-1', spot_filter)
+        self.assertNotIn('A-1-3', spot_filter)
+
+    def test_queries_dont_grow_with_the_related_entities(self):
+        def queries() -> int:
+            with CaptureQueriesContext(connection) as captured:
+                self.changelist(Operation)
+            return len(captured)
+
+        before = queries()
+        for column in range(4, 40):
+            Spot.objects.create(parcel='A', row='1', column=str(column))
+        self.assertEqual(queries(), before)
+
+
+class SpotChangelistTest(AdminTestCase):
+    def add_spots(self, n: int):
+        """ `n` more spots, each with a bit of everything the changelist shows, sharing deeds and authorizations """
+        for _ in range(n):
+            column = Spot.objects.count() + 1
+            spot = Spot.objects.create(parcel='A', row='1', column=str(column))
+            shared = Spot.objects.filter(column=str(column - 1)).first()
+            deed = Deed.objects.create(number=column, year=2000)
+            deed.spots.set([spot, shared] if shared else [spot])
+            for name in ['Ion Pop', 'Ana Pop']:
+                Owner.objects.create(name=f'{name} {column}').deeds.add(deed)
+            if column % 3 == 0:  # and a cancelled one, that's not shown
+                cancelled = Deed.objects.create(number=column, year=1990, cancel_reason=Deed.DONATED)
+                cancelled.spots.add(spot)
+            Operation.objects.create(spot=spot, type=Operation.BURIAL, date='2010-01-01')
+            Operation.objects.create(spot=spot, type=Operation.BURIAL, date='2015-01-01')
+            Construction.objects.create(type=Construction.TOMB).spots.set([spot, shared] if shared else [spot])
+            Authorization.objects.create(number=column, year=2010).spots.set([spot, shared] if shared else [spot])
+            PaymentUnit.objects.create(spot=spot, year=2000 + column, value=10)
+            Maintenance.objects.create(spot=spot, year=2000 + column, kept=column % 2 == 0)
+
+    def changelist_rows(self) -> list:
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('admin:cemetery_spot_changelist'))
+        self.queries = len(captured)
+        self.page = response.content.decode()
+        return list(response.context['cl'].result_list)
+
+    def test_queries_dont_grow_with_the_spots(self):
+        self.add_spots(3)
+        self.changelist_rows()
+        self.add_spots(20)
+        with self.assertNumQueries(self.queries):  # as many as for 3 spots
+            rows = self.changelist_rows()
+        self.assertEqual(len(rows), 23)
+
+    def test_shows_what_the_spot_properties_do(self):
+        self.add_spots(10)
+        spot_admin = site._registry[Spot]
+        for listed in self.changelist_rows():
+            spot = Spot.objects.get(pk=listed.pk)  # loading its relations itself, row by row
+            expected = {
+                'show_active_deed': show_head_links(spot.active_deeds, 1),
+                'show_owners': show_head_links(spot.active_owners),
+                'show_operations': show_head_links(spot.operations, 1),
+                'show_constructions': show_head_links(spot.constructions, 1),
+                'show_shares_deed_with': show_head_links(spot.shares_deed_with),
+                'show_shares_authorizations_with': show_head_links(spot.shares_authorization_with),
+                'show_last_paid_year': spot.last_paid_year,
+                'show_unkept_since': spot.unkept_since,
+            }
+            with self.subTest(spot=str(spot)):
+                self.assertEqual({column: getattr(spot_admin, column)(listed) for column in expected}, expected)
+                for column in ['show_active_deed', 'show_owners', 'show_shares_deed_with',
+                               'show_shares_authorizations_with']:
+                    if expected[column] is not None:
+                            self.assertIn(f'<td class="field-{column}">{expected[column]}</td>', self.page)
+
+
+class UnkeptSinceTest(AdminTestCase):
+    this_year = date.today().year
+    histories = {  # spot column ~> ({year: kept}, the smallest unkept year with no kept year after it)
+        '1': ({}, None),
+        '2': ({2010: True, 2011: True}, None),
+        '3': ({2010: False, 2011: False}, 2010),
+        '4': ({2010: False, 2012: True, 2016: False, 2019: False}, 2016),  # with gaps
+        '5': ({2010: False, 2015: True}, None),
+        '6': ({2005: False, 2009: False}, 2005),
+        '7': ({2010: True, this_year - 1: False}, this_year - 1),
+        '8': ({this_year - 3: True, this_year - 2: False, this_year: False}, this_year - 2),
+        '9': ({this_year - 5: False, this_year - 4: True}, None),
+        '10': ({this_year - 6: True, this_year - 5: False}, this_year - 5),
+        '11': ({this_year - 5: False, this_year - 4: False}, this_year - 5),
+    }
+
+    def setUp(self):
+        super().setUp()
+        for column, (kept_years, _unkept) in self.histories.items():
+            spot = Spot.objects.create(parcel='A', row='1', column=column)
+            for year, kept in kept_years.items():
+                Maintenance.objects.create(spot=spot, year=year, kept=kept)
+        self.expected = {column: unkept for column, (_kept_years, unkept) in self.histories.items()}
+
+    def test_the_database_finds_what_python_does(self):
+        walked = {spot.column: unkept_year(spot.maintenances.order_by('-year')) for spot in Spot.objects.all()}
+        self.assertEqual(walked, self.expected)
+        annotated = dict(Spot.objects.annotate(unkept_year=unkept_year_subquery()).values_list('column', 'unkept_year'))
+        self.assertEqual(annotated, self.expected)
+
+    def test_the_filter_finds_what_python_does(self):
+        def filtered(value: str) -> set:
+            response = self.client.get(reverse('admin:cemetery_spot_changelist'), {'unkept': value})
+            return {spot.column for spot in response.context['cl'].result_list}
+
+        self.assertEqual(filtered('no'), {column for column, year in self.expected.items() if year is None})
+        self.assertEqual(filtered('yes'), {column for column, year in self.expected.items() if year is not None})
+        for years in [2, 5]:
+            with self.subTest(years=years):
+                self.assertEqual(filtered(str(years)), {column for column, year in self.expected.items()
+                                                        if year is not None and year <= self.this_year - years})
@@ -0,0 +1,70 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from cemetery.models import Owner, Spot
+from cemetery.batch_validation import BatchValidation, VECTORIZE_FROM, active_validation, validating_in_batches
+
+
+def full_clean_errors(entity) -> dict:
+    try:
+        entity.full_clean()
+        return {}
+    except ValidationError as error:
+        return error.message_dict
+
+
+class BatchValidationTest(TestCase):
+    def setUp(self):
+        Owner.objects.create(name='Ion Popescu')
+        Spot.objects.create(parcel='A', row='1', column='1')
+
+    def owners(self, n: int) -> [Owner]:
+        """ valid and invalid ones, alternating """
+        return [Owner(name=f'Owner {i}', phone='0722123456') if i % 2 else
+                Owner(name=f'Owner {i}', phone='12', city='<')
+                for i in range(n)]
+
+    def assert_same_errors_as_full_clean(self, entities):
+        expected = [full_clean_errors(entity) for entity in entities]
+        errors = BatchValidation().validate(entities)
+        self.assertEqual([errors[i].message_dict if i in errors else {} for i in range(len(entities))], expected)
+
+    def test_the_errors_of_full_clean(self):
+        self.assert_same_errors_as_full_clean(self.owners(4))
+
+    def test_the_errors_of_full_clean_for_whole_columns(self):
+        self.assert_same_errors_as_full_clean(self.owners(2 * VECTORIZE_FROM))
+
+    def test_clashes_with_the_database(self):
+        errors = BatchValidation().validate([Owner(name='Ion Popescu')])
+        self.assertIn('name', errors[0].message_dict)
+        spots = [Spot(parcel='A', row='1', column='1'), Spot(parcel='A', row='1', column='2')]
+        errors = BatchValidation().validate(spots)
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(errors[0].message_dict, full_clean_errors(Spot(parcel='A', row='1', column='1')))
+
+    def test_clashes_within_the_import(self):
+        validation = BatchValidation()
+        self.assertEqual(validation.validate([Owner(name='Ana Pop')]), {})
+        errors = validation.validate([Owner(name='Ana Pop'), Owner(name='Ana Pop'.upper())])
+        self.assertEqual(sorted(errors), [0, 1])  # names are title cased while cleaning
+
+    def test_a_changed_entity_does_not_clash_with_itself(self):
+        owner = Owner.objects.get()
+        owner.city = 'Iasi'
+        self.assertEqual(BatchValidation().validate([owner]), {})
+
+    def test_a_stale_key_is_confirmed_with_the_database(self):
+        validation = BatchValidation()
+        validation.keys(Owner)  # loaded before the owner is renamed
+        Owner.objects.update(name='Ion Ionescu')
+        self.assertEqual(validation.validate([Owner(name='Ion Popescu')]), {})
+
+    def test_saves_are_validated_by_the_active_one(self):
+        self.assertIsNone(active_validation())
+        with validating_in_batches() as validation:
+            self.assertIs(active_validation(), validation)
+            Owner(name='Ana Pop').save()
+            with self.assertRaises(ValidationError):
+                Owner(name='Ana Pop').save()  # caught without a query, by the key of the first one
+        self.assertIsNone(active_validation())
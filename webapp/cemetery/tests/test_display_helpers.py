@@ -0,0 +1,93 @@
+from unittest import mock
+
+from django.core.urlresolvers import reverse, resolve, get_script_prefix, set_script_prefix
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import translation
+
+from cemetery.models import Spot, Deed, Owner
+from cemetery.display_helpers import NBSP, change_link_template, entity_link, head_and_count, show_head_links
+
+
+class HeadAndCountTest(TestCase):
+    def setUp(self):
+        spots = [Spot.objects.create(parcel='A', row='1', column=str(column)) for column in [1, 2]]
+        for number, name in enumerate(['Ana Pop', 'Ion Popescu', 'Maria Ionescu', 'Vasile Stan', 'Elena Stan']):
+            deed = Deed.objects.create(number=number + 1, year=2000)
+            deed.spots.set(spots)  # each owner twice through the spots' deeds, without distinct
+            Owner.objects.create(name=name).deeds.add(deed)
+
+    def on_both_paths(self, function, *args, windowed: int, fallback: int):
+        """
+        What `function` returns, which has to be the same with and without window functions,
+        making the given number of queries on each path
+        """
+        results = []
+        for n_queries, window_functions in [(windowed, True), (fallback, False)]:
+            with self.subTest(window_functions=window_functions), \
+                    mock.patch('cemetery.display_helpers.SQLITE_WINDOW_FUNCTIONS', window_functions):
+                with self.assertNumQueries(n_queries):
+                    results.append(function(*args))
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_the_head_and_the_count(self):
+        head, count = self.on_both_paths(head_and_count, Owner.objects.all(), 2, windowed=1, fallback=2)
+        self.assertEqual(([str(owner) for owner in head], count), (['Ana Pop', 'Elena Stan'], 5))
+
+    def test_no_count_needed_when_the_head_is_everything(self):
+        head, count = self.on_both_paths(head_and_count, Owner.objects.all(), 10, windowed=1, fallback=1)
+        self.assertEqual(count, 5)
+
+    def test_empty(self):
+        self.assertEqual(self.on_both_paths(head_and_count, Owner.objects.none(), 2, windowed=0, fallback=0), ([], 0))
+        nobody = Owner.objects.filter(name='Nobody')
+        self.assertEqual(self.on_both_paths(head_and_count, nobody, 2, windowed=1, fallback=1), ([], 0))
+
+    def test_distinct_is_counted_after_it_applies(self):
+        owners = Owner.objects.filter(deeds__spots__parcel='A')
+        self.assertEqual(head_and_count(owners, 2)[1], 10)  # every owner twice
+        # the window would count before DISTINCT: both paths count the other way
+        head, count = self.on_both_paths(head_and_count, owners.distinct(), 2, windowed=2, fallback=2)
+        self.assertEqual(count, 5)
+
+    def test_show_head_links_as_for_loaded_entities(self):
+        shown = self.on_both_paths(show_head_links, Owner.objects, windowed=1, fallback=2)
+        self.assertEqual(shown, show_head_links(list(Owner.objects.all())))
+        self.assertIn(f'Ana{NBSP}Pop', shown)
+        self.assertTrue(shown.endswith(f'{NBSP}(+3)'))
+
+
+class ChangeLinkTest(SimpleTestCase):
+    def assert_resolves_to_the_change_page(self, link: str, pk: int = 7):
+        match = resolve(link[len(get_script_prefix()) - 1:])
+        self.assertEqual((match.url_name, match.args), ('cemetery_spot_change', (str(pk),)))
+
+    def test_reversed_once_per_model(self):
+        change_link_template.cache_clear()
+        links = [entity_link('Spot', pk) for pk in [7, 8, 9]]
+        self.assertEqual(links, [reverse('admin:cemetery_spot_change', args=[pk]) for pk in [7, 8, 9]])
+        self.assertEqual(change_link_template.cache_info().misses, 1)
+
+    def test_follows_the_urlconf(self):
+        link = entity_link('Spot', 7)
+        with override_settings(ROOT_URLCONF='cemetery.tests.urls'):
+            self.assertEqual(entity_link('Spot', 7), '/elsewhere/cemetery/spot/7/change/')
+            self.assert_resolves_to_the_change_page(entity_link('Spot', 7))
+        self.assertEqual(entity_link('Spot', 7), link)
+        self.assert_resolves_to_the_change_page(link)
+
+    def test_follows_the_script_prefix(self):
+        link = entity_link('Spot', 7)
+        set_script_prefix('/gods-acre/')  # as it's served from (by the wsgi handler, for each request)
+        try:
+            self.assertEqual(entity_link('Spot', 7), '/gods-acre' + link)
+            self.assert_resolves_to_the_change_page(entity_link('Spot', 7))
+        finally:
+            set_script_prefix('/')
+        self.assertEqual(entity_link('Spot', 7), link)
+
+    def test_follows_the_language(self):
+        for language in ['ro', 'en']:
+            with translation.override(language):
+                self.assertTrue(entity_link('Spot', 7).startswith(f'/{language}/'))
+                self.assert_resolves_to_the_change_page(entity_link('Spot', 7))
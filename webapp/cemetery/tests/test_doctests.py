@@ -0,0 +1,26 @@
+import doctest
+
+from cemetery import batch_validation, import_timings, key_maps, parsing_helpers, search_index, sheet_streams, synthetic_data, utils
+
+
+"""
+Runs the examples in the docstrings of these modules along with the other tests
+(each module also runs its own when executed directly)
+"""
+
+DOCTESTED_MODULES = [
+    batch_validation,
+    import_timings,
+    key_maps,
+    parsing_helpers,
+    search_index,
+    sheet_streams,
+    synthetic_data,
+    utils,
+]
+
+
+def load_tests(loader, tests, ignore):
+    for module in DOCTESTED_MODULES:
+        tests.addTests(doctest.DocTestSuite(module))
+    return tests
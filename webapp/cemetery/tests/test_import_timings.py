@@ -0,0 +1,74 @@
+from collections import deque
+from contextlib import ExitStack
+from io import BytesIO
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from cemetery.import_timings import StageTimings, timing_stages
+from cemetery.key_maps import KeyMaps, using_key_maps
+from cemetery.batch_validation import validating_in_batches
+from cemetery.model_parsers import parse_file, parse_sheet
+from .test_model_parsers import DOCUMENT
+from .documents import METADATA, sheet, document
+
+
+BATCH_STAGES = ['parse columns', 'parse fields', 'insert referenced entities', 'prepare fields', 'validate',
+                'get/create', 'save', 'set relational fields', 'save again']
+
+
+class ImportTimingsTest(TestCase):
+    def import_sheet(self, sheet_name: str, batch: bool):
+        """ the rows of `sheet_name` in `DOCUMENT`, imported by themselves """
+        with ExitStack() as stack:
+            if batch:
+                stack.enter_context(using_key_maps(KeyMaps()))
+                stack.enter_context(validating_in_batches())
+            parse_sheet(sheet(METADATA[sheet_name], *DOCUMENT[sheet_name]), METADATA[sheet_name])
+
+    def test_a_batch_import_times_every_stage_and_field_of_every_sheet(self):
+        with timing_stages() as timings:
+            parse_file(BytesIO(document(DOCUMENT)), batch=True)
+        timed = timings.as_dict()
+        for sheet_name, rows in DOCUMENT.items():
+            metadata = METADATA[sheet_name]
+            with self.subTest(sheet=sheet_name):
+                self.assertEqual(list(timed[sheet_name]['stages']), BATCH_STAGES)  # in the order they ran
+                self.assertEqual({stage['calls'] for stage in timed[sheet_name]['stages'].values()}, {1})
+                self.assertEqual(set(timed[sheet_name]['fields']), set(metadata.field_parsers))
+                self.assertLessEqual(sum(stage['queries'] for stage in timed[sheet_name]['stages'].values()),
+                                     timed[sheet_name]['total']['queries'])
+        self.assertGreater(timed['Operatii']['stages']['save']['queries'], 0)
+        self.assertEqual(timed['Operatii']['stages']['parse columns']['queries'], 0)  # no database work
+        # the connection logs its queries as before
+        self.assertIsInstance(connection.queries_log, deque)
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_counts_every_query_of_a_sheet(self):
+        for batch in [True, False]:
+            with self.subTest(batch=batch):
+                # imported twice, from the same state
+                with transaction.atomic(), CaptureQueriesContext(connection) as captured:
+                    self.import_sheet('Acte concesiune', batch)
+                    transaction.set_rollback(True)
+                with transaction.atomic(), timing_stages() as timings:
+                    self.import_sheet('Acte concesiune', batch)
+                    transaction.set_rollback(True)
+                self.assertEqual(timings.as_dict()['Acte concesiune']['total']['queries'], len(captured))
+
+    def test_a_row_import_times_each_row(self):
+        with timing_stages() as timings:
+            self.import_sheet('Acte concesiune', batch=False)
+        stages = timings.as_dict()['Acte concesiune']['stages']
+        self.assertEqual(stages['get/create']['calls'], len(DOCUMENT['Acte concesiune']) - 1)  # the last fails before
+        self.assertGreater(stages['get/create']['queries'], 0)
+
+    def test_nothing_is_timed_outside_timing_stages(self):
+        with mock.patch.object(StageTimings, 'sheet') as sheet, mock.patch.object(StageTimings, 'totals') as totals:
+            parse_file(BytesIO(document(DOCUMENT)), batch=True)
+            self.import_sheet('Acte concesiune', batch=False)
+        sheet.assert_not_called()
+        totals.assert_not_called()
+        self.assertIsInstance(connection.queries_log, deque)
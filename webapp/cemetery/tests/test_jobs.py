@@ -0,0 +1,127 @@
+from collections import Counter
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from unittest import mock
+import json
+import os
+import threading
+
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from cemetery import model_parsers
+from cemetery.models import Spot, Deed, Owner, ImportJob
+from cemetery.jobs import run_import, live_progress
+from .documents import document
+
+
+DOCUMENT = {
+    'Acte concesiune': [{'deed_id': '1/2000', 'spots': 'A-1-1', 'owners': 'ion popescu'},
+                        {'deed_id': '2/x', 'spots': 'A-1-2'}],  # fails on its first cell
+    'Proprietari':     [{'name': 'ion popescu', 'city': 'Iasi'}],
+}
+
+
+def spooled(test, content: bytes) -> str:
+    """ the path of a temporary file with `content`, as `spool_upload` leaves it """
+    with NamedTemporaryFile(suffix='.xlsx', delete=False) as spooled_file:
+        spooled_file.write(content)
+    test.addCleanup(lambda: os.path.exists(spooled_file.name) and os.remove(spooled_file.name))
+    return spooled_file.name
+
+
+class RunImportTest(TestCase):
+    def run_job(self, content: bytes, **options) -> ImportJob:
+        job = ImportJob.objects.create(file_name='document.xlsx', **options)
+        self.path = spooled(self, content)
+        run_import(job.pk, self.path)  # on this thread, instead of the worker's
+        return ImportJob.objects.get(pk=job.pk)
+
+    def test_imports_and_stores_the_feedback(self):
+        job = self.run_job(document(DOCUMENT))
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertIsNotNone(job.finished)
+
+        deed = Deed.objects.get()
+        self.assertEqual(Owner.objects.get().city, 'Iasi')
+        self.assertEqual(list(deed.owners.values_list('name', flat=True)), ['Ion Popescu'])
+
+        feedbacks = job.feedbacks.filter(sheet_name='Acte concesiune')
+        self.assertEqual([(f.row, f.status) for f in feedbacks], [(2, 'add'), (3, 'fail')])
+        self.assertEqual(feedbacks[0].entity, deed)  # only referenced, rendered when shown
+        self.assertEqual(feedbacks[0].info, '')
+
+    def test_the_document_is_deleted_once_done(self):
+        self.run_job(document(DOCUMENT))
+        self.assertFalse(os.path.exists(self.path))
+        with self.assertLogs('cemetery.jobs', 'ERROR'):
+            self.run_job(b'not an excel document')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_progress_is_saved_once_done(self):
+        job = self.run_job(document(DOCUMENT))
+        self.assertEqual(json.loads(job.progress)['Acte concesiune'], [2, 2])
+        self.assertEqual(live_progress(job), json.loads(job.progress))
+
+    def test_wipes_beforehand(self):
+        Spot.objects.create(parcel='Z', row='9', column='9')
+        job = self.run_job(document(DOCUMENT), wipe_beforehand=True)
+        self.assertIsNotNone(job.wipe_duration)
+        self.assertEqual(sorted(map(str, Spot.objects.all())), ['A-1-1'])
+
+    def test_a_crash_is_recorded(self):
+        with self.assertLogs('cemetery.jobs', 'ERROR'):
+            job = self.run_job(b'not an excel document')
+        self.assertEqual(job.status, ImportJob.CRASHED)
+        self.assertIn('Traceback', job.error)
+        self.assertFalse(job.feedbacks.exists())
+
+    def test_a_preview_of_a_wipe_keeps_everything(self):
+        Spot.objects.create(parcel='Z', row='9', column='9')
+        job = self.run_job(document(DOCUMENT), wipe_beforehand=True, dry_run=True)
+        self.assertIsNone(job.wipe_duration)
+        self.assertEqual(sorted(map(str, Spot.objects.all())), ['Z-9-9'])
+        self.assertEqual(list(job.feedbacks.filter(sheet_name='Acte concesiune').values_list('status', flat=True)),
+                         ['add', 'fail'])
+
+
+class LiveProgressTest(TransactionTestCase):  # the worker thread needs to see the job committed
+    def test_polled_while_a_sheet_is_in_flight(self):
+        job = ImportJob.objects.create(file_name='document.xlsx')
+        path = spooled(self, document(DOCUMENT))
+        in_flight, resume = threading.Event(), threading.Event()
+        parse_fields, parsed = model_parsers.parse_fields, Counter()
+
+        def parse_fields_pausing(row, metadata, *args):
+            parsed[metadata.sheet_name] += 1
+            if (metadata.sheet_name, parsed[metadata.sheet_name]) == ('Acte concesiune', 2):
+                in_flight.set()
+                resume.wait(10)
+            return parse_fields(row, metadata, *args)
+
+        with mock.patch('cemetery.model_parsers.PROGRESS_EVERY', 1), \
+                mock.patch('cemetery.model_parsers.parse_fields', parse_fields_pausing):
+            worker = threading.Thread(target=run_import, args=(job.pk, path))
+            worker.start()
+            try:
+                self.assertTrue(in_flight.wait(10))
+                self.assertEqual(live_progress(job)['Acte concesiune'], (1, 2))  # its first row
+            finally:
+                resume.set()
+                worker.join()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual(live_progress(job)['Acte concesiune'], [2, 2])
+
+
+class WriteAheadLogTest(SimpleTestCase):
+    def test_sqlite_connections_use_it(self):
+        with TemporaryDirectory() as directory:
+            db = DatabaseWrapper(dict(connection.settings_dict, NAME=os.path.join(directory, 'db.sqlite3')))
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone(), ('wal',))
+            finally:
+                db.close()
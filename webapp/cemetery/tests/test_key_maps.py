@@ -0,0 +1,68 @@
+from django.test import TestCase
+
+from cemetery.models import Spot, Deed, Owner
+from cemetery.key_maps import KeyMaps, active_key_maps, using_key_maps, load_relations, update_column, \
+    through_columns
+
+
+class KeyMapTest(TestCase):
+    def setUp(self):
+        self.existing = Spot.objects.create(parcel='A', row='1', column='1')
+        self.key_maps = KeyMaps()
+        self.spots = self.key_maps[Spot]
+
+    def test_finds_existing_entities(self):
+        self.assertEqual(self.spots.getsert({'parcel': 'A', 'row': '1', 'column': '1'}).pk, self.existing.pk)
+
+    def test_new_entities_are_inserted_on_flush(self):
+        spot = self.spots.getsert({'parcel': 'A', 'row': '2', 'column': '1'})
+        self.assertIs(self.spots.getsert({'parcel': 'A', 'row': '2', 'column': '1'}), spot)
+        self.assertIsNone(spot.pk)
+        self.assertFalse(Spot.objects.filter(row='2').exists())
+
+        self.assertEqual(self.key_maps.flush(), {})
+        self.assertEqual(Spot.objects.get(row='2').pk, spot.pk)
+        self.assertFalse(spot._state.adding)
+
+    def test_cleaning_can_change_the_key(self):
+        bis = Spot.objects.create(parcel='A', row='3bis', column='1')
+        spots = KeyMaps()[Spot]
+        self.assertEqual(spots.getsert({'parcel': 'A', 'row': '3BIS', 'column': '1'}).pk, bis.pk)
+
+    def test_flush_reports_the_entities_that_can_not_be_inserted(self):
+        owners = self.key_maps[Owner]
+        valid = owners.getsert({'name': 'Ion Popescu'})
+        clashing = Owner(name='Ana Pop')  # inserted behind the map's back, the map doesn't know about it
+        owners.add(clashing, {'name': 'Ana Pop'})
+        Owner.objects.create(name='Ana Pop')
+
+        errors = self.key_maps.flush()
+        self.assertEqual(list(errors), [id(clashing)])
+        self.assertIsNotNone(valid.pk)
+        self.assertIsNone(owners.get({'name': 'Ana Pop'}))
+
+    def test_using_key_maps_restores_the_previous_ones(self):
+        with using_key_maps(self.key_maps):
+            with using_key_maps(None):
+                self.assertIsNone(active_key_maps())
+            self.assertIs(active_key_maps(), self.key_maps)
+        self.assertIsNone(active_key_maps())
+
+
+class RelationsTest(TestCase):
+    def test_load_relations_from_either_side(self):
+        spot = Spot.objects.create(parcel='A', row='1', column='1')
+        deed = Deed.objects.create(number=1, year=2000)
+        deed.spots.add(spot)
+        self.assertEqual(load_relations(Deed, 'spots'), {deed.pk: {spot.pk}})
+        self.assertEqual(load_relations(Spot, 'deeds'), {spot.pk: {deed.pk}})
+
+    def test_through_columns_of_the_reverse_side(self):
+        through, source, target = through_columns(Deed._meta.get_field('owners'))
+        self.assertIs(through, Owner.deeds.through)
+        self.assertEqual((source, target), ('deed_id', 'owner_id'))
+
+    def test_update_column(self):
+        first, second = Owner.objects.create(name='Ion Popescu'), Owner.objects.create(name='Ana Pop')
+        update_column(Owner, 'city', {first.pk: 'Iasi', second.pk: 'Cluj'})
+        self.assertEqual(dict(Owner.objects.values_list('name', 'city')), {'Ion Popescu': 'Iasi', 'Ana Pop': 'Cluj'})
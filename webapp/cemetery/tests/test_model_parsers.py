@@ -0,0 +1,172 @@
+from io import BytesIO
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from cemetery.models import Spot, Deed, OwnershipReceipt, Owner, Construction, PaymentUnit, SpotSummary, ALL_MODELS, \
+    backfill_spots_signatures
+from cemetery.model_parsers import EntityRef, parse_sheet, parse_file, relational_get
+from cemetery.wiping import wipe
+from .documents import METADATA, sheet, document
+
+
+DOCUMENT = {
+    'Operatii':        [{'type': 'inhumare', 'deceased': 'ion popescu', 'spot': 'A-1-1', 'date': '24.01.1994'}],
+    'Acte concesiune': [{'deed_id': '1/2000', 'spots': 'A-1-1,A-1-2', 'receipt_ids': '3/2000', 'values': '100',
+                         'owners': 'ion popescu,ana pop'},
+                        {'deed_id': '2/2000', 'spots': 'A-1-3', 'owners': 'ana pop'},
+                        {'deed_id': '1/2000', 'spots': 'A-1-1', 'owners': 'ana pop'},  # the last row decides
+                        {'deed_id': '2/x', 'spots': 'A-1-4'}],
+    'Proprietari':     [{'name': 'ion popescu', 'phone': '0722 123 456'},
+                        {'name': 'ana pop', 'city': 'Iasi'}],
+    'Constructii':     [{'type': 'cavou', 'spots': 'A-1-1,A-1-2', 'company': 'Constructii SRL'},
+                        {'type': 'cavou', 'spots': 'A-1-1,A-1-2', 'owner_builder': 'ana pop'}],
+    'Contributii':     [{'receipt_id': '7/2001', 'spots': 'A-1-1', 'years': '2001,2002', 'values': '10'}],
+}
+
+
+class RowModeTest(TestCase):
+    deeds = METADATA['Acte concesiune']
+
+    def test_a_failing_row_saves_nothing(self):
+        # the spot is created while parsing the fields, the row fails afterwards (more values than receipts)
+        [feedback] = parse_sheet(sheet(self.deeds, {'deed_id': '1/2000', 'spots': 'A-1-1', 'values': '10'}),
+                                 self.deeds)
+        self.assertEqual(feedback.status, 'fail')
+        self.assertFalse(Spot.objects.exists())
+        self.assertFalse(Deed.objects.exists())
+
+    def test_the_rows_around_a_failing_one_are_saved(self):
+        feedbacks = parse_sheet(sheet(self.deeds,
+                                      {'deed_id': '1/2000', 'spots': 'A-1-1', 'receipt_ids': '5/2000', 'values': '10'},
+                                      {'deed_id': '2/2000', 'spots': 'A-1-2', 'values': '10'},
+                                      {'deed_id': '3/2000', 'spots': 'A-1-3'}),
+                                self.deeds)
+        self.assertEqual([f.status for f in feedbacks], ['add', 'fail', 'add'])
+        self.assertEqual(sorted(map(str, Spot.objects.all())), ['A-1-1', 'A-1-3'])
+        self.assertEqual(OwnershipReceipt.objects.get().deed.number, 1)
+
+
+class FeedbackTest(TestCase):
+    def test_entities_are_only_referenced(self):
+        feedbacks, _ = parse_file(BytesIO(document(DOCUMENT)), batch=True)
+        deed = Deed.objects.get(number=2)
+        self.assertEqual(feedbacks['Acte concesiune'][1].info, EntityRef(Deed, deed.pk))
+
+    def test_all_or_nothing_shows_the_entities_before_rolling_back(self):
+        feedbacks, _ = parse_file(BytesIO(document(DOCUMENT)), batch=True, all_or_nothing=True)
+        self.assertFalse(Deed.objects.exists())
+        deed = feedbacks['Acte concesiune'][1]
+        self.assertEqual(deed.status, 'add')
+        self.assertIn('cemetery/deed/', deed.info)
+        self.assertIn('A-1-3', deed.additional)
+
+
+class ConstructionLookupTest(TestCase):
+    constructions = METADATA['Constructii']
+
+    def setUp(self):
+        self.spots = [Spot.objects.create(parcel='A', row='1', column=str(column)) for column in [1, 2, 3]]
+
+    def unsigned_construction(self, spots) -> Construction:
+        """ as inserted before there were signatures (bulk inserts send no signals) """
+        Construction.objects.bulk_create([Construction(type=Construction.TOMB)])
+        construction = Construction.objects.latest('pk')
+        through = Construction.spots.through
+        through.objects.bulk_create([through(construction_id=construction.pk, spot_id=spot.pk) for spot in spots])
+        return construction
+
+    def lookup(self, spots) -> Construction:
+        return relational_get(Construction, {'type': Construction.TOMB, 'spots': spots}, {'spots'})
+
+    def test_finds_exactly_the_construction_on_the_spots(self):
+        construction = Construction.objects.create(type=Construction.TOMB)
+        construction.spots.set(self.spots[:2])
+        self.assertEqual(self.lookup(self.spots[:2]), construction)
+        self.assertIsNone(self.lookup(self.spots[:1]))
+        self.assertIsNone(self.lookup(self.spots))
+
+    def test_finds_the_constructions_that_were_not_signed_yet(self):
+        construction = self.unsigned_construction(self.spots[:2])
+        self.assertEqual(self.lookup(self.spots[:2]), construction)
+        self.assertIsNone(self.lookup(self.spots[:1]))
+        self.assertIsNone(self.lookup(self.spots))
+
+    def test_a_reimport_after_the_backfill_finds_them_by_signature(self):
+        construction = self.unsigned_construction(self.spots[:2])
+        self.unsigned_construction([])  # nothing to sign
+        self.assertEqual(backfill_spots_signatures(), 1)
+        self.assertNotEqual(Construction.objects.get(pk=construction.pk).spots_signature, '')
+
+        [feedback] = parse_sheet(sheet(self.constructions, {'type': 'cavou', 'spots': 'A-1-1,A-1-2'}),
+                                 self.constructions)
+        self.assertEqual(feedback.status, 'duplicate')
+        self.assertEqual(Construction.objects.count(), 2)
+
+
+class IncrementalTest(TestCase):
+    owners = METADATA['Proprietari']
+
+    def import_owners(self, *rows) -> [str]:
+        return [f.status for f in parse_sheet(sheet(self.owners, *rows), self.owners, incremental=True)]
+
+    def test_skips_the_rows_imported_before(self):
+        self.assertEqual(self.import_owners({'name': 'Ion Popescu'}, {'name': 'Ana Pop'}), ['add', 'add'])
+        self.assertEqual(self.import_owners({'name': 'Ion Popescu'}, {'name': 'Ana Pop', 'city': 'Iasi'}),
+                         ['unchanged', 'duplicate'])
+        self.assertEqual(Owner.objects.get(name='Ana Pop').city, 'Iasi')
+
+    def test_imports_again_the_rows_whose_entity_was_deleted(self):
+        self.import_owners({'name': 'Ion Popescu'})
+        Owner.objects.get().delete()
+        self.assertEqual(self.import_owners({'name': 'Ion Popescu'}), ['add'])
+        self.assertTrue(Owner.objects.exists())
+
+    def test_failed_rows_are_not_remembered(self):
+        self.assertEqual(self.import_owners({'name': 'Ion Popescu', 'phone': '12'}), ['fail'])
+        self.assertEqual(self.import_owners({'name': 'Ion Popescu', 'phone': '12'}), ['fail'])
+
+
+class PreviewTest(TestCase):
+    def setUp(self):
+        Owner.objects.create(name='Ana Pop', city='Cluj')  # a duplicate
+        Spot.objects.create(parcel='A', row='1', column='1')
+
+    def statuses(self, feedbacks) -> dict:
+        return {sheet_name: [f.status for f in sheet_feedbacks] for sheet_name, sheet_feedbacks in feedbacks.items()}
+
+    def contents(self) -> dict:
+        return {model.__name__: sorted(map(str, model.objects.all())) for model in ALL_MODELS}
+
+    def test_gives_the_feedback_of_the_import(self):
+        before = self.contents()
+        preview, _ = parse_file(BytesIO(document(DOCUMENT)), dry_run=True)
+        self.assertEqual(self.contents(), before)
+
+        feedbacks, _ = parse_file(BytesIO(document(DOCUMENT)), batch=True)
+        self.assertEqual(self.statuses(preview), self.statuses(feedbacks))
+        self.assertEqual(Construction.objects.count(), 1)
+        self.assertEqual(PaymentUnit.objects.count(), 2)
+        self.assertEqual(list(Deed.objects.get(number=1).owners.values_list('name', flat=True)), ['Ana Pop'])
+
+    def test_writes_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            parse_file(BytesIO(document(DOCUMENT)), dry_run=True, incremental=True)
+        writes = [q['sql'] for q in queries if not q['sql'].startswith('SELECT')]
+        self.assertEqual(writes, [])
+
+    def test_new_entities_are_described_by_their_row(self):
+        preview, _ = parse_file(BytesIO(document(DOCUMENT)), dry_run=True)
+        deed = preview['Acte concesiune'][1]
+        self.assertEqual((deed.status, deed.info), ('add', 'Deed {number: 2, year: 2000}'))
+        self.assertIn('ana pop'.title(), deed.additional)
+        self.assertIn('cemetery/owner/', preview['Proprietari'][1].info)  # the existing one is linked
+
+    def test_as_if_the_database_was_wiped(self):
+        preview, _ = parse_file(BytesIO(document(DOCUMENT)), dry_run=True, from_scratch=True)
+        self.assertEqual(Owner.objects.get().city, 'Cluj')
+
+        wipe(ALL_MODELS + [SpotSummary])
+        feedbacks, _ = parse_file(BytesIO(document(DOCUMENT)), batch=True)
+        self.assertEqual(self.statuses(preview), self.statuses(feedbacks))
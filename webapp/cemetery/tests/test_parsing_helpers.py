@@ -0,0 +1,37 @@
+from datetime import date, datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from cemetery.parsing_helpers import parse_date, parse_date_stats, _parse_date_str
+
+
+class ParseDateTest(SimpleTestCase):
+    def setUp(self):
+        _parse_date_str.cache_clear()
+
+    def stats_since(self, before: dict) -> dict:
+        return {key: value - before[key] for key, value in parse_date_stats().items()}
+
+    def test_counts_the_parsing_paths_and_the_cache_hits(self):
+        before = parse_date_stats()
+        parse_date('24.01.1994')
+        parse_date('24.01.1994')  # cached
+        parse_date(1994)
+        parse_date('January 24, 1994')  # not a format of the sheets: parsed by dateutil
+        self.assertEqual(self.stats_since(before), {'hits': 1, 'misses': 3, 'fast': 2, 'fallback': 1})
+
+    def test_the_fast_path_parses_as_dateutil_does(self):
+        for text in ['94', "'17", '1994', '6', '24.01.1994', '01.24.1994', '05.01.1994', '18 07 2017']:
+            with self.subTest(text=text):
+                fast = parse_date(text)
+                _parse_date_str.cache_clear()
+                with mock.patch('cemetery.parsing_helpers._parse_date_fast', return_value=None):
+                    self.assertEqual(parse_date(text), fast)
+
+    def test_dates_are_returned_unchanged(self):
+        before = parse_date_stats()
+        parsed = datetime(1994, 1, 5)  # would be read as May 1st, through its string and `dayfirst`
+        self.assertIs(parse_date(parsed), parsed)
+        self.assertEqual(parse_date(date(1994, 1, 5)), parsed)
+        self.assertEqual(self.stats_since(before), {'hits': 0, 'misses': 0, 'fast': 0, 'fallback': 0})
@@ -0,0 +1,107 @@
+from io import BytesIO
+
+from django.db import connection
+from django.test import TestCase
+
+from cemetery.models import Spot, Deed, Owner, Operation, Construction, Company, SpotSummary, ALL_MODELS
+from cemetery.model_parsers import parse_file
+from cemetery.wiping import wipe
+from cemetery.search_index import DOCUMENTS, search, search_available, search_table, updating_search_afterwards
+from .documents import document
+
+
+def indexed(model) -> dict:
+    """ pk ~> document, as stored """
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid, document FROM {search_table(model)}')
+        return dict(cursor.fetchall())
+
+
+def found(model, search_term: str) -> [str]:
+    return sorted(map(str, search(model.objects.all(), search_term)))
+
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        if not search_available():
+            self.skipTest('sqlite without FTS5')
+        self.spot = Spot.objects.create(parcel='A', row='1', column='2')
+        self.deed = Deed.objects.create(number=12, year=1995)
+        self.deed.spots.add(self.spot)
+        self.owner = Owner.objects.create(name='Ștefan Popescu', city='Iasi')
+        self.owner.deeds.add(self.deed)
+
+    def assert_up_to_date(self):
+        for model, documents in DOCUMENTS.items():
+            pks = list(model.objects.values_list('pk', flat=True))
+            fresh = {pk: ' '.join(str(word) for word in words) for pk, words in documents(pks).items()}
+            self.assertEqual(indexed(model), fresh, model.__name__)
+
+    def test_finds_entities_by_what_their_admin_searched(self):
+        self.assertEqual(found(Spot, 'popescu'), ['A-1-2'])
+        self.assertEqual(found(Spot, 'stefan 12/1995'), ['A-1-2'])  # without diacritics, in any order
+        self.assertEqual(found(Owner, 'A-1-2'), ['Ștefan Popescu'])
+        self.assertEqual(found(Deed, 'ion'), [])
+        self.assertIsNone(search(Company.objects.all(), 'srl'))  # not indexed
+
+    def test_follows_the_changes_of_what_documents_show(self):
+        changes = [
+            lambda: Operation.objects.create(spot=self.spot, type=Operation.BURIAL, date='2010-01-01',
+                                             deceased='Ion Popescu'),
+            lambda: Construction.objects.create(type=Construction.TOMB, owner_builder=self.owner)
+                                .spots.add(self.spot),
+            lambda: setattr(self.owner, 'name', 'Ana Pop') or self.owner.save(),
+            lambda: self.deed.owners.clear(),
+            lambda: self.spot.deeds.clear(),
+            lambda: self.deed.delete(),
+            lambda: self.spot.delete(),
+        ]
+        for i, change in enumerate(changes):
+            with self.subTest(change=i):
+                change()
+                self.assert_up_to_date()
+
+    def test_moving_an_operation_updates_both_spots(self):
+        other = Spot.objects.create(parcel='B', row='1', column='1')
+        operation = Operation.objects.create(spot=self.spot, type=Operation.BURIAL, date='2010-01-01')
+        operation = Operation.objects.get(pk=operation.pk)
+        operation.spot = other
+        operation.save()
+        self.assert_up_to_date()
+
+    def test_written_once_after_a_block(self):
+        with updating_search_afterwards():
+            self.owner.name = 'Ana Pop'
+            self.owner.save()
+            self.assertEqual(found(Spot, 'ana'), [])  # not yet
+        self.assertEqual(found(Spot, 'ana'), ['A-1-2'])
+
+    def test_a_batch_import_writes_only_the_documents_of_what_it_wrote(self):
+        untouched = Spot.objects.create(parcel='Z', row='1', column='1')
+        with connection.cursor() as cursor:  # a rebuild would fix it
+            cursor.execute(f'UPDATE {search_table(Spot)} SET document = %s WHERE rowid = %s', ['stale', untouched.pk])
+
+        parse_file(BytesIO(document({
+            'Operatii':        [{'type': 'inhumare', 'deceased': 'vasile stan', 'spot': 'B-1-1', 'date': '24.01.1994'}],
+            'Acte concesiune': [{'deed_id': '12/1995', 'spots': 'A-1-2,B-1-1', 'owners': 'ana pop'}],
+            'Constructii':     [{'type': 'cavou', 'spots': 'B-1-1', 'company': 'Constructii SRL'}],
+        })), batch=True)
+        self.assertEqual(indexed(Spot)[untouched.pk], 'stale')
+        self.assertEqual(found(Spot, 'stale'), ['Z-1-1'])
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {search_table(Spot)} SET document = %s WHERE rowid = %s', ['Z-1-1', untouched.pk])
+        self.assert_up_to_date()
+        self.assertEqual(found(Spot, 'ana pop'), ['A-1-2', 'B-1-1'])
+        self.assertEqual(found(Spot, 'popescu'), [])
+
+    def test_a_wipe_empties_the_index_before_an_import(self):
+        wipe(ALL_MODELS + [SpotSummary])
+        self.assertEqual([indexed(model) for model in DOCUMENTS], [{}] * len(DOCUMENTS))
+
+        parse_file(BytesIO(document({
+            'Acte concesiune': [{'deed_id': '7/2001', 'spots': 'B-1-1', 'owners': 'ana pop'}],
+        })), batch=True)
+        self.assert_up_to_date()
+        self.assertEqual(found(Spot, 'popescu'), [])
+        self.assertEqual(found(Owner, 'A-1-2'), [])
+        self.assertEqual(found(Spot, 'ana pop'), ['B-1-1'])
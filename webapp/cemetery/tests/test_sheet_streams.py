@@ -0,0 +1,60 @@
+from io import BytesIO
+
+from django.test import SimpleTestCase, TestCase
+import pandas as pd
+
+from cemetery.model_parsers import parse_file
+from cemetery.sheet_streams import is_csv_archive, stream_workbook
+from .documents import document
+
+
+DOCUMENT = {
+    'Acte concesiune': [{'deed_id': '1/2000', 'spots': 'A-1-1', 'owners': 'ion popescu'},
+                        {'deed_id': '2/2000', 'spots': 'A-1-2'},
+                        {'deed_id': '3/2000', 'spots': 'A-1-3', 'owners': 'ana pop'}],
+    'Proprietari':     [{'name': 'ion popescu', 'city': 'Iasi'}],
+}
+
+
+class StreamWorkbookTest(SimpleTestCase):
+    def test_tells_csv_archives_from_workbooks(self):
+        self.assertTrue(is_csv_archive(BytesIO(document(DOCUMENT, extension='.zip'))))
+        self.assertFalse(is_csv_archive(BytesIO(document(DOCUMENT))))
+        self.assertFalse(is_csv_archive(BytesIO(b'not a zip archive')))
+
+    def test_chunks_have_the_rows_of_the_whole_sheet(self):
+        content = document(DOCUMENT)
+        whole = pd.read_excel(BytesIO(content), sheetname='Acte concesiune')
+        stream = stream_workbook(BytesIO(content), ['Acte concesiune'], chunk_size=2)['Acte concesiune']
+        chunks = list(stream.chunks)
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(list(chunks[0].columns), list(whole.columns))
+        self.assertEqual(list(pd.concat(chunks)['Act'].astype(str)), list(whole['Act'].astype(str)))
+
+    def test_csv_sheets_are_read_as_text(self):
+        content = document({'Proprietari': [{'name': 'ion popescu', 'phone': '0722123456'}]}, extension='.zip')
+        stream = stream_workbook(BytesIO(content), ['Proprietari'])['Proprietari']
+        self.assertIsNone(stream.n_rows)
+        [chunk] = stream.chunks
+        self.assertIn('0722123456', chunk.values.tolist()[0])  # the leading zero is kept
+
+    def test_a_missing_sheet_is_an_error(self):
+        with self.assertRaises(KeyError):
+            stream_workbook(BytesIO(document(DOCUMENT)), ['Foaie'])
+
+
+class StreamingImportTest(TestCase):
+    def statuses(self, content: bytes, streaming: bool) -> dict:
+        feedbacks, _ = parse_file(BytesIO(content), batch=True, streaming=streaming)
+        return {sheet_name: [f.status for f in sheet_feedbacks] for sheet_name, sheet_feedbacks in feedbacks.items()
+                if sheet_feedbacks}
+
+    def test_a_streamed_workbook_imports_like_a_whole_one(self):
+        self.assertEqual(self.statuses(document(DOCUMENT), streaming=True),
+                         {'Acte concesiune': ['add'] * 3, 'Proprietari': ['duplicate']})
+        self.assertEqual(self.statuses(document(DOCUMENT), streaming=False),
+                         {'Acte concesiune': ['duplicate'] * 3, 'Proprietari': ['duplicate']})
+
+    def test_imports_a_csv_archive(self):
+        self.assertEqual(self.statuses(document(DOCUMENT, extension='.zip'), streaming=True),
+                         {'Acte concesiune': ['add'] * 3, 'Proprietari': ['duplicate']})
@@ -0,0 +1,128 @@
+from io import BytesIO
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.forms.models import model_to_dict
+from django.db.models.signals import post_init
+from django.test import TestCase, override_settings
+
+from cemetery.models import Spot, Deed, Owner, Construction, Operation, OwnershipReceipt, PaymentUnit, Maintenance, \
+    SpotSummary
+from cemetery.spot_summaries import compute_summaries, rebuild_summaries, updating_summaries_afterwards
+from cemetery.model_parsers import parse_file
+from .documents import document
+
+
+class SummariesTestCase(TestCase):
+    def setUp(self):
+        self.spots = [Spot.objects.create(parcel='A', row='1', column=str(column)) for column in [1, 2, 3]]
+        self.deed = Deed.objects.create(number=1, year=2000)
+        self.deed.spots.set(self.spots[:2])
+        self.owner = Owner.objects.create(name='Ion Popescu')
+        self.owner.deeds.add(self.deed)
+
+    def assert_up_to_date(self):
+        fresh = {s.spot_id: model_to_dict(s, exclude=['id'])
+                 for s in compute_summaries(list(Spot.objects.values_list('pk', flat=True)))}
+        stored = {s.spot_id: model_to_dict(s, exclude=['id']) for s in SpotSummary.objects.all()}
+        self.assertEqual(stored, fresh)
+
+    def summary(self, spot: Spot) -> SpotSummary:
+        return SpotSummary.objects.get(spot=spot)
+
+
+class SummariesTest(SummariesTestCase):
+    def test_summarizes_a_spot(self):
+        self.assert_up_to_date()
+        summary = self.summary(self.spots[0])
+        self.assertEqual((summary.active_deed, summary.active_owners, summary.shares_deed_with),
+                         (self.deed, 'Ion Popescu', 'A-1-2'))
+        self.assertEqual(self.summary(self.spots[2]).n_active_deeds, 0)
+
+    def test_follows_the_changes_of_what_they_are_derived_from(self):
+        spot = self.spots[0]
+        changes = [
+            lambda: Maintenance.objects.create(spot=spot, year=2019, kept=False),
+            lambda: PaymentUnit.objects.create(spot=spot, year=2020, value=10),
+            lambda: Operation.objects.create(spot=spot, type=Operation.BURIAL, date='2010-01-01'),
+            lambda: Owner.objects.filter(pk=self.owner.pk).first().save(),
+            lambda: Owner.objects.create(name='Ana Pop').deeds.add(self.deed),
+            lambda: self.deed.spots.add(self.spots[2]),
+            lambda: self.spots[2].deeds.remove(self.deed),
+            lambda: self.deed.owners.clear(),
+            lambda: Construction.objects.create(type=Construction.TOMB).spots.add(*self.spots[:2]),
+            lambda: spot.constructions.clear(),
+            lambda: setattr(self.deed, 'cancel_reason', 'l') or self.deed.save(),
+            lambda: self.spots[1].delete(),
+            lambda: self.deed.delete(),
+        ]
+        for i, change in enumerate(changes):
+            with self.subTest(change=i):
+                change()
+                self.assert_up_to_date()
+
+    def test_moving_a_payment_updates_both_spots(self):
+        payment = PaymentUnit.objects.create(spot=self.spots[0], year=2020, value=10)
+        payment = PaymentUnit.objects.get(pk=payment.pk)
+        payment.spot = self.spots[2]
+        payment.save()
+        self.assert_up_to_date()
+        self.assertIsNone(self.summary(self.spots[0]).last_paid_year)
+
+    def test_loading_children_sends_no_signal(self):
+        # what they were loaded with is kept by `RemembersLoadedValues`, not by a post_init receiver per entity
+        for model in [PaymentUnit, Maintenance, Operation, OwnershipReceipt, Construction]:
+            self.assertFalse(post_init.has_listeners(model), model.__name__)
+
+    def test_updated_once_after_a_block(self):
+        with updating_summaries_afterwards():
+            Maintenance.objects.create(spot=self.spots[2], year=2019, kept=False)
+            self.owner.deeds.clear()
+            self.assertEqual(self.summary(self.spots[0]).active_owners, 'Ion Popescu')  # not yet
+        self.assert_up_to_date()
+
+    def test_rebuilt_from_scratch(self):
+        SpotSummary.objects.all().delete()
+        self.assertEqual(rebuild_summaries(), 3)
+        self.assert_up_to_date()
+
+
+class BatchImportTest(SummariesTestCase):
+    document = {
+        'Operatii':        [{'type': 'inhumare', 'deceased': 'ion popescu', 'spot': 'A-1-3', 'date': '24.01.1994'}],
+        'Acte concesiune': [{'deed_id': '1/2000', 'spots': 'A-1-1', 'owners': 'ana pop'},  # A-1-2 leaves it
+                            {'deed_id': '2/2000', 'spots': 'B-1-1,B-1-2', 'owners': 'ion popescu,ana pop'}],
+        'Constructii':     [{'type': 'cavou', 'spots': 'B-1-1', 'company': 'Constructii SRL'}],
+        'Contributii':     [{'receipt_id': '7/2001', 'spots': 'B-1-2', 'years': '2001,2002', 'values': '10'}],
+    }
+
+    def test_only_what_was_written_is_summarized_again(self):
+        untouched = Spot.objects.create(parcel='Z', row='1', column='1')
+        SpotSummary.objects.filter(spot=untouched).update(active_owners='stale')  # a rebuild would fix it
+
+        parse_file(BytesIO(document(self.document)), batch=True)
+        self.assertEqual(SpotSummary.objects.get(spot=untouched).active_owners, 'stale')
+        SpotSummary.objects.filter(spot=untouched).update(active_owners='')
+        self.assert_up_to_date()
+        self.assertEqual(self.summary(self.spots[1]).n_active_deeds, 0)
+        self.assertEqual(self.summary(self.spots[0]).active_owners, 'Ana Pop')
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class MaintenanceActionsTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.spot = Spot.objects.create(parcel='A', row='1', column='1')
+        self.maintenance = Maintenance.objects.create(spot=self.spot, year=2019, kept=False)
+
+    def act(self, action: str):
+        self.client.post(reverse('admin:cemetery_maintenance_changelist'),
+                         {'action': action, '_selected_action': [self.maintenance.pk]})
+
+    def test_the_summary_shows_the_marked_values(self):
+        self.assertEqual(SpotSummary.objects.get().unkept_since, 2019)
+        self.act('mark_kept')
+        self.assertTrue(Maintenance.objects.get().kept)
+        self.assertIsNone(SpotSummary.objects.get().unkept_since)
+        self.act('mark_unkept')
+        self.assertEqual(SpotSummary.objects.get().unkept_since, 2019)
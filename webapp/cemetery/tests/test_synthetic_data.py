@@ -0,0 +1,35 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from cemetery.models import Owner, ALL_MODELS
+from cemetery.parsing_helpers import keep_only
+from cemetery.synthetic_data import SyntheticCemetery, save_block, sheet_columns
+
+
+class SyntheticCemeteryTest(TestCase):
+    def setUp(self):
+        self.blocks = list(SyntheticCemetery(40, seed=1, block_spots=20).blocks())
+        for block in self.blocks:
+            save_block(block)
+
+    def test_what_is_saved_is_valid(self):
+        phones = Owner.objects.exclude(phone=None).values_list('phone', flat=True)
+        self.assertTrue(phones)
+        self.assertTrue(all(phone.isdigit() for phone in phones))  # as cleaned, not only as they'd pass the cleaning
+        for model in ALL_MODELS:
+            for entity in model.objects.all():
+                with self.subTest(entity=f'{model.__name__} {entity.pk}'):
+                    try:
+                        entity.full_clean()
+                    except ValidationError as error:
+                        self.fail(error.message_dict)
+
+    def test_the_sheets_write_phones_like_people_do(self):
+        phone_column = sheet_columns('Proprietari').index('phone')
+        name_column = sheet_columns('Proprietari').index('name')
+        phones = dict(Owner.objects.values_list('name', 'phone'))
+        rows = [row for block in self.blocks for row in block.rows.get('Proprietari', []) if row[phone_column]]
+        self.assertTrue(rows)
+        for row in rows:
+            self.assertIn(' ', row[phone_column])
+            self.assertEqual(keep_only(row[phone_column], str.isdigit), phones[row[name_column]])
@@ -0,0 +1,119 @@
+from unittest.mock import patch
+import os
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from cemetery.models import Spot, Owner, Operation, ImportJob, ImportFeedback
+from cemetery.model_parsers import STATUSES
+
+
+# every model is cleaned before it's saved (see `models.validate_model`), stored sessions fail the unique check
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class ImportJobViewTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def feedback_page(self, job: ImportJob) -> str:
+        query = {'sheet': 'Proprietari', 'status': STATUSES}
+        return self.client.get(reverse('import-job', args=[job.pk]), query).content.decode()
+
+    def test_only_entity_links_are_rendered_as_html(self):
+        job = ImportJob.objects.create(file_name='document.xlsx', status=ImportJob.DONE)
+        Owner.objects.bulk_create([Owner(name='Ion <b>Popescu</b>')])  # not cleaned, as if saved before validation
+        owner = Owner.objects.get()
+        ImportFeedback.objects.bulk_create([
+            ImportFeedback(job=job, sheet_name='Proprietari', row=2, status='add', entity=owner),
+            ImportFeedback(job=job, sheet_name='Proprietari', row=3, status='unchanged',
+                           info='name: <script>alert(1)</script>'),
+            ImportFeedback(job=job, sheet_name='Proprietari', row=4, status='fail', info='<i>cell</i>'),
+        ])
+
+        page = self.feedback_page(job)
+        self.assertIn(f'<a href="{reverse("admin:cemetery_owner_change", args=[owner.pk])}">', page)
+        self.assertIn('&lt;b&gt;Popescu&lt;/b&gt;', page)
+        self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', page)
+        self.assertIn('&lt;i&gt;cell&lt;/i&gt;', page)
+        self.assertNotIn('<script>alert', page)
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class ImportEntriesViewTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_the_upload_is_spooled_to_a_file_for_the_job(self):
+        upload = SimpleUploadedFile('document.xlsx', b'the content of the document')
+        with patch('cemetery.views.submit_import') as submit_import:  # not run on the worker thread
+            response = self.client.post(reverse('import'), {'document': upload, 'dry_run': 'on'})
+
+        job, path = submit_import.call_args[0]
+        self.addCleanup(os.remove, path)
+        self.assertRedirects(response, reverse('import-job', args=[job.pk]), fetch_redirect_response=False)
+        self.assertEqual((job.file_name, job.dry_run), ('document.xlsx', True))
+        self.assertTrue(path.endswith('.xlsx'))
+        with open(path, 'rb') as spooled:
+            self.assertEqual(spooled.read(), b'the content of the document')
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+class AutocompleteViewTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        for name in ['Ana Pop', 'Ion Popescu', 'Maria Ionescu', 'Vasile Stan']:
+            Owner.objects.create(name=name)
+
+    def autocomplete(self, model: str = 'Owner', **parameters):
+        return self.client.get(reverse('autocomplete'), dict(app_label='cemetery', model=model, **parameters))
+
+    def texts(self, **parameters) -> (list, int):
+        result = self.autocomplete(**parameters).json()
+        self.assertEqual({item['id'] for item in result['items']},
+                         set(Owner.objects.filter(name__in=[item['text'] for item in result['items']])
+                             .values_list('pk', flat=True)))
+        return [item['text'] for item in result['items']], result['total']
+
+    def test_a_page_of_what_the_admin_search_finds(self):
+        self.assertEqual(self.texts(), (['Ana Pop', 'Ion Popescu', 'Maria Ionescu', 'Vasile Stan'], 4))
+        self.assertEqual(self.texts(q='ion'), (['Ion Popescu', 'Maria Ionescu'], 2))
+        self.assertEqual(self.texts(q='nobody'), ([], 0))
+
+    def test_pages(self):
+        self.assertEqual(self.texts(page_size=3), (['Ana Pop', 'Ion Popescu', 'Maria Ionescu'], 4))
+        self.assertEqual(self.texts(page_size=3, page=2), (['Vasile Stan'], 4))
+        self.assertEqual(self.texts(page_size=3, page=3), ([], 4))  # scrolled past the last one
+
+    def test_pages_are_capped(self):
+        with patch('cemetery.views.AUTOCOMPLETE_PAGE_SIZE', (2, 3)):
+            self.assertEqual(len(self.texts()[0]), 2)
+            self.assertEqual(len(self.texts(page_size=1000)[0]), 3)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.autocomplete(model='Nothing').status_code, 400)
+        self.assertEqual(self.autocomplete(model='ImportedRow').status_code, 400)  # not in the admin
+        self.assertEqual(self.autocomplete(page='last').status_code, 400)
+        self.assertEqual(self.client.get(reverse('autocomplete'), {'model': 'Owner'}).status_code, 400)
+
+    def test_only_for_who_can_change_the_model(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.autocomplete().status_code, 403)
+        self.client.force_login(User.objects.create_user('visitor'))
+        self.assertEqual(self.autocomplete().status_code, 302)  # to the admin's login
+
+    def test_queries_dont_grow_with_the_entities(self):
+        def queries(n_operations: int) -> int:
+            Spot.objects.all().delete()
+            for i in range(n_operations):
+                spot = Spot.objects.create(parcel='A', row='1', column=str(i + 1))
+                Operation.objects.create(spot=spot, type=Operation.BURIAL, date='2010-01-01', deceased='Ion Pop')
+            with CaptureQueriesContext(connection) as captured:
+                result = self.autocomplete(model='Operation', page_size=50).json()
+            self.assertEqual(len(result['items']), n_operations)
+            return len(captured)
+
+        self.assertEqual(queries(2), queries(20))
@@ -0,0 +1,68 @@
+import re
+
+from django import forms
+from django.contrib.admin import site
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cemetery.models import Spot, Deed, Operation, Construction
+from cemetery.forms import DeedForm
+from cemetery.widgets import AutocompleteSelect, AutocompleteSelectMultiple
+from .test_admin import AdminTestCase
+
+
+def options(html: str) -> [(str, str)]:
+    """ (value, label) of every option rendered """
+    return re.findall(r'<option value="([^"]*)"[^>]*>([^<]*)</option>', html)
+
+
+class AutocompleteWidgetTest(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.spots = [Spot.objects.create(parcel='A', row='1', column=str(column)) for column in range(1, 31)]
+
+    def test_renders_only_the_chosen_entities(self):
+        chosen = [str(self.spots[2].pk), str(self.spots[5].pk)]
+        with CaptureQueriesContext(connection) as captured:
+            html = AutocompleteSelectMultiple(Spot).render('spots', chosen)
+        self.assertEqual(options(html), [(chosen[0], 'A-1-3'), (chosen[1], 'A-1-6')])
+        self.assertEqual(len(captured), 1)
+        self.assertIn(f'data-ajax--url="{reverse("autocomplete")}"', html)
+        self.assertIn('data-model="Spot"', html)
+
+    def test_renders_the_empty_choice_of_its_field_every_time(self):
+        field = forms.ModelChoiceField(Spot.objects.all(), widget=AutocompleteSelect(Spot))
+        html = field.widget.render('spot', str(self.spots[0].pk))
+        self.assertEqual(options(html), [('', field.empty_label), (str(self.spots[0].pk), 'A-1-1')])
+        self.assertEqual(options(field.widget.render('spot', None)), [('', field.empty_label)])
+
+    def test_ignores_what_is_not_a_pk(self):  # a submitted form shown again, before it's validated
+        html = AutocompleteSelectMultiple(Spot).render('spots', ['nothing', str(self.spots[0].pk)])
+        self.assertEqual(options(html), [(str(self.spots[0].pk), 'A-1-1')])
+
+    def test_admin_relations_are_autocompletes(self):
+        operation_admin = site._registry[Operation]
+        field = operation_admin.formfield_for_foreignkey(Operation._meta.get_field('spot'))
+        self.assertIsInstance(field.widget, AutocompleteSelect)
+        construction_admin = site._registry[Construction]
+        field = construction_admin.formfield_for_manytomany(Construction._meta.get_field('spots'))
+        self.assertIsInstance(field.widget, AutocompleteSelectMultiple)
+
+    def test_change_pages_dont_list_every_entity(self):
+        deed = Deed.objects.create(number=1, year=2000)
+        deed.spots.set(self.spots[:2])
+        page = self.client.get(reverse('admin:cemetery_deed_change', args=[deed.pk])).content.decode()
+        spot_options = [label for _value, label in options(page) if label.startswith('A-1-')]
+        self.assertEqual(spot_options, ['A-1-1', 'A-1-2'])
+
+
+class DeedFormTest(AdminTestCase):
+    def test_spots_are_required_as_the_model_field_makes_them(self):
+        self.assertTrue(Deed._meta.get_field('spots').formfield().required)  # not blank
+        form = DeedForm(data={'number': 1, 'year': 2000})
+        self.assertFalse(form.is_valid())
+        self.assertIn('spots', form.errors)
+
+        spot = Spot.objects.create(parcel='A', row='1', column='1')
+        self.assertTrue(DeedForm(data={'number': 1, 'year': 2000, 'spots': [spot.pk]}).is_valid())
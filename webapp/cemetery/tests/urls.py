@@ -0,0 +1,11 @@
+from django.conf.urls import url
+from django.contrib import admin
+
+
+"""
+The admin somewhere else (and without the language prefix), for the tests of links following the urlconf
+"""
+
+urlpatterns = [
+    url(r'^elsewhere/', admin.site.urls),
+]
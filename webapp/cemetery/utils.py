@@ -1,3 +1,11 @@
+from typing import Iterator
+from hashlib import sha1
+
+
+SQLITE_MAX_PARAMS = 999  # parameters a query can have in sqlite (by default, before 3.32)
+QUERY_CHUNK = SQLITE_MAX_PARAMS // 2  # values in the `IN (...)` of a query, leaving room for its other parameters
+
+
 def rev(l: list) -> list:
     """
     >>> rev([1, 2, 3])
@@ -35,6 +43,30 @@ def all_equal(l: list) -> bool:
 def class_name(obj: ...) -> str:
     return type(obj).__name__
 
+def relation_signature(pks) -> str:
+    """
+    Canonical form of a set of related entities (by their pks), to look an entity up by all of them at once
+    (eg: the construction on exactly these spots). Empty for no entities
+
+    Examples:
+        >>> relation_signature([12, 3, 5, 3]) == relation_signature([3, 5, 12])
+        True
+        >>> relation_signature([])
+        ''
+    """
+    pks = sorted(set(pks))
+    if not pks:
+        return ''
+    return sha1(','.join(map(str, pks)).encode()).hexdigest()
+
+def chunks(l: list, size: int) -> Iterator[list]:
+    """
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+    """
+    for start in range(0, len(l), size):
+        yield l[start:start + size]
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -1,16 +1,66 @@
+from typing import Dict, Any
+import json
+
 from django.utils.translation import activate, ugettext_lazy as _
 
-from django.http import HttpResponseBadRequest
-from django.shortcuts import render
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Count
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, Http404
+from django.utils.http import urlencode
+from django.shortcuts import render, redirect, get_object_or_404
+from django.apps import apps
+from django.core.exceptions import PermissionDenied
 from django.contrib import messages
+from django.contrib.admin import site
 from django.contrib.admin.views.decorators import staff_member_required
 
 from .forms import ImportForm
-from .model_parsers import parse_file
-from .models import ALL_MODELS
+from .jobs import spool_upload, submit_import, live_progress
+from .model_parsers import MODELS_METADATA, STATUSES, show_feedback_entities
+from .models import ImportJob
+
+
+DYNAMIC_TRANSLATIONS = [_('fail'), _('add'), _('duplicate'), _('unchanged')]
+
+FEEDBACKS_PER_PAGE = 100  # rows of import feedback
+AUTOCOMPLETE_PAGE_SIZE = 100, 1000  # entities in a page of autocomplete results: by default, at most
+
+
+def feedback_counts(job: ImportJob) -> Dict[str, Dict[str, int]]:
+    """ sheet name ~> status ~> how many rows got it, in the order the sheets are imported """
+    counts = {metadata.sheet_name: {status: 0 for status in STATUSES} for metadata in MODELS_METADATA}
+    rows = job.feedbacks.order_by().values_list('sheet_name', 'status').annotate(Count('pk'))  # no ordering: grouped
+    for sheet_name, status, count in rows:
+        counts.setdefault(sheet_name, {status: 0 for status in STATUSES})[status] = count
+    return counts
+
+
+def feedback_page(request, job: ImportJob, counts: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+    """ the rows of one sheet with the selected statuses, one page at a time (`sheet`, `status` and `page` in GET) """
+    sheet_name = request.GET.get('sheet')
+    if sheet_name not in counts:
+        sheet_name = next(iter(counts))
+    statuses = request.GET.getlist('status') if 'sheet' in request.GET else STATUSES  # all are shown at first
 
+    feedbacks = job.feedbacks.filter(sheet_name=sheet_name, status__in=statuses).prefetch_related('entity')
+    paginator = Paginator(feedbacks, FEEDBACKS_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    show_feedback_entities(page.object_list)
+
+    status_query = urlencode([('status', status) for status in statuses])
+    return {
+        'sheet_name':   sheet_name,
+        'statuses':     statuses,
+        'page':         page,
+        'status_query': status_query,  # to keep the selected statuses when switching sheets
+        'page_query':   urlencode([('sheet', sheet_name)]) + '&' + status_query,  # to change pages
+    }
 
-DYNAMIC_TRANSLATIONS = [_('fail'), _('add'), _('duplicate')]
 
 @staff_member_required
 def import_entries(request):
@@ -23,20 +73,112 @@ def import_entries(request):
         if not form.is_valid():
             return HttpResponseBadRequest()
 
-        # wipe the database before
-        if form.cleaned_data['wipe_beforehand']:
-            for model in ALL_MODELS:
-                model.objects.all().delete()
-
+        # the parsing itself happens in the background, see `jobs.py`
         file = form.cleaned_data['document']
-        sheet_feedbacks, counts = parse_file(file)
-        context['sheet_feedbacks'] = sheet_feedbacks
+        job = ImportJob(file_name=file.name,
+                        wipe_beforehand=form.cleaned_data['wipe_beforehand'],
+                        all_or_nothing=form.cleaned_data['all_or_nothing'],
+                        dry_run=form.cleaned_data['dry_run'],
+                        incremental=form.cleaned_data['incremental'],
+                        time_stages=form.cleaned_data['time_stages'])
+        job.save()
+        submit_import(job, spool_upload(file))
+        return redirect('import-job', job_id=job.pk)
+
+    return render(request, 'import-entries.html', context)
+
+
+@staff_member_required
+def import_job(request, job_id):
+    activate('ro')
+
+    job = get_object_or_404(ImportJob, pk=job_id)
+    context = {'form': ImportForm(), 'job': job}
+
+    if job.status == ImportJob.DONE:
+        counts = feedback_counts(job)
         context['counts'] = counts
+        context.update(feedback_page(request, job, counts))
+        if job.stage_timings:  # shown next to the counts of the selected sheet
+            context['sheet_timings'] = json.loads(job.stage_timings).get(context['sheet_name'])
+
+        totals = {status: sum(count_values[status] for count_values in counts.values()) for status in STATUSES}
+
+        if job.wipe_duration is not None and not job.dry_run:
+            messages.info(request, _(f'The database was wiped in {job.wipe_duration:.1f} seconds'))
 
-        totals = {status: sum(count_values[status] for count_values in counts.values())
-                  for status in ['add', 'fail', 'duplicate']}
+        if job.dry_run:
+            messages.info(request,
+                 _(f'Preview (nothing was saved): {totals["add"]} would be added, {totals["fail"]} would fail, {totals["duplicate"]} duplicates, {totals["unchanged"]} unchanged'))
+        elif job.all_or_nothing and totals['fail']:
+            messages.error(request, _(f'Nothing was imported because {totals["fail"]} rows failed'))
+        else:
+            messages.success(request,
+                 _(f'Finished importing: {totals["add"]} successful, {totals["fail"]} failed, {totals["duplicate"]} duplicates, {totals["unchanged"]} unchanged'))
 
-        messages.success(request,
-             _(f'Finished importing: {totals["add"]} successful, {totals["fail"]} failed, {totals["duplicate"]} duplicates'))
+    elif job.status == ImportJob.CRASHED:
+        if job.dry_run:
+            messages.error(request, _('The preview crashed'))
+        else:
+            messages.error(request, _('The import crashed, nothing was saved from the sheet it was on'))
 
     return render(request, 'import-entries.html', context)
+
+
+@staff_member_required
+def import_timings(request, job_id):
+    """ the stage timings of the whole import, as json (see `import_timings.py`) """
+    job = get_object_or_404(ImportJob, pk=job_id)
+    if not job.stage_timings:
+        raise Http404('The import was not timed')
+    response = HttpResponse(job.stage_timings, content_type='application/json')
+    response['Content-Disposition'] = f'attachment; filename="import-{job.pk}-timings.json"'
+    return response
+
+
+@staff_member_required
+def import_progress(request, job_id):
+    """ polled by the import page while the job runs """
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return JsonResponse({
+        'status':   job.status,
+        'finished': job.is_finished,
+        'progress': live_progress(job),  # sheet name ~> [rows parsed, rows in sheet]
+    })
+
+
+@staff_member_required
+def autocomplete(request):
+    """
+    A page of the entities of a model that its admin's search finds (all of them without a search), polled by
+    the autocompletes jet makes of the relation filters (see `admin.AutocompleteFilter`), with their parameters:
+    `app_label`, `model`, `q`, `page` and `page_size`, giving {'items': [{'id', 'text'}], 'total'}
+    """
+    try:
+        model = apps.get_model(request.GET['app_label'], request.GET['model'])
+        model_admin = site._registry[model]
+        page_number = int(request.GET.get('page') or 1)
+        page_size = min(int(request.GET.get('page_size') or AUTOCOMPLETE_PAGE_SIZE[0]), AUTOCOMPLETE_PAGE_SIZE[1])
+    except (KeyError, LookupError, ValueError):
+        return HttpResponseBadRequest()
+    if not model_admin.has_change_permission(request):
+        raise PermissionDenied
+
+    # not the admin's queryset: its annotations are for the changelist (the foreign keys are for `str`)
+    entities = model._default_manager.select_related()
+    search_term = request.GET.get('q', '').strip()
+    if search_term:
+        entities, use_distinct = model_admin.get_search_results(request, entities, search_term)
+        if use_distinct:
+            entities = entities.distinct()
+
+    paginator = Paginator(entities if entities.ordered else entities.order_by('pk'), page_size)
+    try:
+        page = paginator.page(page_number)
+    except EmptyPage:  # scrolled past the last one
+        page = []
+    return JsonResponse({
+        'error': False,
+        'items': [{'id': entity.pk, 'text': str(entity)} for entity in page],
+        'total': paginator.count,
+    })
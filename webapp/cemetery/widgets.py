@@ -60,3 +60,53 @@ class AddAnotherWidgetWrapper(forms.Widget):
 
     def id_for_label(self, id_):
         return self.widget.id_for_label(id_)
+
+
+class Autocomplete:
+    """
+    Mixin for the select widgets choosing entities of `model` that renders only the chosen ones: jet makes it an
+    autocomplete, which asks `views.autocomplete` for a page of the others at a time, as the user types
+    (instead of an option for every entity of the model, on every load of the change page)
+    """
+    def __init__(self, model, attrs=None):
+        super().__init__(attrs)
+        self.model = model
+
+    def get_context(self, name, value, attrs):
+        attrs = dict(attrs or {}, **{
+            'class': 'ajax',
+            'data-app-label': self.model._meta.app_label,
+            'data-model': self.model._meta.object_name,
+            'data-ajax--url': reverse('autocomplete'),
+        })
+        return super().get_context(name, value, attrs)
+
+    def optgroups(self, name, value, attrs=None):
+        # value: the chosen pks, as strings (they're not validated yet when the submitted form is shown again)
+        field = getattr(self.choices, 'field', None)  # set by the form field, with what to show for no choice
+        empty = [('', field.empty_label)] if getattr(field, 'empty_label', None) is not None else []
+        chosen = self.model._default_manager.filter(pk__in=[pk for pk in value if pk.isdigit()])
+        all_choices, self.choices = self.choices, empty + [(entity.pk, str(entity)) for entity in chosen]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = all_choices  # rendered again (eg: with the form's errors) from the field's ones
+
+
+class AutocompleteSelect(Autocomplete, forms.Select):
+    pass
+
+
+class AutocompleteSelectMultiple(Autocomplete, forms.SelectMultiple):
+    pass
+
+
+class AutocompleteRelations:
+    """ ModelAdmin (or inline) mixin: the foreign keys and many-to-many fields of its forms are autocompletes """
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        kwargs.setdefault('widget', AutocompleteSelect(db_field.remote_field.model))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def formfield_for_manytomany(self, db_field, request=None, **kwargs):
+        kwargs.setdefault('widget', AutocompleteSelectMultiple(db_field.remote_field.model))
+        return super().formfield_for_manytomany(db_field, request, **kwargs)
@@ -0,0 +1,80 @@
+from typing import List
+from time import perf_counter
+
+from django.db import connection, transaction
+
+from .search_index import search_tables
+
+
+"""
+Fast wipe: every row of the given models removed with one DELETE per table.
+`model.objects.all().delete()` collects every entity and every cascading relation in memory first,
+which, on a big database, takes longer than importing it back
+"""
+
+
+def through_tables(models) -> List[str]:
+    """ tables of the (auto created) many-to-many relations of `models` """
+    tables = []
+    for model in models:
+        for field in model._meta.local_many_to_many:
+            through = field.remote_field.through
+            if through._meta.auto_created and through._meta.db_table not in tables:
+                tables.append(through._meta.db_table)
+    return tables
+
+
+def deletion_order(models) -> list:
+    """
+    `models` ordered so that every model comes before the ones it has foreign keys to (children before parents),
+    so no DELETE leaves rows pointing to missing ones
+
+    Raises:
+        ValueError: if a model outside of `models` points to one of them (its rows would be left dangling)
+    """
+    models = list(models)
+    for model in models:
+        for relation in model._meta.related_objects:
+            if not relation.many_to_many and relation.related_model not in models:
+                raise ValueError(f'{relation.related_model.__name__} points to {model.__name__}, wipe it as well')
+
+    ordered = []
+    def visit(model, path=()):
+        if model in ordered or model in path:  # already placed, or a cycle (constraints are checked on commit)
+            return
+        for relation in model._meta.related_objects:
+            if not relation.many_to_many and relation.related_model in models:
+                visit(relation.related_model, path + (model,))
+        ordered.append(model)
+
+    for model in models:
+        visit(model)
+    return ordered
+
+
+def wipe(models, vacuum: bool = False) -> float:
+    """
+    Deletes every entity of `models` (and their many-to-many relations and search documents) inside one transaction.
+    Bypasses the ORM: no signals are sent and nothing is loaded in memory
+
+    Args:
+        models: all the models to empty, anything pointing to them included
+        vacuum: also reclaim the freed space afterwards (skipped inside a transaction, where it's not allowed)
+
+    Returns:
+        seconds it took
+    """
+    start = perf_counter()
+    tables = through_tables(models) + [model._meta.db_table for model in deletion_order(models)] \
+           + search_tables(models)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for table in tables:
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(table)}')
+
+    if vacuum and not connection.in_atomic_block:
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+
+    return perf_counter() - start
@@ -1,7 +1,7 @@
 from django.conf.urls import include, url
 from django.conf.urls.i18n import i18n_patterns
 
-from cemetery.views import import_entries
+from cemetery.views import import_entries, import_job, import_progress, import_timings, autocomplete
 
 
 urlpatterns = [
@@ -13,4 +13,8 @@ urlpatterns += i18n_patterns(
     url(r'^', include('cemetery.urls')),
     # we have to do it here because translatable patterns can't be included
     url(r'^import$', import_entries, name='import'),
+    url(r'^import/(?P<job_id>\d+)$', import_job, name='import-job'),
+    url(r'^import/(?P<job_id>\d+)/progress$', import_progress, name='import-progress'),
+    url(r'^import/(?P<job_id>\d+)/timings$', import_timings, name='import-timings'),
+    url(r'^autocomplete$', autocomplete, name='autocomplete'),
 )